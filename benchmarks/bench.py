@@ -0,0 +1,368 @@
+# Benchmarks of the hot paths, run against recorded Overpass and Nominatim responses so no network is needed
+#
+#   python benchmarks/bench.py --record             records live responses to benchmarks/fixtures.json.gz
+#   python benchmarks/bench.py --record-synthetic   generates responses instead, for machines without network
+#   python benchmarks/bench.py [--baseline old.json] [--radii 0.5 1 2] [--runs 100 10000 100000]
+#
+# Every run saves its timings to benchmarks/results/<commit>.json. With --baseline the timings are
+# compared to an earlier results file and the exit code is 1 when a stage got slower than --max-ratio.
+# Synthetic fixtures are marked as synthetic in the fixtures file and in the results
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+import overpass
+import geocode
+import http_client
+import display
+import results
+import obfuscation
+import hybrid
+import poi
+import walkable
+import simulation
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIXTURES = os.path.join(HERE, "fixtures.json.gz")
+RESULTS_DIR = os.path.join(HERE, "results")
+RADII = (0.5, 1.0, 2.0)
+RUNS = (100, 10000, 100000)
+REPEAT = 3
+MAX_RATIO = 1.2     # slowest allowed time compared to the baseline before it counts as a regression
+MIN_SECONDS = 0.001 # stages faster than this in both runs are too noisy to count as a regression
+
+# Addresses the fixtures are recorded for, with the coordinates synthetic fixtures use
+LOCATIONS = {
+    "1000 Hilltop Circle, Baltimore": (39.2556, -76.7110),
+    "1726 East Preston Street, Baltimore": (39.3050, -76.5960),
+    "Inner Harbor, Baltimore": (39.2854, -76.6122),
+}
+
+# Generated elements per square km for --record-synthetic
+SYNTHETIC_DENSITY = {"poi": 120, "walkable": 250}
+POI_TAGS = [("amenity", "cafe"), ("amenity", "restaurant"), ("shop", "convenience"),
+            ("leisure", "park"), ("tourism", "museum"), ("amenity", "bank")]
+HIGHWAYS = ["residential", "footway", "service", "secondary", "path", "primary"]
+
+# Overpass-like response for a query, the same query always gives the same elements
+def synthetic_response(query):
+    around = re.search(r"around:([\d.]+),([-\d.]+),([-\d.]+)", query)
+    rad_m, lat, lon = (float(v) for v in around.groups())
+    kind = "walkable" if '"highway"' in query else "poi"
+    rng = np.random.default_rng(int(hashlib.sha1(query.encode("utf-8")).hexdigest()[:12], 16))
+    rad = rad_m / 1000
+    count = int(SYNTHETIC_DENSITY[kind] * np.pi * rad ** 2)
+    dist = rad * np.sqrt(rng.random(count))
+    angle = rng.random(count) * 2 * np.pi
+    lats = lat + dist * np.cos(angle) / overpass.KM_PER_DEGREE
+    lons = lon + dist * np.sin(angle) / (overpass.KM_PER_DEGREE * np.cos(np.radians(lat)))
+    elements = []
+    for i in range(count):
+        point = {"lat": round(float(lats[i]), 7), "lon": round(float(lons[i]), 7)}
+        if kind == "poi":
+            key, value = POI_TAGS[i % len(POI_TAGS)]
+            tags = {key: value}
+            # about one in five real POIs has no name and is left out
+            if i % 5:
+                tags["name"] = f"Synthetic {value} {i}"
+            if i % 3:
+                elements.append({"type": "node", "id": i + 1, **point, "tags": tags})
+            else:
+                elements.append({"type": "way", "id": i + 1, "center": point, "tags": tags})
+        else:
+            tags = {"highway": HIGHWAYS[i % len(HIGHWAYS)]}
+            if i % 2:
+                tags["name"] = f"Synthetic Street {i // 2}"
+            elements.append({"type": "way", "id": i + 1, "center": point, "tags": tags})
+    return json.dumps({"version": 0.6, "generator": "synthetic", "elements": elements})
+
+# Nominatim-like response for an address, the addresses of LOCATIONS are found at their coordinates
+def synthetic_nominatim(address):
+    coords = LOCATIONS.get(address)
+    if not coords:
+        return "[]"
+    lat, lon = coords
+    return json.dumps([{
+        "place_id": int(hashlib.sha1(address.encode("utf-8")).hexdigest()[:8], 16),
+        "licence": "Data (c) OpenStreetMap contributors, ODbL 1.0. http://osm.org/copyright",
+        "osm_type": "way", "osm_id": 1, "lat": f"{lat:.7f}", "lon": f"{lon:.7f}",
+        "category": "place", "type": "house", "place_rank": 30, "importance": 0.1, "addresstype": "place",
+        "name": "", "display_name": f"{address}, Maryland, United States",
+        "boundingbox": [f"{lat - 0.0005:.7f}", f"{lat + 0.0005:.7f}", f"{lon - 0.0005:.7f}", f"{lon + 0.0005:.7f}"],
+    }])
+
+# Stands in for a requests response, so geocode.py and overpass.py parse the recorded body themselves
+class RecordedResponse:
+    status_code = 200
+
+    def __init__(self, text):
+        self.text = text
+        self.content = text.encode("utf-8")
+
+    def json(self):
+        return json.loads(self.text)
+
+# The fixtures a request is kept under, Nominatim by address and Overpass by query
+def fixture_key(url, params):
+    if url == geocode.NOMINATIM_URL:
+        return "nominatim", params["q"]
+    return "overpass", params["data"]
+
+# Sends the tile cache of the run to a file of its own and empties the tiles kept in memory
+def use_tile_cache(path):
+    overpass.CACHE_ENABLED = True
+    overpass.CACHE_PATH = path
+    overpass.OFFLINE_DB = None
+    overpass._cache = None
+    overpass._tiles.clear()
+
+# Fixture files ending in .gz are compressed, the fixtures kept in the repository are
+def open_fixtures(path, mode="r"):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+# Looks up every address and runs every query the benchmark makes through the tile cache,
+# and saves the raw response bodies
+def record(path, radii, synthetic):
+    fixtures = {"synthetic": synthetic, "recorded": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "nominatim": {}, "overpass": {}}
+    live_get = http_client.get
+
+    def get(url, params=None, **kwargs):
+        kind, key = fixture_key(url, params)
+        if not synthetic:
+            text = live_get(url, params=params, **kwargs).text
+        elif kind == "nominatim":
+            text = synthetic_nominatim(key)
+        else:
+            text = synthetic_response(key)
+        fixtures[kind][key] = text
+        return RecordedResponse(text)
+    http_client.get = get
+
+    with tempfile.TemporaryDirectory() as scratch:
+        use_tile_cache(os.path.join(scratch, "overpass_cache.sqlite"))
+        for address in LOCATIONS:
+            coords = geocode.lookup(address)
+            if not coords:
+                continue
+            for radius in radii:
+                for kind in ("poi", "walkable"):
+                    overpass.fetch_elements(kind, coords[0], coords[1], radius)
+        overpass._cache = None
+    with open_fixtures(path, "w") as file:
+        json.dump(fixtures, file)
+    print(f"Recorded {len(fixtures['nominatim'])} addresses and {len(fixtures['overpass'])} responses to {path}")
+
+# Answers Nominatim and Overpass requests with the recorded bodies. Only the network is left
+# out, the failover, the JSON parsing and the geocode and tile caches all run like they do live
+def replay(fixtures):
+    def get(url, params=None, **kwargs):
+        kind, key = fixture_key(url, params)
+        if key not in fixtures[kind]:
+            raise KeyError("No recorded response for a request, record the fixtures again")
+        return RecordedResponse(fixtures[kind][key])
+    http_client.get = get
+
+# Times a function, returns the min and median over repeat calls and the last return value
+def timed(function, repeat):
+    times = []
+    value = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = function()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": statistics.median(times)}, value
+
+def run_benchmarks(fixtures, radii, runs, repeat):
+    timings = {}
+
+    def add(stage, radius, num_runs, timing):
+        key = f"{stage}|r={radius}|runs={num_runs}"
+        timings[key] = timing
+        print(f"{key:<42} min {timing['min'] * 1000:10.3f} ms  median {timing['median'] * 1000:10.3f} ms")
+
+    addresses = list(fixtures["nominatim"])
+    geocode.GEOCODE_CACHE_PATH = os.path.join(os.getcwd(), "geocode_cache.sqlite")
+    geocode._cache = None
+    timing, _ = timed(lambda: [geocode.lookup(address) for address in addresses], repeat)
+    add("geocode_lookup", "-", "-", timing)
+    # the first repeat looks every address up, the others come from the geocode cache
+    timing, found_coords = timed(lambda: [geocode.get_coordinates(address) for address in addresses], repeat)
+    add("geocode", "-", "-", timing)
+    coords_list = [coords for coords in found_coords if coords]
+    timing, _ = timed(lambda: [json.loads(text) for text in fixtures["overpass"].values()], repeat)
+    add("json_parse", "-", "-", timing)
+
+    use_tile_cache(os.path.join(os.getcwd(), "overpass_cache.sqlite"))
+
+    # the tiles of every user, keep_memory or keep_disk False empties that cache first
+    def fetch_tiles(radius, keep_memory=True, keep_disk=True):
+        if not keep_memory:
+            overpass._tiles.clear()
+        if not keep_disk:
+            overpass.get_cache().clear()
+        return [overpass.fetch_tile(kind, lat, lon, radius)
+                for lat, lon in coords_list for kind in ("poi", "walkable")]
+
+    for radius in radii:
+        # every tile downloaded and parsed, then read back from the disk cache, the find stages
+        # below get them from memory
+        timing, _ = timed(lambda: fetch_tiles(radius, keep_memory=False, keep_disk=False), repeat)
+        add("tile_download", radius, "-", timing)
+        timing, _ = timed(lambda: fetch_tiles(radius, keep_memory=False), repeat)
+        add("tile_disk", radius, "-", timing)
+        timing, found = timed(lambda: [(obfuscation.FindPOIs(lat, lon, radius),
+                                        obfuscation.FindWalkableAreas(lat, lon, radius))
+                                       for lat, lon in coords_list], repeat)
+        add("hybrid_find", radius, "-", timing)
+        timing, candidates = timed(lambda: [obfuscation.ChooseLocations(p, w) for p, w in found], repeat)
+        add("hybrid_choose", radius, "-", timing)
+        timing, poi_lists = timed(lambda: [poi.FindPOIs(lat, lon, radius) for lat, lon in coords_list], repeat)
+        add("poi_find", radius, "-", timing)
+        timing, _ = timed(lambda: [[poi.ParsePOI(p) for p in pois] for pois in poi_lists], repeat)
+        add("poi_parse", radius, "-", timing)
+        timing, walkable_lists = timed(
+            lambda: [walkable.FindWalkableAreas(lat, lon, radius) for lat, lon in coords_list], repeat)
+        add("walkable_find", radius, "-", timing)
+
+        for num_runs in runs:
+            pairs = [(coords, locs) for coords, locs in zip(coords_list, candidates) if locs]
+            timing, simulated = timed(lambda: [obfuscation.SimulateRuns(coords, locs, num_runs,
+                                                                        np.random.default_rng(0))
+                                               for coords, locs in pairs], repeat)
+            add("hybrid_simulate", radius, num_runs, timing)
+            timing, _ = timed(lambda: [simulation.curves(
+                [float(loc[1]) for loc in locs], [float(loc[2]) for loc in locs], coords[0], coords[1],
+                result["choices"]) for (coords, locs), result in zip(pairs, simulated)], repeat)
+            add("metrics", radius, num_runs, timing)
+            timing, _ = timed(lambda: [poi.RunPOI(coords, radius, 0.002, num_runs, pois=pois,
+                                                  rng=np.random.default_rng(0))
+                                       for coords, pois in zip(coords_list, poi_lists) if pois], repeat)
+            add("poi_run", radius, num_runs, timing)
+            timing, _ = timed(lambda: [walkable.run_walkable(coords, radius, num_runs, areas)
+                                       for coords, areas in zip(coords_list, walkable_lists) if areas], repeat)
+            add("walkable_run", radius, num_runs, timing)
+
+            if not pairs:
+                continue
+            (coords, locs), result = pairs[0], simulated[0]
+            counter = obfuscation.PickCounts(locs, result["choices"])
+            timing, _ = timed(lambda: hybrid.CreateMap(coords[0], coords[1], radius, locs, counter), repeat)
+            add("map", radius, num_runs, timing)
+            timing, _ = timed(lambda: hybrid.make_graph(result["utility"], result["privacy"]), repeat)
+            add("plot", radius, num_runs, timing)
+
+            def write_results():
+                writer = results.ResultsWriter("hybrid_data.npz")
+                writer.add(locs, result["choices"], result["utility"], result["privacy"])
+                writer.write()
+            timing, _ = timed(write_results, repeat)
+            add("results_npz", radius, num_runs, timing)
+    return timings
+
+def commit_id():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+# Prints every stage next to the baseline, returns the stages that got slower than max_ratio
+def compare(current, baseline, max_ratio):
+    regressions = []
+    print(f"\n{'stage':<42} {'baseline ms':>12} {'current ms':>12} {'ratio':>7}")
+    for key, timing in current["timings"].items():
+        old = baseline["timings"].get(key)
+        if not old:
+            continue
+        ratio = timing["min"] / old["min"] if old["min"] > 0 else float("inf")
+        slower = ratio > max_ratio and max(timing["min"], old["min"]) >= MIN_SECONDS
+        flag = "  slower" if slower else ""
+        print(f"{key:<42} {old['min'] * 1000:12.3f} {timing['min'] * 1000:12.3f} {ratio:7.2f}{flag}")
+        if slower:
+            regressions.append(key)
+    if baseline.get("synthetic") != current.get("synthetic"):
+        print("Warning: one of the runs used synthetic fixtures and the other recorded ones")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the hot paths against recorded responses")
+    parser.add_argument("--record", action="store_true", help="record live Overpass and Nominatim responses")
+    parser.add_argument("--record-synthetic", action="store_true", help="record generated responses")
+    parser.add_argument("--fixtures", default=FIXTURES)
+    parser.add_argument("--radii", type=float, nargs="+", default=list(RADII))
+    parser.add_argument("--runs", type=int, nargs="+", default=list(RUNS))
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--out", help="results file, benchmarks/results/<commit>.json by default")
+    parser.add_argument("--baseline", help="earlier results file to compare with")
+    parser.add_argument("--max-ratio", type=float, default=MAX_RATIO)
+    args = parser.parse_args()
+
+    if args.record or args.record_synthetic:
+        record(args.fixtures, args.radii, synthetic=args.record_synthetic)
+        return 0
+    if not os.path.exists(args.fixtures):
+        print(f"No fixtures at {args.fixtures}, run with --record or --record-synthetic first")
+        return 1
+    with open_fixtures(args.fixtures) as file:
+        fixtures = json.load(file)
+    if "nominatim" not in fixtures:
+        print(f"{args.fixtures} is from an older version without the raw Nominatim responses, record it again")
+        return 1
+    if fixtures.get("synthetic"):
+        print("Using synthetic fixtures, the timings are not from real OpenStreetMap data")
+
+    replay(fixtures)
+    display.set_headless()
+    results.set_quiet()
+    # the benchmark changes directory, so paths given on the command line are made absolute first
+    out = os.path.abspath(args.out) if args.out else os.path.join(RESULTS_DIR, f"{commit_id()}.json")
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    # maps, graphs and result files go to a scratch folder
+    with tempfile.TemporaryDirectory() as scratch:
+        os.chdir(scratch)
+        timings = run_benchmarks(fixtures, args.radii, args.runs, args.repeat)
+        os.chdir(ROOT)
+
+    current = {
+        "commit": commit_id(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "synthetic": bool(fixtures.get("synthetic")),
+        "fixtures_recorded": fixtures.get("recorded"),
+        "repeat": args.repeat,
+        "timings": timings,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as file:
+        json.dump(current, file, indent=2)
+    print(f"Saved results to {out}")
+
+    if baseline_path:
+        with open(baseline_path, encoding="utf-8") as file:
+            baseline = json.load(file)
+        regressions = compare(current, baseline, args.max_ratio)
+        if regressions:
+            print(f"{len(regressions)} stages are more than {args.max_ratio}x slower than the baseline")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,256 @@
+import json
+import math
+import os
+import shutil
+import sys
+import numpy as np
+import overpass
+import distance
+
+# Default size of a grid cell in degrees, about 550 m of latitude
+CELL_SIZE = 0.005
+
+# Codes used for the location type of each candidate
+KINDS = ("poi", "walkable")
+
+# Works out the rows and columns needed to cover a bounding box. The spans are rounded first
+# so float error such as 0.01 / 0.005 = 2.0000000000000018 does not add a row or column of cells
+def grid_shape(min_lat, min_lon, max_lat, max_lon, cell_size):
+    rows = max(1, math.ceil(round((max_lat - min_lat) / cell_size, 9)))
+    cols = max(1, math.ceil(round((max_lon - min_lon) / cell_size, 9)))
+    return rows, cols
+
+# Center of a cell, which is where its candidates are searched from
+def cell_center(meta, cell):
+    row, col = divmod(cell, meta['cols'])
+    lat = meta['min_lat'] + (row + 0.5) * meta['cell_size']
+    lon = meta['min_lon'] + (col + 0.5) * meta['cell_size']
+    return lat, lon
+
+# Finds the candidate list hybrid.py would build for every cell
+def compute_cells(meta, cells):
+    import obfuscation
+    lists = {}
+    for cell in cells:
+        lat, lon = cell_center(meta, cell)
+        pois = obfuscation.FindPOIs(lat, lon, meta['radius'])
+        walkable_areas = obfuscation.FindWalkableAreas(lat, lon, meta['radius'])
+        lists[cell] = obfuscation.ChooseLocations(pois, walkable_areas)
+    return lists
+
+# Versions of the arrays kept on disk, older ones are removed after a save
+KEEP_VERSIONS = 2
+
+def _versions(out_dir):
+    found = []
+    for name in os.listdir(out_dir):
+        if name.startswith("v") and name[1:].isdigit() and os.path.isdir(os.path.join(out_dir, name)):
+            found.append(int(name[1:]))
+    return sorted(found)
+
+# Saves the grid arrays to a new version directory and then points meta.json at it, so the
+# whole set is swapped in at once. A reader opened before or during a refresh keeps using the
+# arrays of the version its meta.json named and never mixes files of two versions
+def save_arrays(out_dir, meta, arrays):
+    os.makedirs(out_dir, exist_ok=True)
+    versions = _versions(out_dir)
+    version = f"v{versions[-1] + 1 if versions else 1}"
+    os.makedirs(os.path.join(out_dir, version))
+    for name, array in arrays.items():
+        np.save(os.path.join(out_dir, version, f"{name}.npy"), array)
+    meta = dict(meta, version=version)
+    tmp_path = os.path.join(out_dir, "meta.json.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(meta, file, indent=2)
+    os.replace(tmp_path, os.path.join(out_dir, "meta.json"))
+
+    # the previous version stays for readers that read meta.json just before the swap
+    for old in _versions(out_dir)[:-KEEP_VERSIONS]:
+        shutil.rmtree(os.path.join(out_dir, f"v{old}"), ignore_errors=True)
+
+# Adds the candidates of a list to the candidate table and returns their ids,
+# first_id is the number of candidates already stored before the table
+def _candidate_ids(table, ids, locations, first_id=0):
+    found = []
+    for name, lat, lon, loc_type in locations:
+        key = (name, lat, lon, loc_type)
+        if key not in ids:
+            ids[key] = first_id + len(table['names'])
+            table['names'].append(name.encode('utf-8'))
+            table['lat'].append(lat)
+            table['lon'].append(lon)
+            table['kind'].append(KINDS.index(loc_type))
+        found.append(ids[key])
+    return found
+
+def _table_arrays(table, lat=None, lon=None, kind=None, names=None, name_offsets=None):
+    lengths = [len(b) for b in table['names']]
+    start = 0 if name_offsets is None else int(name_offsets[-1])
+    new_offsets = start + np.cumsum(lengths, dtype=np.int64)
+    new_names = np.frombuffer(b"".join(table['names']), dtype=np.uint8)
+    return {
+        'lat': np.concatenate([lat if lat is not None else [], np.array(table['lat'], dtype=np.float64)]),
+        'lon': np.concatenate([lon if lon is not None else [], np.array(table['lon'], dtype=np.float64)]),
+        'kind': np.concatenate([kind if kind is not None else np.zeros(0, np.uint8),
+                                np.array(table['kind'], dtype=np.uint8)]).astype(np.uint8),
+        'names': np.concatenate([names if names is not None else np.zeros(0, np.uint8), new_names]),
+        'name_offsets': np.concatenate([name_offsets if name_offsets is not None else np.zeros(1, np.int64),
+                                        new_offsets]).astype(np.int64),
+    }
+
+# Writes the per-cell lists as flat arrays: one table of unique candidates plus
+# an index of candidate ids per cell and the offsets of each cell in that index
+def write_grid(out_dir, meta, cell_lists):
+    table = {'names': [], 'lat': [], 'lon': [], 'kind': []}
+    ids = {}
+    index = []
+    offsets = [0]
+    for cell in range(meta['rows'] * meta['cols']):
+        index.extend(_candidate_ids(table, ids, cell_lists.get(cell, [])))
+        offsets.append(len(index))
+    arrays = _table_arrays(table)
+    arrays['index'] = np.array(index, dtype=np.int32)
+    arrays['offsets'] = np.array(offsets, dtype=np.int64)
+    save_arrays(out_dir, meta, arrays)
+
+# Cells whose candidate list can contain an element at one of the given points.
+# A cell lists the elements within the radius of its center, so only those cells change
+def affected_cells(meta, points):
+    radius = meta['radius']
+    size = meta['cell_size']
+    cells = set()
+    for lat, lon in points:
+        dlat = radius / overpass.KM_PER_DEGREE
+        dlon = radius / (overpass.KM_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+        low_row = max(0, math.floor((lat - dlat - meta['min_lat']) / size))
+        high_row = min(meta['rows'] - 1, math.floor((lat + dlat - meta['min_lat']) / size))
+        low_col = max(0, math.floor((lon - dlon - meta['min_lon']) / size))
+        high_col = min(meta['cols'] - 1, math.floor((lon + dlon - meta['min_lon']) / size))
+        for row in range(low_row, high_row + 1):
+            for col in range(low_col, high_col + 1):
+                cell = row * meta['cols'] + col
+                center_lat, center_lon = cell_center(meta, cell)
+                if distance.haversine_scalar(center_lat, center_lon, lat, lon) <= radius * 1.001:
+                    cells.add(cell)
+    return sorted(cells)
+
+# Recomputes only the cells around changed elements and swaps in the new arrays.
+# Candidates no longer listed by any cell stay in the table until the grid is rebuilt
+def refresh_grid(path, points):
+    grid = CandidateGrid(path)
+    meta = grid.meta
+    cells = affected_cells(meta, points)
+    if not cells:
+        return cells
+    new_lists = compute_cells(meta, cells)
+
+    # new candidates are appended after the existing table
+    ids = {}
+    for i in range(len(grid.lat)):
+        ids[(grid.name(i), float(grid.lat[i]), float(grid.lon[i]), KINDS[grid.kind[i]])] = i
+    table = {'names': [], 'lat': [], 'lon': [], 'kind': []}
+
+    pieces = []
+    lengths = []
+    for cell in range(meta['rows'] * meta['cols']):
+        if cell in new_lists:
+            piece = np.array(_candidate_ids(table, ids, new_lists[cell], len(grid.lat)), dtype=np.int32)
+        else:
+            piece = np.array(grid.index[grid.offsets[cell]:grid.offsets[cell + 1]])
+        pieces.append(piece)
+        lengths.append(len(piece))
+
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    arrays = _table_arrays(
+        table,
+        np.array(grid.lat), np.array(grid.lon), np.array(grid.kind),
+        np.array(grid.names), np.array(grid.name_offsets)
+    )
+    arrays['index'] = np.concatenate(pieces).astype(np.int32) if pieces else np.zeros(0, np.int32)
+    arrays['offsets'] = offsets
+    del grid
+    save_arrays(path, meta, arrays)
+    return cells
+
+# Batch job that covers a bounding box with cells and stores the candidates of every cell
+def build_grid(min_lat, min_lon, max_lat, max_lon, radius, out_dir, cell_size=CELL_SIZE):
+    rows, cols = grid_shape(min_lat, min_lon, max_lat, max_lon, cell_size)
+    meta = {
+        'min_lat': min_lat,
+        'min_lon': min_lon,
+        'cell_size': cell_size,
+        'rows': rows,
+        'cols': cols,
+        'radius': radius,
+    }
+    cell_lists = compute_cells(meta, range(rows * cols))
+    write_grid(out_dir, meta, cell_lists)
+    return meta
+
+# Read-only view of a grid, the arrays are memory mapped so opening it costs almost nothing
+class CandidateGrid:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), encoding="utf-8") as file:
+            self.meta = json.load(file)
+        # grids saved before versions were used keep their arrays next to meta.json
+        self.array_dir = os.path.join(path, self.meta['version']) if 'version' in self.meta else path
+        self.lat = self._load("lat.npy")
+        self.lon = self._load("lon.npy")
+        self.kind = self._load("kind.npy")
+        self.names = self._load("names.npy")
+        self.name_offsets = self._load("name_offsets.npy")
+        self.index = self._load("index.npy")
+        self.offsets = self._load("offsets.npy")
+
+    def _load(self, filename):
+        return np.load(os.path.join(self.array_dir, filename), mmap_mode='r')
+
+    # Returns the cell number of a point, or None when it is outside the grid
+    def cell_of(self, lat, lon):
+        meta = self.meta
+        row = math.floor((lat - meta['min_lat']) / meta['cell_size'])
+        col = math.floor((lon - meta['min_lon']) / meta['cell_size'])
+        if row < 0 or col < 0 or row >= meta['rows'] or col >= meta['cols']:
+            return None
+        return row * meta['cols'] + col
+
+    # True when the grid was built for this radius and contains the point
+    def covers(self, lat, lon, radius):
+        return self.meta['radius'] == radius and self.cell_of(lat, lon) is not None
+
+    # Candidate ids of the cell containing a point
+    def candidate_ids(self, lat, lon):
+        cell = self.cell_of(lat, lon)
+        if cell is None:
+            return self.index[0:0]
+        return self.index[self.offsets[cell]:self.offsets[cell + 1]]
+
+    # Latitudes, longitudes and type codes of the candidates near a point
+    def arrays(self, lat, lon):
+        ids = self.candidate_ids(lat, lon)
+        return self.lat[ids], self.lon[ids], self.kind[ids]
+
+    def name(self, candidate_id):
+        start, end = self.name_offsets[candidate_id], self.name_offsets[candidate_id + 1]
+        return bytes(self.names[start:end]).decode('utf-8')
+
+    # Candidates near a point in the same (name, lat, lon, type) form hybrid.py uses
+    def candidates(self, lat, lon):
+        return [
+            (self.name(i), float(self.lat[i]), float(self.lon[i]), KINDS[self.kind[i]])
+            for i in self.candidate_ids(lat, lon)
+        ]
+
+def main():
+    if len(sys.argv) < 7:
+        print("Usage: python candidate_grid.py <min_lat> <min_lon> <max_lat> <max_lon> <radius_km> <out_dir> [cell_size]")
+        return
+    min_lat, min_lon, max_lat, max_lon, radius = (float(v) for v in sys.argv[1:6])
+    cell_size = float(sys.argv[7]) if len(sys.argv) > 7 else CELL_SIZE
+    meta = build_grid(min_lat, min_lon, max_lat, max_lon, radius, sys.argv[6], cell_size)
+    print(f"Wrote {meta['rows'] * meta['cols']} cells to {sys.argv[6]}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+import hashlib
+import itertools
+import math
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import geo_ind
+import distance
+import instrumentation
+from spatial_index import KM_PER_DEGREE
+
+# l-clustering of large sets of user locations: every user is reported as the noisy centroid of a
+# cluster of at least l nearby users. Points are put in order along a Hilbert curve, which keeps
+# points that are close on the map close in the order, and every l consecutive points form a cluster.
+# The points that do not fill a last cluster join the one before it instead of being dropped.
+# Input can be streamed in chunks, so millions of locations are clustered with bounded memory.
+# The mini-batch k-means further down groups candidate locations into a coarse tier for dense areas
+
+# The Hilbert curve covers the whole world on a 2^ORDER by 2^ORDER grid, about 40 m per cell,
+# so chunks of the same stream share one order
+HILBERT_ORDER = 20
+CLUSTER_SIZE = 2
+CHUNK_SIZE = 1_000_000
+
+# Settings for the mini-batch k-means of candidate locations
+KMEANS_BATCH = 1024     # points per mini-batch
+KMEANS_STEPS = 30       # mini-batches for a new fit
+KMEANS_WARM_STEPS = 5   # mini-batches when starting from the cached centers
+CENTER_TILES = 256      # tiles of cluster centers kept in memory
+CENTER_DISK_TILES = 4096
+# Cluster centers are also kept on disk so later runs in the same tile reuse them,
+# set DATAPRIVACY_CENTER_CACHE=0 to only keep them in memory
+CENTER_CACHE_PATH = os.environ.get("DATAPRIVACY_CENTER_CACHE", "cluster_cache.sqlite")
+
+# Position of every point along the Hilbert curve. The flips and swaps of each step are done
+# with XOR masks on whole arrays, n - 1 - x is x ^ (n - 1) for x < n
+def hilbert_keys(lats, lons, order=HILBERT_ORDER):
+    top = (1 << order) - 1
+    x = np.clip(((np.asarray(lons, dtype=np.float64) + 180) / 360 * (1 << order)).astype(np.int64), 0, top)
+    y = np.clip(((np.asarray(lats, dtype=np.float64) + 90) / 180 * (1 << order)).astype(np.int64), 0, top)
+    keys = np.zeros(len(x), dtype=np.int64)
+    s = 1 << (order - 1)
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        keys += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant so the curve stays continuous
+        flip = -(rx & ~ry).astype(np.int64) & top
+        x ^= flip
+        y ^= flip
+        swap = (x ^ y) & -(~ry).astype(np.int64)
+        x ^= swap
+        y ^= swap
+        s >>= 1
+    return keys
+
+# Orders the points along the Hilbert curve and splits them into clusters of l points,
+# the last cluster also takes the leftover points. Returns the order and the start of
+# every cluster in it, cluster c is order[starts[c]:starts[c + 1]]
+def l_clusters(lats, lons, l=CLUSTER_SIZE):
+    order = np.argsort(hilbert_keys(lats, lons), kind="stable")
+    starts = np.arange(max(1, len(order) // l)) * l
+    return order, np.append(starts, len(order))
+
+# Centroid of every cluster with planar Laplace noise (epsilon per metre, see geo_ind.py),
+# from sums over the sorted points instead of a loop per cluster.
+# Returns the noisy centroid latitude and longitude of every point, in the order the points were given
+def noisy_centroids(lats, lons, order, starts, epsilon=geo_ind.EPSILON, rng=None):
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    if not len(order):
+        return np.empty(0), np.empty(0)
+    sizes = np.diff(starts)
+    centroid_lats = np.add.reduceat(lats[order], starts[:-1]) / sizes
+    centroid_lons = np.add.reduceat(lons[order], starts[:-1]) / sizes
+    noisy_lats, noisy_lons = geo_ind.obfuscate(centroid_lats, centroid_lons, epsilon, rng)
+    result_lats = np.empty(len(order))
+    result_lons = np.empty(len(order))
+    result_lats[order] = np.repeat(noisy_lats, sizes)
+    result_lons[order] = np.repeat(noisy_lons, sizes)
+    return result_lats, result_lons
+
+# Clusters the points of every chunk and yields (ids, noisy lats, noisy lons) for the users
+# that are done, ids count the points from 0 across the whole stream. The last cluster of a chunk
+# is carried into the next one, so the leftover points of the stream can still join a full cluster.
+# Clusters are tightest when the chunks hold nearby points, such as a stream sorted by region.
+# Only when the whole stream has fewer than l points is a cluster smaller than l
+def stream_clusters(chunks, l=CLUSTER_SIZE, epsilon=geo_ind.EPSILON, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
+    carry_ids = np.empty(0, dtype=np.int64)
+    carry_lats = np.empty(0)
+    carry_lons = np.empty(0)
+    next_id = 0
+    for chunk_lats, chunk_lons in chunks:
+        chunk_lats = np.asarray(chunk_lats, dtype=np.float64)
+        chunk_lons = np.asarray(chunk_lons, dtype=np.float64)
+        ids = np.concatenate([carry_ids, np.arange(next_id, next_id + len(chunk_lats))])
+        lats = np.concatenate([carry_lats, chunk_lats])
+        lons = np.concatenate([carry_lons, chunk_lons])
+        next_id += len(chunk_lats)
+
+        order, starts = l_clusters(lats, lons, l)
+        if len(starts) <= 2:
+            carry_ids, carry_lats, carry_lons = ids, lats, lons
+            continue
+        # everything but the last cluster is finished
+        done = order[:starts[-2]]
+        kept = order[starts[-2]:]
+        noisy_lats, noisy_lons = noisy_centroids(
+            lats[done], lons[done], np.arange(len(done)), starts[:-1], epsilon, rng
+        )
+        yield ids[done], noisy_lats, noisy_lons
+        carry_ids, carry_lats, carry_lons = ids[kept], lats[kept], lons[kept]
+
+    if len(carry_ids):
+        starts = np.array([0, len(carry_ids)])
+        noisy_lats, noisy_lons = noisy_centroids(
+            carry_lats, carry_lons, np.arange(len(carry_ids)), starts, epsilon, rng
+        )
+        yield carry_ids, noisy_lats, noisy_lons
+
+# Points in km on a flat map around lat0, close enough for the size of a tile
+def _project(lats, lons, lat0):
+    return np.column_stack([np.asarray(lons) * math.cos(math.radians(lat0)) * KM_PER_DEGREE,
+                            np.asarray(lats) * KM_PER_DEGREE])
+
+def _closest(points, centers):
+    d = (points * points).sum(axis=1)[:, None] - 2 * points @ centers.T + (centers * centers).sum(axis=1)[None, :]
+    return np.argmin(d, axis=1)
+
+# k-means++ starting centers: each next center is a point picked with a chance in
+# proportion to its squared distance from the closest center so far
+def _seed_centers(points, k, rng):
+    centers = [points[rng.integers(len(points))]]
+    closest = ((points - centers[0]) ** 2).sum(axis=1)
+    for _ in range(1, k):
+        total = closest.sum()
+        pick = rng.integers(len(points)) if total <= 0 else rng.choice(len(points), p=closest / total)
+        centers.append(points[pick])
+        closest = np.minimum(closest, ((points - points[pick]) ** 2).sum(axis=1))
+    return np.array(centers)
+
+# Mini-batch k-means of locations. Every step assigns a random batch of points to the closest
+# centers and moves each center towards the mean of its points by 1 / (points it has seen),
+# so a center settles as it sees more points. Starting centers and their counts can be passed
+# in to carry on from an earlier fit. Returns the center latitudes, longitudes and counts
+def minibatch_kmeans(lats, lons, k, centers=None, counts=None, steps=KMEANS_STEPS, batch_size=KMEANS_BATCH, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    lat0 = float(lats.mean())
+    points = _project(lats, lons, lat0)
+    if centers is None:
+        centers = _seed_centers(points, min(k, len(points)), rng)
+        counts = np.zeros(len(centers))
+    else:
+        centers = _project(centers[0], centers[1], lat0)
+        counts = np.array(counts, dtype=np.float64)
+    k = len(centers)
+
+    for _ in range(steps):
+        batch = points[rng.integers(0, len(points), size=min(batch_size, len(points)))]
+        labels = _closest(batch, centers)
+        batch_counts = np.bincount(labels, minlength=k).astype(np.float64)
+        counts += batch_counts
+        moved = batch_counts > 0
+        for axis in range(2):
+            sums = np.bincount(labels, weights=batch[:, axis], minlength=k)
+            centers[moved, axis] += (sums[moved] - batch_counts[moved] * centers[moved, axis]) / counts[moved]
+
+    scale = math.cos(math.radians(lat0)) * KM_PER_DEGREE
+    return centers[:, 1] / KM_PER_DEGREE, centers[:, 0] / scale, counts
+
+# Cluster centers of the candidates of recently used tiles, in memory and in a small SQLite file.
+# An entry holds the centers and the candidates they were fitted on. When the candidates of a tile
+# change, new locations only move the cached centers a little (a few mini-batches over the new points)
+# and removed ones start a short fit from the cached centers instead of from scratch
+class CenterCache:
+    def __init__(self, path=None, max_tiles=CENTER_TILES, max_disk_tiles=CENTER_DISK_TILES):
+        self.path = path
+        self.max_tiles = max_tiles
+        self.max_disk_tiles = max_disk_tiles
+        self._tiles = OrderedDict()
+        self._lock = threading.Lock()
+        if path:
+            with self._connect() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS centers ("
+                    "key TEXT PRIMARY KEY, accessed REAL, fingerprint TEXT, k INTEGER, data BLOB)"
+                )
+                conn.execute("CREATE INDEX IF NOT EXISTS centers_accessed ON centers (accessed)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _read(self, name):
+        with self._connect() as conn:
+            row = conn.execute("SELECT fingerprint, k, data FROM centers WHERE key = ?", (name,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE centers SET accessed = ? WHERE key = ?", (time.time(), name))
+        fingerprint, k, data = row
+        values = np.frombuffer(data, dtype=np.float64)
+        points = values[3 * k:].reshape(2, -1)
+        return {"fingerprint": fingerprint, "lats": values[:k], "lons": values[k:2 * k],
+                "counts": values[2 * k:3 * k].copy(), "points": (points[0], points[1])}
+
+    def _write(self, name, entry):
+        data = np.concatenate([entry["lats"], entry["lons"], entry["counts"], *entry["points"]])
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO centers (key, accessed, fingerprint, k, data) VALUES (?, ?, ?, ?, ?)",
+                (name, time.time(), entry["fingerprint"], len(entry["lats"]), sqlite3.Binary(data.tobytes()))
+            )
+            extra = conn.execute("SELECT COUNT(*) FROM centers").fetchone()[0] - self.max_disk_tiles
+            if extra > 0:
+                conn.execute("DELETE FROM centers WHERE key IN (SELECT key FROM centers ORDER BY accessed LIMIT ?)",
+                             (extra,))
+
+    def _remember(self, name, entry):
+        with self._lock:
+            self._tiles[name] = entry
+            self._tiles.move_to_end(name)
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+
+    # Returns the latitudes and longitudes of k cluster centers of the points of a tile
+    def centers(self, key, lats, lons, k, rng=None):
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        name = repr((key, k))
+        fingerprint = hashlib.sha1(lats.tobytes() + lons.tobytes()).hexdigest()
+        with self._lock:
+            entry = self._tiles.get(name)
+            if entry is not None:
+                self._tiles.move_to_end(name)
+        if entry is None and self.path:
+            entry = self._read(name)
+            if entry is not None:
+                self._remember(name, entry)
+        if entry is not None and entry["fingerprint"] == fingerprint:
+            instrumentation.count("cluster_cache_hits")
+            return entry["lats"], entry["lons"]
+
+        if entry is None:
+            instrumentation.count("cluster_cache_misses")
+            center_lats, center_lons, counts = minibatch_kmeans(lats, lons, k, rng=rng)
+        else:
+            instrumentation.count("cluster_cache_updates")
+            start = ((entry["lats"], entry["lons"]), entry["counts"])
+            points = set(zip(lats.round(7).tolist(), lons.round(7).tolist()))
+            old_points = set(zip(entry["points"][0].round(7).tolist(), entry["points"][1].round(7).tolist()))
+            added = points - old_points
+            if added and not old_points - points:
+                new = np.array(sorted(added))
+                steps = max(1, math.ceil(len(new) / KMEANS_BATCH))
+                center_lats, center_lons, counts = minibatch_kmeans(new[:, 0], new[:, 1], k, *start, steps=steps, rng=rng)
+            else:
+                center_lats, center_lons, counts = minibatch_kmeans(
+                    lats, lons, k, *start, steps=KMEANS_WARM_STEPS, rng=rng
+                )
+        entry = {"fingerprint": fingerprint, "lats": center_lats, "lons": center_lons, "counts": counts,
+                 "points": (lats, lons)}
+        self._remember(name, entry)
+        if self.path:
+            self._write(name, entry)
+        return center_lats, center_lons
+
+_centers = None
+
+def get_center_cache():
+    global _centers
+    if _centers is None:
+        _centers = CenterCache(CENTER_CACHE_PATH if CENTER_CACHE_PATH != "0" else None)
+    return _centers
+
+# Clusters to fit on a tile fetched with fetch_rad km around its center, so that about k of them
+# fall inside a search of radius km
+def tile_clusters(k, radius, fetch_rad):
+    return max(k, math.ceil(k * (fetch_rad / radius) ** 2))
+
+# A coarse tier of candidates for dense areas: the location closest to the center of each cluster
+# of candidates stands for its cluster, so suggestions are spread over the area instead of following
+# where the locations are most crowded. The k clusters are fitted on area, every candidate of the
+# tile or grid cell the user is in, and cached under key so every user there shares them. The user
+# then gets one location for each cluster their own locations fall in.
+# Without area the clusters are fitted on the locations themselves
+@instrumentation.timed("candidates")
+def coarse_tier(locations, k, key=None, area=None, rng=None):
+    if area is None:
+        if len(locations) <= k:
+            return locations
+        area = locations
+    if not locations or not area:
+        return locations
+    area_lats = np.array([float(loc[1]) for loc in area])
+    area_lons = np.array([float(loc[2]) for loc in area])
+    if key is None:
+        center_lats, center_lons, _ = minibatch_kmeans(area_lats, area_lons, k, rng=rng)
+    else:
+        center_lats, center_lons = get_center_cache().centers(key, area_lats, area_lons, k, rng)
+
+    lats = np.array([float(loc[1]) for loc in locations])
+    lons = np.array([float(loc[2]) for loc in locations])
+    # a few hundred centers at most, comparing every pair is quicker than building an index
+    d = distance.many_to_many(lats, lons, center_lats, center_lons)
+    clusters = np.argmin(d, axis=1)
+    dists = d[np.arange(len(lats)), clusters]
+    order = np.lexsort((dists, clusters))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = clusters[order][1:] != clusters[order][:-1]
+    return [locations[i] for i in np.sort(order[first])]
+
+# Reads a file of "lat,lon" lines chunk_size lines at a time, a header line is skipped
+def read_chunks(path, chunk_size=CHUNK_SIZE):
+    with open(path, encoding="utf-8") as file:
+        first = file.readline()
+        lines = file if _is_header(first) else itertools.chain([first], file)
+        while True:
+            block = list(itertools.islice(lines, chunk_size))
+            if not block:
+                return
+            data = np.loadtxt(block, delimiter=",", usecols=(0, 1), ndmin=2)
+            yield data[:, 0], data[:, 1]
+
+def _is_header(line):
+    try:
+        float(line.split(",")[0])
+        return False
+    except ValueError:
+        return True
+
+# python clustering.py locations.csv clustered.csv [l] [epsilon]
+# writes the id, noisy latitude and noisy longitude of every user
+def main():
+    if len(sys.argv) < 3:
+        print("Usage: python clustering.py locations.csv clustered.csv [l] [epsilon]")
+        return
+    l = int(sys.argv[3]) if len(sys.argv) > 3 else CLUSTER_SIZE
+    epsilon = float(sys.argv[4]) if len(sys.argv) > 4 else geo_ind.EPSILON
+    written = 0
+    with open(sys.argv[2], "w", encoding="utf-8") as out:
+        out.write("id,lat,lon\n")
+        for ids, lats, lons in stream_clusters(read_chunks(sys.argv[1]), l, epsilon):
+            np.savetxt(out, np.column_stack([ids, lats, lons]), fmt=["%d", "%.7f", "%.7f"], delimiter=",")
+            written += len(ids)
+    print(f"Wrote {written} clustered locations to {sys.argv[2]}")
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,25 @@
-import subprocess
-import time
 import math
-import re
-from geopy.geocoders import Nominatim
-from geopy.distance import geodesic
+import poi
+import walkable
+import parallel
+import geocode
+import distance
 import statistics
-import matplotlib.pyplot as plt
+import plotting
+import instrumentation
 
 # Generate coordinates from an address
 def get_coordinates(address):
-    geolocator = Nominatim(user_agent="geoapi")
-    location = geolocator.geocode(address)
-    return (location.latitude, location.longitude) if location else (None, None)
-
-# Get coordinates from a file
-def extract_coords_from_file(filepath):
-    coords = []
-    with open(filepath, 'r', encoding='utf-8') as file:
-        # Use regex to match a line in the file to a coordinate
-        for line in file:
-            match = re.search(r"\(([-\d.]+), ([-\d.]+)\)", line)
-            if match:
-                lat = float(match.group(1))
-                lon = float(match.group(2))
-                coords.append((lat, lon))
-    return coords
+    coords = geocode.get_coordinates(address)
+    return coords if coords else (None, None)
 
 # Find the average distance between two coordinates
 def average_distance(from_coord, to_coords):
     if not to_coords:
         return float('inf')
-    total = sum(geodesic(from_coord, point).km for point in to_coords)
-    return total / len(to_coords)
+    lats = [point[0] for point in to_coords]
+    lons = [point[1] for point in to_coords]
+    return float(distance.one_to_many(from_coord[0], from_coord[1], lats, lons).mean())
 
 # Determine the centroid from a list of coordinates
 def centroid(coords):
@@ -41,9 +29,27 @@ def centroid(coords):
     lon = sum(point[1] for point in coords) / len(coords)
     return (lat, lon)
 
-
-# def run_program(command):
-#     subprocess.run(command, shell=True)
+# Utility and privacy of the suggested points for a location
+def location_metrics(coords, points):
+    utility = average_distance(coords, points)
+    center = centroid(points)
+    privacy = distance.haversine_scalar(*coords, *center) if center[0] is not None else float('inf')
+    return utility, privacy
+
+# Downloads the POIs and walkable areas for a location, this runs on a thread
+def fetch_location(task):
+    address, coords, radius, num_runs = task
+    return poi.FindPOIs(coords[0], coords[1], radius), walkable.FindWalkablePoints(coords[0], coords[1], radius, num_runs)
+
+# Runs both methods for a location, this runs in a worker process.
+# The stage timings of the worker are sent back with the results
+def simulate_location(task, fetched):
+    address, coords, radius, num_runs = task
+    pois, walkable_areas = fetched
+    instrumentation.reset()
+    poi_result = poi.RunPOI(coords, radius, 0.002, num_runs, pois=pois)
+    walkable_result = walkable.run_walkable(coords, radius, num_runs, walkable_areas)
+    return poi_result, walkable_result, instrumentation.report()
 
 def main():
     # Use the text file as input
@@ -56,58 +62,62 @@ def main():
 
     results = []
     num_runs = lines[1]
+
+    # Geocode every address up front, repeated addresses are only looked up once
+    all_coords = geocode.geocode_batch(lines[2::2])
+
+    tasks = []
     for i in range(2, len(lines), 2):
         # Parse the text file for the required input
         address = lines[i]
         radius = float(lines[i + 1])
-        coords = get_coordinates(address)
+        coords = all_coords[(i - 2) // 2] or (None, None)
 
         if not coords[0]:
             print(f"Skipping invalid address: {address}")
             continue
+        tasks.append((address, coords, radius, int(num_runs)))
 
-        print(f"\nProcessing location: {address} (radius {radius} km)")
-
-        # Run the poi.py method using the input from text file
-        print("Running POI-based method...")
-        proc = subprocess.Popen(
-            f'python poi.py',
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            shell=show_popups
-        )
-        proc.communicate(input=f"address\n{address}\n{radius}\n0.002\n{num_runs}\n")
-        time.sleep(2)
+    # Download the locations on a few threads and run both methods for each one in worker processes
+    print(f"Processing {len(tasks)} locations...")
+    outcomes = parallel.run_locations(tasks, fetch_location, simulate_location)
+
+    # the graphs of every location are drawn together at the end, each to its own file
+    graph_jobs = []
+    for number, ((address, coords, radius, _), outcome) in enumerate(zip(tasks, outcomes), 1):
+        if outcome is None:
+            print(f"Skipping failed location: {address}")
+            continue
+        poi_result, walkable_result, metrics = outcome
+        instrumentation.merge(metrics)
+        print(f"\nProcessed location: {address} (radius {radius} km)")
 
         # Determine the privacy and utility for a single location for POI method
-        poi_coords = extract_coords_from_file("POIs.txt")
-        utility_poi = average_distance(coords, poi_coords)
-        centroid_poi = centroid(poi_coords)
-        privacy_poi = geodesic(coords, centroid_poi).km if centroid_poi[0] is not None else float('inf')
+        poi_coords = poi_result["noisy_points"] if poi_result else []
+        if poi_result and show_popups:
+            poi.CreateMap(coords[0], coords[1], radius, poi_result["poi_counter"], poi_coords)
+            graph_jobs.append((plotting.save_panels, (
+                f"POI_Utility_Privacy_Graph_{number}.png", poi.GraphPanels(poi_result["utility"], poi_result["privacy"])
+            )))
+        utility_poi, privacy_poi = location_metrics(coords, poi_coords)
         results.append((address, "POI", utility_poi, privacy_poi)) 
 
-        # Run the walkable.py method using input from text file
-        print("Running Walkable method...")
-        proc = subprocess.Popen(
-            f'python walkable.py',
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            shell=show_popups
-        )
-        proc.communicate(input=f"address\n{address}\n{radius}\n{num_runs}\n")
-        time.sleep(2)
-
         # Determine the privacy and utility for a single location for walkable method
-        walkable_coords = extract_coords_from_file("Walkable.txt")
-        utility_osrm = average_distance(coords, walkable_coords)
-        centroid_osrm = centroid(walkable_coords)
-        privacy_osrm = geodesic(coords, centroid_osrm).km if centroid_osrm[0] is not None else float('inf')
+        walkable_areas = walkable_result["walkable_areas"] if walkable_result else []
+        if walkable_result and show_popups:
+            walkable.save_to_file(walkable_areas)
+            walkable.create_map(coords[0], coords[1], radius, walkable_areas)
+            graph_jobs.append((plotting.save_panels, (
+                f"Walkable_Utility_Privacy_Graph_{number}.png",
+                walkable.graph_panels(walkable_result["utility"], walkable_result["privacy"])
+            )))
+        walkable_coords = [(lat, lon) for _, lat, lon, *_ in walkable_areas]
+        utility_osrm, privacy_osrm = location_metrics(coords, walkable_coords)
         results.append((address, "Walkable", utility_osrm, privacy_osrm)) 
 
+    if graph_jobs:
+        plotting.render_batch(graph_jobs)
+
     # Print summary
     total_utility_poi = []
     total_privacy_poi = []
@@ -136,14 +146,15 @@ def main():
     print(f"Average Privacy for Walkable: {statistics.mean(total_privacy_osrm):.4f} km")
 
     # Create a summary plot of privacy/utility tradeoff for each location, for each method
-    plt.figure(figsize=(12, 7))
+    fig = plotting.new_figure((12, 7))
+    ax = fig.add_subplot(1, 1, 1)
     for address, method, utility, privacy in results:
         color = 'blue' if method == "POI" else 'green'
         marker = 'o' if method == "POI" else '^'
-        plt.scatter(privacy, utility, color=color, marker=marker, label=method if address == results[0][0] else "")
+        ax.scatter(privacy, utility, color=color, marker=marker, label=method if address == results[0][0] else "")
 
         # Annotate each point with the address
-        plt.annotate(
+        ax.annotate(
             address,
             (privacy, utility),
             textcoords="offset points",
@@ -152,15 +163,16 @@ def main():
             fontsize=8,
             alpha=0.7
         )
-    plt.xlabel("Privacy (Distance from centroid to true location) [km]")
-    plt.ylabel("Utility (Avg distance from true location) [km]")
-    plt.title("Privacy vs Utility Tradeoff")
-    plt.legend()
-    plt.grid(True)
-    plt.tight_layout()
-    plt.savefig("Privacy_Utility_Tradeoff.png")
-    plt.show()
+    ax.set_xlabel("Privacy (Distance from centroid to true location) [km]")
+    ax.set_ylabel("Utility (Avg distance from true location) [km]")
+    ax.set_title("Privacy vs Utility Tradeoff")
+    ax.legend()
+    ax.grid(True)
+    fig.tight_layout()
+    with instrumentation.stage("render_graph"):
+        fig.savefig("Privacy_Utility_Tradeoff.png")
 
 
 if __name__ == "__main__":
     main()
+    instrumentation.save()
@@ -0,0 +1,16 @@
+import os
+
+# When headless, maps are still saved to files but not opened in a browser. Graphs are always only saved.
+# Set DATAPRIVACY_HEADLESS=1, or headless=true in hybrid_day_in_life.txt, for servers and batch jobs
+HEADLESS = os.environ.get("DATAPRIVACY_HEADLESS", "0").strip().lower() not in ("", "0", "false", "no")
+
+def set_headless(headless=True):
+    global HEADLESS
+    HEADLESS = headless
+
+# Opens a saved map in the browser
+def open_map(path):
+    if HEADLESS:
+        return
+    import webbrowser
+    webbrowser.open('file://' + os.path.realpath(path))
@@ -0,0 +1,44 @@
+import math
+import numpy as np
+
+# Radius of the earth in km
+EARTH_RADIUS = 6371.0
+
+# Harversine formula for finding the distance between coordinates in km
+# https://www.geeksforgeeks.org/haversine-formula-to-find-distance-between-two-points-on-a-sphere/
+# The arguments can be numbers or NumPy arrays, arrays are broadcast against each other
+def haversine(lat1, lon1, lat2, lon2):
+    lat1 = np.radians(lat1)
+    lon1 = np.radians(lon1)
+    lat2 = np.radians(lat2)
+    lon2 = np.radians(lon2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+# Same formula with the math module, faster than NumPy for a single pair of points
+def haversine_scalar(lat1, lon1, lat2, lon2):
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + \
+        math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(1.0, a)))
+
+# Distances from one point to every point of an array, shape (n,)
+def one_to_many(lat, lon, lats, lons):
+    return haversine(lat, lon, np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64))
+
+# Distances between every point of the first array and every point of the second, shape (n, m)
+def many_to_many(lats1, lons1, lats2, lons2):
+    lats1 = np.asarray(lats1, dtype=np.float64)[:, None]
+    lons1 = np.asarray(lons1, dtype=np.float64)[:, None]
+    lats2 = np.asarray(lats2, dtype=np.float64)[None, :]
+    lons2 = np.asarray(lons2, dtype=np.float64)[None, :]
+    return haversine(lats1, lons1, lats2, lons2)
+
+# Distances between matching points of two arrays of the same length, shape (n,)
+def pairwise(lats1, lons1, lats2, lons2):
+    lats1 = np.asarray(lats1, dtype=np.float64)
+    lats2 = np.asarray(lats2, dtype=np.float64)
+    if lats1.shape != lats2.shape:
+        raise ValueError("pairwise distances need arrays of the same length")
+    return haversine(lats1, np.asarray(lons1, dtype=np.float64), lats2, np.asarray(lons2, dtype=np.float64))
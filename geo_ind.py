@@ -0,0 +1,75 @@
+import math
+import os
+import numpy as np
+from spatial_index import SpatialIndex
+
+# Geo-indistinguishability with the planar Laplace mechanism: a reported point is the true point
+# moved in a uniformly random direction by a random distance, and two true points d metres apart
+# give reports whose likelihoods differ by at most a factor of exp(epsilon * d).
+# epsilon is per metre, the usual setting is a privacy level of ln(4) within 200 m.
+# Noise for any number of users is drawn at once with NumPy, no SciPy is needed for the Lambert W function
+DEFAULT_LEVEL = math.log(4)
+DEFAULT_RADIUS_M = 200.0
+EPSILON = float(os.environ.get("GEO_IND_EPSILON", DEFAULT_LEVEL / DEFAULT_RADIUS_M))
+
+METERS_PER_DEGREE = 111195.0
+HALLEY_STEPS = 12   # most steps taken, it normally stops after three or four
+
+# epsilon per metre that gives a privacy level of `level` within radius_m metres
+def epsilon_for(level=DEFAULT_LEVEL, radius_m=DEFAULT_RADIUS_M):
+    return level / radius_m
+
+# The lower branch W-1 of the Lambert W function for x in [-1/e, 0), as an array.
+# Starts from a series near the branch point or the asymptotic expansion near 0 and
+# takes Halley steps until it stops changing, a few steps are enough for double precision
+def lambert_w_minus1(x):
+    x = np.asarray(x, dtype=np.float64)
+    x = np.clip(x, -1 / math.e, -np.finfo(np.float64).tiny)
+    near_branch = x < -0.25
+    p = -np.sqrt(np.maximum(2 * (math.e * x + 1), 0.0))
+    l1 = np.log(-x)
+    l2 = np.log(-l1)
+    w = np.where(near_branch, -1 + p - p * p / 3 + 11 / 72 * p ** 3, l1 - l2 + l2 / l1)
+    for _ in range(HALLEY_STEPS):
+        ew = np.exp(w)
+        f = w * ew - x
+        wp1 = w + 1
+        # at w = -1 the step is 0 / 0, that is the branch point and already the answer
+        safe = np.where(wp1 == 0, 1.0, wp1)
+        step = np.where(wp1 == 0, 0.0, f / (ew * safe - (w + 2) * f / (2 * safe)))
+        w = w - step
+        if not np.any(np.abs(step) > 1e-12 * np.abs(w)):
+            break
+    return np.minimum(w, -1.0)
+
+# Distance in metres that the noise stays within with probability q. The radius of the
+# planar Laplace has the CDF 1 - (1 + epsilon r) exp(-epsilon r), and its inverse uses W-1
+def radius_quantile(epsilon, q):
+    q = np.asarray(q, dtype=np.float64)
+    return -(lambert_w_minus1((q - 1) / math.e) + 1) / epsilon
+
+# count noise offsets in metres, east and north
+def noise(count, epsilon=EPSILON, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
+    angle = rng.random(count) * 2 * math.pi
+    radius = radius_quantile(epsilon, rng.random(count))
+    return radius * np.cos(angle), radius * np.sin(angle)
+
+# Noisy reports of many points at once, returns their latitudes and longitudes
+def obfuscate(lats, lons, epsilon=EPSILON, rng=None):
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    east, north = noise(len(lats), epsilon, rng)
+    noisy_lats = lats + north / METERS_PER_DEGREE
+    noisy_lons = lons + east / (METERS_PER_DEGREE * np.maximum(np.cos(np.radians(lats)), 1e-6))
+    return noisy_lats, noisy_lons
+
+# Noisy reports of many points, each moved to the closest candidate location.
+# candidates can be hybrid.py style locations or a SpatialIndex built over them.
+# Returns the index of the candidate picked for each point and how far the noisy point was from it in km.
+# Snapping only looks at the noisy point, so it keeps the same privacy guarantee
+def obfuscate_to(lats, lons, candidates, epsilon=EPSILON, rng=None):
+    index = candidates if isinstance(candidates, SpatialIndex) else SpatialIndex.from_locations(candidates)
+    noisy_lats, noisy_lons = obfuscate(lats, lons, epsilon, rng)
+    return index.nearest_many(noisy_lats, noisy_lons)
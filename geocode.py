@@ -0,0 +1,94 @@
+import os
+import re
+import sqlite3
+import time
+import http_client
+import instrumentation
+
+# Settings for the on-disk cache of geocoded addresses
+GEOCODE_CACHE_PATH = os.environ.get("GEOCODE_CACHE_PATH", "geocode_cache.sqlite")
+NOT_FOUND_TTL = 24 * 60 * 60   # seconds before an address that was not found is tried again
+
+# Requests to Nominatim go through http_client, which keeps them a second apart
+NOMINATIM_URL = "https://nominatim.openstreetmap.org/search"
+
+# Lowercases and tidies an address so small differences in typing share a cache entry
+def normalize_address(address):
+    address = address.strip().lower()
+    address = re.sub(r"\s*,\s*", ", ", address)
+    address = re.sub(r"\s+", " ", address)
+    return address.strip(" ,.")
+
+# Geocoded addresses stored in SQLite, addresses that were not found are kept for a day
+class GeocodeCache:
+    def __init__(self, path=GEOCODE_CACHE_PATH):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS addresses (address TEXT PRIMARY KEY, lat REAL, lon REAL, created REAL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    # Returns (True, coords) for a cached address, coords is None when it was not found
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT lat, lon, created FROM addresses WHERE address = ?", (key,)).fetchone()
+        if row is None:
+            return False, None
+        lat, lon, created = row
+        if lat is None:
+            if time.time() - created > NOT_FOUND_TTL:
+                return False, None
+            return True, None
+        return True, (lat, lon)
+
+    def put(self, key, coords):
+        lat, lon = coords if coords else (None, None)
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO addresses VALUES (?, ?, ?, ?)", (key, lat, lon, time.time()))
+
+_cache = None
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = GeocodeCache(GEOCODE_CACHE_PATH)
+    return _cache
+
+# Asks Nominatim for an address
+def lookup(address, priority=http_client.NORMAL):
+    response = http_client.get(
+        NOMINATIM_URL, params={'q': address, 'format': 'jsonv2', 'limit': 1}, priority=priority
+    )
+    instrumentation.count("geocode_requests")
+    instrumentation.count("geocode_bytes", len(response.content))
+    results = response.json()
+    if results:
+        return (float(results[0]['lat']), float(results[0]['lon']))
+    return None
+
+# converts a text address into latitude and longitude, or None when it is not found
+@instrumentation.timed("geocode")
+def get_coordinates(address):
+    key = normalize_address(address)
+    cache = get_cache()
+    found, coords = cache.get(key)
+    if found:
+        instrumentation.count("geocode_cache_hits")
+        return coords
+    instrumentation.count("geocode_cache_misses")
+    coords = lookup(address)
+    cache.put(key, coords)
+    return coords
+
+# Geocodes a list of addresses, each distinct address is only looked up once.
+# Returns the coordinates (or None) in the same order as the addresses
+def geocode_batch(addresses):
+    results = {}
+    for address in addresses:
+        key = normalize_address(address)
+        if key not in results:
+            results[key] = get_coordinates(address)
+    return [results[normalize_address(address)] for address in addresses]
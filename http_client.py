@@ -0,0 +1,189 @@
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+# Request priorities, lower numbers are sent first when a host is busy
+HIGH = 0
+NORMAL = 5
+LOW = 10
+
+# (connect, read) timeouts in seconds used when a caller does not give one
+DEFAULT_TIMEOUT = (10, 90)
+MAX_RETRIES = 3
+BACKOFF_BASE = 1.0     # seconds, doubled after every failed attempt
+BACKOFF_MAX = 60.0
+POOL_SIZE = 16         # kept-alive connections per host
+
+# Status codes that mean the server is busy and the request can be tried again
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# Smallest gap in seconds between two requests to a host.
+# Nominatim's usage policy allows at most one request per second
+HOST_INTERVALS = {
+    "nominatim.openstreetmap.org": 1.0,
+}
+
+USER_AGENT = "geoapi"
+
+# Hands out turns to send requests so every host gets its minimum gap, waiting
+# requests go in priority order, and a host can be paused after a 429 / Retry-After
+class HostScheduler:
+    def __init__(self, intervals=None):
+        self.intervals = HOST_INTERVALS if intervals is None else intervals
+        self._cond = threading.Condition()
+        self._waiting = {}
+        self._next_time = {}
+        self._deferred = {}
+        self._order = itertools.count()
+
+    # Blocks until it is this request's turn to go to the host
+    def acquire(self, host, priority=NORMAL):
+        ticket = (priority, next(self._order))
+        with self._cond:
+            heap = self._waiting.setdefault(host, [])
+            heapq.heappush(heap, ticket)
+            while True:
+                wait = self._next_time.get(host, 0) - time.monotonic()
+                if heap[0] == ticket:
+                    if wait <= 0:
+                        heapq.heappop(heap)
+                        self._next_time[host] = time.monotonic() + self.intervals.get(host, 0)
+                        self._cond.notify_all()
+                        return
+                    self._cond.wait(wait)
+                else:
+                    self._cond.wait()
+
+    # Stops sending requests to a host for a number of seconds
+    def defer(self, host, seconds):
+        with self._cond:
+            until = time.monotonic() + seconds
+            self._deferred[host] = max(self._deferred.get(host, 0), until)
+            self._next_time[host] = max(self._next_time.get(host, 0), until)
+            self._cond.notify_all()
+
+    # Seconds left before a host that asked to be left alone can be used again, 0 when it is not deferred
+    def deferred_for(self, host):
+        with self._cond:
+            return max(0.0, self._deferred.get(host, 0) - time.monotonic())
+
+_scheduler = HostScheduler()
+_sessions = {}
+_sessions_lock = threading.Lock()
+# index of the last endpoint that worked for each list of mirrors
+_preferred = {}
+
+# One keep-alive session per process, worker processes must not share the parent's sockets
+# requests is only loaded once something is downloaded, runs from the offline store never need it
+def get_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    pid = os.getpid()
+    with _sessions_lock:
+        session = _sessions.get(pid)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=0)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["User-Agent"] = USER_AGENT
+            _sessions[pid] = session
+    return session
+
+# Seconds asked for by a Retry-After header, which can be a number or an HTTP date
+def retry_after(response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff(attempt):
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+# A host answered 429 or 503 with a Retry-After header and was deferred instead of waited for
+class HostDeferred(Exception):
+    def __init__(self, host, seconds, error):
+        super().__init__(f"{host} asked to wait {seconds:.0f} s: {error}")
+        self.host = host
+        self.seconds = seconds
+        self.error = error
+
+# Sends a GET request, retrying with exponential backoff on connection errors,
+# timeouts and busy responses. Raises the last error when every attempt fails.
+# With wait_deferred=False a Retry-After answer raises HostDeferred at once, so a caller
+# with other mirrors can use them instead of waiting
+def get(url, params=None, headers=None, timeout=DEFAULT_TIMEOUT, priority=NORMAL, retries=MAX_RETRIES,
+        wait_deferred=True):
+    import requests
+    host = urlparse(url).netloc
+    error = None
+    for attempt in range(retries + 1):
+        _scheduler.acquire(host, priority)
+        wait = None
+        try:
+            response = get_session().get(url, params=params, headers=headers, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            error = e
+        else:
+            if response.status_code not in RETRY_STATUSES:
+                response.raise_for_status()
+                return response
+            error = requests.HTTPError(f"{response.status_code} from {host}", response=response)
+            wait = retry_after(response)
+            if wait is not None:
+                _scheduler.defer(host, wait)
+                if not wait_deferred:
+                    raise HostDeferred(host, wait, error)
+        # the scheduler already holds the host back when the server said how long to wait
+        if attempt < retries and wait is None:
+            time.sleep(backoff(attempt))
+    raise error
+
+# Tries a list of mirror endpoints, starting with the last one that worked. A mirror that asks to
+# wait with Retry-After is deferred and the next one is tried straight away, and mirrors that are
+# still deferred are skipped. Only when every mirror is deferred is the one free soonest waited for
+def get_with_failover(urls, **kwargs):
+    import requests
+    key = tuple(urls)
+    start = _preferred.get(key, 0)
+    error = None
+    deferred = []
+    for i in range(len(urls)):
+        index = (start + i) % len(urls)
+        host = urlparse(urls[index]).netloc
+        if _scheduler.deferred_for(host) > 0:
+            deferred.append(index)
+            continue
+        try:
+            response = get(urls[index], wait_deferred=False, **kwargs)
+        except HostDeferred as e:
+            print(f"Request to {urls[index]} deferred: {e}")
+            error = e.error
+            deferred.append(index)
+            continue
+        except requests.RequestException as e:
+            print(f"Request to {urls[index]} failed: {e}")
+            error = e
+            continue
+        _preferred[key] = index
+        return response
+
+    if deferred:
+        index = min(deferred, key=lambda i: _scheduler.deferred_for(urlparse(urls[i]).netloc))
+        response = get(urls[index], **kwargs)
+        _preferred[key] = index
+        return response
+    raise error
@@ -1,18 +1,23 @@
-import folium
-from geopy.geocoders import Nominatim
-from folium import Circle # helps create the interactive map
-import webbrowser 
 import os
-import requests # making http request to OpenStreetMaps
+import overpass # cached queries to OpenStreetMaps
+import candidate_grid
+import montecarlo
+import distance
+import geocode
+import display # maps and graphs, loaded only when they are made
+import maps
+import plotting
+import results
+import instrumentation
+import walk_graph
 import re
-import random
-from collections import defaultdict
 import warnings
-import math
-import matplotlib.pyplot as plt
-import pandas as pd
+# finding and picking locations lives in obfuscation.py so it can be used without the map and plot libraries
+from obfuscation import (
+    POI_THRESHOLD, FindPOIs, FindWalkableAreas, ChooseLocations, LocationKey, SimulateRuns, PickCounts, RunLocations,
+    SimulateLaplace, CoarseLocations
+)
 
-OVERPASS_URL = "http://overpass-api.de/api/interpreter"
 os.environ["OMP_NUM_THREADS"] = "1"
 warnings.filterwarnings(
     "ignore",
@@ -22,96 +27,13 @@ warnings.filterwarnings(
 
 # converts a text address into latitude and longitude 
 def GetCoordinates(address):
-    # Nominatim is a geocoding service
-    geolocator = Nominatim(user_agent="geoapi")
-    location = geolocator.geocode(address)
-    if location:
-        return (location.latitude, location.longitude)
-    else:
-        return None
-
-# Queiries OpenStreetMaps Overpass API to find POIs
-def FindPOIs(lat, lon, rad):
-    # finds amentities, tourism, leisure, and shop tags 
-    query = f"""
-    [out:json];
-    (
-      node["amenity"](around:{rad * 1000},{lat},{lon});
-      node["tourism"](around:{rad * 1000},{lat},{lon});
-      node["leisure"](around:{rad * 1000},{lat},{lon});
-      node["shop"](around:{rad * 1000},{lat},{lon});
-
-      way["amenity"](around:{rad * 1000},{lat},{lon});
-      way["tourism"](around:{rad * 1000},{lat},{lon});
-      way["leisure"](around:{rad * 1000},{lat},{lon});
-      way["shop"](around:{rad * 1000},{lat},{lon});
-
-      relation["amenity"](around:{rad * 1000},{lat},{lon});
-      relation["tourism"](around:{rad * 1000},{lat},{lon});
-      relation["leisure"](around:{rad * 1000},{lat},{lon});
-      relation["shop"](around:{rad * 1000},{lat},{lon});
-    );
-    out center tags;
-    """
-    # puts the pois found into a lists
-    response = requests.get(OVERPASS_URL, params={'data': query})
-    data = response.json()
-    pois = []
-    for el in data['elements']:
-        name = el.get('tags', {}).get('name', 'Unnamed POI')
-        lat = el.get('lat')
-        lon = el.get('lon')
-
-        if lat is None or lon is None:
-            center = el.get('center')
-            if center:
-                lat = center.get('lat')
-                lon = center.get('lon')
-
-        if lat is not None and lon is not None and name != 'Unnamed POI':
-            pois.append((name, lat, lon, "poi"))
-
-    # returns the lists of pois
-    return pois
-
-# querires OpenStreetMaps for walkable areas along a road or trail
-def FindWalkableAreas(lat, lon, rad):
-    query = f"""
-    [out:json];
-    (
-      way["highway"](around:{rad * 1000},{lat},{lon})
-        ["highway"!~"motorway|motorway_link"];
-    );
-    out center tags;
-    """
-    response = requests.get(OVERPASS_URL, params={'data': query})
-    data = response.json()
-    # puts the walkable locations into a list with longitude and latitude
-    walkable_areas = []
-    for el in data['elements']:
-        center = el.get('center')
-        if center:
-            lat_center = center.get('lat')
-            lon_center = center.get('lon')
-            if lat_center and lon_center:
-                highway_type = el['tags'].get('highway', 'unknown')
-                name = el['tags'].get('name', f"Walkable Area ({highway_type})")
-                walkable_areas.append((name, lat_center, lon_center, "walkable"))
-    # returns all the walkable locations
-    return walkable_areas
+    # Nominatim is a geocoding service, answers are cached on disk
+    return geocode.get_coordinates(address)
 
 # calculates the distance between to points using longitude and latitude
 def calculate_distance(lat1, lon1, lat2, lon2):
     # uses the Haversine formula
-    R = 6371  # radius of earth
-    dLat = math.radians(lat2 - lat1)
-    dLon = math.radians(lon2 - lon1)
-    a = math.sin(dLat/2) * math.sin(dLat/2) + \
-        math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * \
-        math.sin(dLon/2) * math.sin(dLon/2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    distance = R * c
-    return distance
+    return distance.haversine_scalar(lat1, lon1, lat2, lon2)
 
 # calculates a center location of a set of locations
 def calculate_centroid(locations):
@@ -138,20 +60,18 @@ def calculate_privacy_distance(user_lat, user_lon, chosen_locations):
 def calculate_utility_distance(user_lat, user_lon, chosen_locations):
     if not chosen_locations:
         return 0
-    # calculates the first distance
-    if len(chosen_locations) == 1:
-        loc = chosen_locations[0]
-        return calculate_distance(user_lat, user_lon, float(loc[1]), float(loc[2]))
-    # calculate the centriod longitude and latitude
-    centroid_lat, centroid_lon = calculate_centroid(chosen_locations)
-    # calculate distance between user and centriod
-    distances = [calculate_distance(centroid_lat, centroid_lon, float(loc[1]), float(loc[2])) 
+    # calculate the distance from the user to each chosen location
+    distances = [calculate_distance(user_lat, user_lon, float(loc[1]), float(loc[2]))
                  for loc in chosen_locations]
-    utility_distance = sum(distances) / len(distances) if distances else 0
+    utility_distance = sum(distances) / len(distances)
     return utility_distance
 
 # this creates an interactive map showing users location and chosen locations, and radius
-def CreateMap(lat, lon, rad, locations, location_counter):
+# map_mode is one of maps.MAP_MODES, large numbers of chosen locations are drawn as a cluster or heatmap
+@instrumentation.timed("render_map")
+def CreateMap(lat, lon, rad, locations, location_counter, map_mode=None):
+    import folium
+    from folium import Circle # helps create the interactive map
     Map = folium.Map(location=[lat, lon], zoom_start=13)
     # sets the users location
     folium.Marker([lat, lon], popup="User Location", icon=folium.Icon(color='red')).add_to(Map)
@@ -163,16 +83,20 @@ def CreateMap(lat, lon, rad, locations, location_counter):
         fill=True,
         fill_opacity=0.3
     ).add_to(Map)
-    chosen_locations = []
-    # creates the map markers for chosen locations
-    for location in locations:
-        name, lat_loc, lon_loc, loc_type = location
-        location_key = f"{name} ({lat_loc}, {lon_loc})"
-        count = location_counter.get(location_key, 0)
-        
-        if count > 0:
+    # only the chosen locations are looked at, the counter knows which location each key is
+    known = getattr(location_counter, 'locations', None)
+    if known is None:
+        known = {LocationKey(location): location for location in locations}
+    chosen = [(known[key], count) for key, count in location_counter.items() if count > 0]
+    chosen_locations = [location for location, _ in chosen]
+    counts = [count for _, count in chosen]
+
+    mode = maps.choose_mode(len(chosen_locations), map_mode)
+    if mode == "markers":
+        # creates the map markers for chosen locations
+        for location, count in zip(chosen_locations, counts):
+            name, lat_loc, lon_loc, loc_type = location
             # sets the chosen locations colors 
-            chosen_locations.append(location)
             marker_color = 'green' if loc_type == 'poi' else 'orange'
             # adds the chosen locations to the map
             folium.Marker(
@@ -180,33 +104,89 @@ def CreateMap(lat, lon, rad, locations, location_counter):
                 popup=f"{name}<br>Visits: {count}",
                 icon=folium.Icon(color=marker_color, icon='info-sign' if loc_type == 'poi' else 'road')
             ).add_to(Map)
+    else:
+        maps.add_layer(
+            Map, mode,
+            [float(loc[1]) for loc in chosen_locations], [float(loc[2]) for loc in chosen_locations],
+            weights=counts, labels=[f"{loc[0]}<br>Visits: {count}" for loc, count in zip(chosen_locations, counts)]
+        )
     # saves the map as an html file that is opened in a browser
     Map.save("hybrid_map.html")
-    webbrowser.open('file://' + os.path.realpath("hybrid_map.html"))
+    display.open_map("hybrid_map.html")
     
     return chosen_locations
 
-# this creates a graph from the cvs data showing the privacy vs. utility over multiple runs
-def make_graph(csv_file):
+# this creates a graph showing the privacy vs. utility over multiple runs
+def make_graph(utility_values, privacy_values, path='hybrid_graph.png'):
     try:
-        # 
-        df = pd.read_csv(csv_file)
-        # creates the graph with the privacy and utility
-        plt.figure(figsize=(10, 6))
-        plt.plot(df['Run'], df['Privacy(km)'], marker='o', linestyle='-', color='blue', label='Privacy')
-        plt.plot(df['Run'], df['Utility(km)'], marker='s', linestyle='-', color='green', label='Utility')
-        plt.title('Privacy and Utility Metrics Over Multiple Runs', fontsize=14)
-        plt.xlabel('Number of Locations Chosen', fontsize=12)
-        plt.ylabel('Distance (km)', fontsize=12)
-        plt.grid(True, linestyle='--', alpha=0.7)
-        plt.legend()
-        # saves the graph a png file
-        plt.savefig('hybrid_graph.png', dpi=300)
-        plt.close()
+        # creates the graph with the privacy and utility and saves it as a png file
+        plotting.save_curves(
+            path,
+            [(privacy_values, dict(marker='o', linestyle='-', color='blue', label='Privacy')),
+             (utility_values, dict(marker='s', linestyle='-', color='green', label='Utility'))],
+            'Privacy and Utility Metrics Over Multiple Runs', 'Number of Locations Chosen', 'Distance (km)',
+            dpi=300
+        )
     # if the graph was not created then it returns an error
     except Exception as e:
         print(f"Error creating graphs: {e}")
 
+# runs every address in the config file and saves the final metrics of each one
+def MultiMain(config):
+    addresses = config['addresses']
+    radius = config.get('radius', 1.0)
+    num_runs = config.get('num_runs', 10)
+    all_coords = geocode.geocode_batch(addresses)
+    found = [(address, coords) for address, coords in zip(addresses, all_coords) if coords]
+    for address, coords in zip(addresses, all_coords):
+        if not coords:
+            print(f"Skipping invalid address: {address}")
+
+    # there is no map for many locations, the other settings are used for every location
+    if 'map_mode' in config:
+        print("map_mode is left out when several addresses are run, no map is made.")
+    options = {
+        'cluster_k': config.get('cluster_k'),
+        'walk_distance': config.get('walk_distance', radius) if config.get('walk_network') else None,
+        'geo_ind_epsilon': config.get('geo_ind_epsilon'),
+        'keep_runs': 'results_file' in config,
+    }
+    if config.get('monte_carlo_trials') and config.get('geo_ind_epsilon'):
+        print("The Monte Carlo estimate is for uniform picks, it is skipped with planar Laplace noise.")
+
+    print(f"Processing {len(found)} locations with radius {radius} km and {num_runs} runs each")
+    location_results = RunLocations([coords for _, coords in found], radius, num_runs, config.get('candidate_grid'),
+                                    config.get('monte_carlo_trials', 0), config.get('monte_carlo_seed'), options)
+    # the simulations ran in worker processes, their timings come back with the results
+    for result in location_results:
+        if result is not None:
+            instrumentation.merge(result.pop('metrics', None))
+
+    with instrumentation.stage("write_results"), open("hybrid_locations.txt", "w", encoding="utf-8") as file:
+        for (address, coords), result in zip(found, location_results):
+            if result is None:
+                print(f"No locations found for {address}")
+                continue
+            print(f"{address}: Utility {result['utility']:.4f} km, Privacy {result['privacy']:.4f} km")
+            file.write(f"{address} {coords}\n")
+            file.write(f"Utility: {result['utility']:.4f} km\n")
+            file.write(f"Privacy: {result['privacy']:.4f} km\n")
+            if result['monte_carlo']:
+                for line in montecarlo.report_lines(result['monte_carlo']):
+                    print(f"  {line}")
+                    file.write(line + "\n")
+            for loc_key, count in result['location_counter'].items():
+                file.write(f"{loc_key} -> suggested {count} times\n")
+            file.write("\n")
+
+    # every run of every location in one file, the user column numbers the addresses that were found
+    if 'results_file' in config:
+        writer = results.ResultsWriter(config['results_file'])
+        for user, result in enumerate(location_results):
+            if result is not None:
+                writer.add(*result['runs'], user=user)
+        writer.write()
+
 # this reads a text file for location data needed
 def parse_config_file(filename):
     try:
@@ -226,11 +206,16 @@ def parse_config_file(filename):
             # gets the longitude and latitude
             if key == 'location_type':
                 config[key] = value.lower()
-            elif key in ['latitude', 'longitude', 'radius', 'noise']:
+            elif key in ['latitude', 'longitude', 'radius', 'noise', 'walk_distance', 'geo_ind_epsilon']:
                 config[key] = float(value)
-            elif key == 'address':
+            elif key in ['address', 'offline_db', 'candidate_grid', 'map_mode', 'results_file', 'metrics_file']:
                 config[key] = value
-            elif key == 'num_runs':
+                # every address line is kept so several locations can be run together
+                if key == 'address':
+                    config.setdefault('addresses', []).append(value)
+            elif key in ['headless', 'quiet', 'walk_network']:
+                config[key] = value.lower() in ['1', 'true', 'yes']
+            elif key in ['num_runs', 'monte_carlo_trials', 'monte_carlo_seed', 'cluster_k']:
                 config[key] = int(value)
                 
         return config
@@ -246,8 +231,25 @@ def Main():
         print("Failed to read file.")
         return
         
+    # saves the map and graph without opening a browser or plot window
+    if config.get('headless'):
+        display.set_headless()
+    # leaves out the lines printed for every run
+    if config.get('quiet'):
+        results.set_quiet()
+    # saves the stage timings and counters when the run ends
+    if 'metrics_file' in config:
+        instrumentation.set_metrics_file(config['metrics_file'])
+
+    # use a local OpenStreetMap extract instead of the Overpass API
+    if 'offline_db' in config:
+        overpass.OFFLINE_DB = config['offline_db']
+
     # gets the location data 
-    if 'location_type' in config and config['location_type'] == 'address':
+    if config.get('location_type') == 'address' and len(config.get('addresses', [])) > 1:
+        MultiMain(config)
+        return
+    elif 'location_type' in config and config['location_type'] == 'address':
         if 'address' not in config:
             print("Address not specified in config file.")
             return
@@ -271,93 +273,129 @@ def Main():
     print(f"Radius: {radius} km")
     print(f"Number of runs: {num_runs}")
     
-    # finds all the pois and walkable locations in the radius
-    pois = FindPOIs(coords[0], coords[1], radius)
-    walkable_areas = FindWalkableAreas(coords[0], coords[1], radius)
-    
-    print(f"Found {len(pois)} POIs and {len(walkable_areas)} walkable areas.")
-    
     locations_to_use = []
-    location_keys = []
-    
-    # when there are not atleast 20 pois then it picks pois
-    if len(pois) >= 20:
-        print("Using only POIs since there at at least 20 in area!")
-        locations_to_use = pois
+
+    # loads precomputed locations so the queries can be skipped
+    grid = None
+    if 'candidate_grid' in config:
+        grid = candidate_grid.CandidateGrid(config['candidate_grid'])
+
+    if grid is not None and grid.covers(coords[0], coords[1], radius):
+        locations_to_use = grid.candidates(coords[0], coords[1])
+        print(f"Using {len(locations_to_use)} precomputed locations from {config['candidate_grid']}.")
     else:
-        # if there arent 20 pois it picks between pois and walkable locations
-        print(f"Only {len(pois)} POIs found. Adding walkable areas.")
-        locations_to_use = pois + walkable_areas
-        
-        # when there are not enough walkable locations or pois in the radius
-        if len(locations_to_use) < 5:
-            print(f"Not enough locations to use")
+        # finds all the pois and walkable locations in the radius
+        pois = FindPOIs(coords[0], coords[1], radius)
+        walkable_areas = FindWalkableAreas(coords[0], coords[1], radius)
+
+        print(f"Found {len(pois)} POIs and {len(walkable_areas)} walkable areas.")
+
+        locations_to_use = ChooseLocations(pois, walkable_areas)
+        # when there are not atleast 20 pois then it picks pois
+        if len(pois) >= POI_THRESHOLD:
+            print("Using only POIs since there at at least 20 in area!")
+        else:
+            # if there arent 20 pois it picks between pois and walkable locations
+            print(f"Only {len(pois)} POIs found. Adding walkable areas.")
+
+            # when there are not enough walkable locations or pois in the radius
+            if len(locations_to_use) < 5:
+                print(f"Not enough locations to use")
     # cant be used if no locations other than the users to pick from
     if not locations_to_use:
         print("No locations found within the specified radius.")
         return
+
+    # in dense areas one location of each cluster is used, the cluster centers are kept per tile
+    # and only updated when the locations found there change
+    cluster_k = config.get('cluster_k')
+    if cluster_k and len(locations_to_use) > cluster_k:
+        found = len(locations_to_use)
+        locations_to_use = CoarseLocations(coords, radius, locations_to_use, cluster_k, grid)
+        print(f"Using {len(locations_to_use)} cluster representatives of {found} locations.")
+
+    # keeps the locations the user can walk to and uses the walking distance for the utility
+    user_dist = None
+    if config.get('walk_network'):
+        walk_km = config.get('walk_distance', radius)
+        try:
+            walkable_locations, user_dist = walk_graph.within_walk(coords, locations_to_use, walk_km)
+        except Exception as e:
+            print(f"Could not load the walking network, using straight line distances: {e}")
+        else:
+            if user_dist is None:
+                print("Location is not near a path, using straight line distances.")
+            elif not walkable_locations:
+                print(f"No locations found within a {walk_km} km walk.")
+                return
+            else:
+                print(f"{len(walkable_locations)} of {len(locations_to_use)} locations are within a {walk_km} km walk.")
+                locations_to_use = walkable_locations
     
-    # Create location keys for the counter and a dictionary to map keys back to locations
-    location_dict = {}
-    for loc in locations_to_use:
-        key = f"{loc[0]} ({loc[1]}, {loc[2]})"
-        location_keys.append(key)
-        location_dict[key] = loc
-    
-    # creates a file to store the data of each location found and privacy and utility
-    with open("hybrid_data.csv", "w", encoding="utf-8") as metrics_file:
-        metrics_file.write("Run,Location,Utility(km),Privacy(km)\n")
-        
-        # creates empty list of locations picked
-        chosen_locations = []
-        location_counter = defaultdict(int)
-        
-        # runs for the number of times they want a location
-        for run in range(1, num_runs + 1):
-            # picks random location
-            chosen_key = random.choice(location_keys)
-            chosen_location = location_dict[chosen_key]
-            location_counter[chosen_key] += 1
-            
-            # adds chosen location to lists
-            chosen_locations.append(chosen_location)
-            
-            #  calculates utility and privacy
-            utility = calculate_utility_distance(
-                coords[0], coords[1], chosen_locations
-            )
-            privacy = calculate_privacy_distance(
-                coords[0], coords[1], chosen_locations
-            )
-            # writes the utility and privacy to file after each new location
-            metrics_file.write(
-                f'{run},"{chosen_key}",{utility:.4f},{privacy:.4f}\n'
-            )
-            
-            print(f"Run {run}: Selected {chosen_location[0]}")
-            print(f"  - Utility: {utility:.4f} km")
-            print(f"  - Privacy: {privacy:.4f} km")
+    # picks the locations for every run, uniformly or with the planar Laplace mechanism
+    if config.get('geo_ind_epsilon'):
+        print(f"Using planar Laplace noise with epsilon {config['geo_ind_epsilon']} per metre.")
+        run_result = SimulateLaplace(coords, locations_to_use, num_runs, config['geo_ind_epsilon'], user_dist=user_dist)
+    else:
+        run_result = SimulateRuns(coords, locations_to_use, num_runs, user_dist=user_dist)
+    choices = run_result["choices"]
+    utility_values = run_result["utility"]
+    privacy_values = run_result["privacy"]
+    location_counter = PickCounts(locations_to_use, choices)
+
+    # creates a file to store the location picked in each run and the privacy and utility,
+    # .csv by default or .npz / .parquet columns
+    writer = results.ResultsWriter(config.get('results_file', 'hybrid_data.csv'))
+    writer.add(locations_to_use, choices, utility_values, privacy_values)
+    writer.write()
+
+    results.print_runs(
+        f"Run {run}: Selected {locations_to_use[choice][0]}\n"
+        f"  - Utility: {utility:.4f} km\n"
+        f"  - Privacy: {privacy:.4f} km"
+        for run, choice, utility, privacy in zip(
+            range(1, num_runs + 1), choices.tolist(), utility_values.tolist(), privacy_values.tolist()
+        )
+    )
     
     # creates a map of the each suggested location 
-    CreateMap(coords[0], coords[1], radius, locations_to_use, location_counter)
+    CreateMap(coords[0], coords[1], radius, locations_to_use, location_counter, config.get('map_mode'))
 
     # creates a graph of the privacy vs utility
-    make_graph("hybrid_data.csv")
+    make_graph(utility_values, privacy_values)
     
-    # calculates the utility and privacy scores based on chosen locations
-    final_utility = calculate_utility_distance(coords[0], coords[1], chosen_locations)
-    final_privacy = calculate_privacy_distance(coords[0], coords[1], chosen_locations)
+    # the utility and privacy scores after the last run cover all chosen locations
+    final_utility = float(utility_values[-1]) if num_runs > 0 else 0
+    final_privacy = float(privacy_values[-1]) if num_runs > 0 else 0
     
+    # runs many more trials of the same location so the metrics are not from one random run
+    estimate = None
+    if config.get('monte_carlo_trials') and config.get('geo_ind_epsilon'):
+        print("The Monte Carlo estimate is for uniform picks, it is skipped with planar Laplace noise.")
+    elif config.get('monte_carlo_trials'):
+        estimate = montecarlo.estimate(
+            [float(loc[1]) for loc in locations_to_use], [float(loc[2]) for loc in locations_to_use],
+            coords[0], coords[1], num_runs, config['monte_carlo_trials'], seed=config.get('monte_carlo_seed'),
+            user_dist=user_dist
+        )
+        for line in montecarlo.report_lines(estimate):
+            print(line)
+
     # saves the final results to a file
-    with open("hybrid_locations.txt", "w", encoding="utf-8") as file:
-        file.write("Final Utility and Privacy Metrics:\n")
-        file.write(f"Utility: {final_utility:.4f} km\n")
-        file.write(f"Privacy: {final_privacy:.4f} km\n\n")
-        # adds in every suggested location generated and the amount of times that the location was suggested
-        file.write("Suggested locations:\n")
-        for loc_key, count in location_counter.items():
-            if count > 0:
-                file.write(f"{loc_key} -> suggested {count} times\n")
+    lines = [
+        "Final Utility and Privacy Metrics:",
+        f"Utility: {final_utility:.4f} km",
+        f"Privacy: {final_privacy:.4f} km",
+        "",
+    ]
+    if estimate:
+        lines += montecarlo.report_lines(estimate) + [""]
+    # adds in every suggested location generated and the amount of times that the location was suggested
+    lines.append("Suggested locations:")
+    lines += [f"{loc_key} -> suggested {count} times" for loc_key, count in location_counter.items() if count > 0]
+    with instrumentation.stage("write_results"), open("hybrid_locations.txt", "w", encoding="utf-8") as file:
+        file.write("\n".join(lines) + "\n")
 
 if __name__ == "__main__":
-    Main()
\ No newline at end of file
+    Main()
+    instrumentation.save()
@@ -0,0 +1,141 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Timings and counters of every pipeline stage: geocode, overpass_fetch, json_decode, candidates,
+# simulation, monte_carlo, render_map, render_graph and write_results. Each stage only holds its own
+# time, so a download inside candidates counts as overpass_fetch and Overpass latency stays apart from
+# our code. Counters hold cache hits and misses, payload bytes and candidate counts.
+# Only the standard library is used so any script can load it.
+# Set DATAPRIVACY_METRICS to a file to save a report when a script ends, .prom or .txt files get the
+# Prometheus text format and any other file gets JSON. hybrid_day_in_life.txt can set metrics_file= instead
+METRICS_FILE = os.environ.get("DATAPRIVACY_METRICS")
+PREFIX = "dataprivacy"
+
+_lock = threading.Lock()
+_stages = {}      # stage -> [calls, total seconds, longest seconds]
+_counters = {}    # counter -> total
+_active = threading.local()   # per thread stack of the stages running
+
+def set_metrics_file(path):
+    global METRICS_FILE
+    METRICS_FILE = path
+
+# Times the code inside it as a stage. Stages are exclusive: time spent in a stage started inside
+# another one only counts for the inner stage, so "candidates" does not include the overpass_fetch
+# and json_decode inside it and the stages add up to the total time. A stage inside another call
+# of the same stage is not timed again, so a function that calls itself is only counted once
+@contextmanager
+def stage(name):
+    stack = getattr(_active, "stack", None)
+    if stack is None:
+        stack = _active.stack = []
+    if any(frame[0] == name for frame in stack):
+        yield
+        return
+    frame = [name, 0.0]   # name, seconds spent in stages inside this one
+    stack.append(frame)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stack.pop()
+        if stack:
+            stack[-1][1] += elapsed
+        record(name, elapsed - frame[1])
+
+# Adds one call of a stage that was timed somewhere else, such as a request handled on asyncio
+def record(name, seconds):
+    with _lock:
+        entry = _stages.setdefault(name, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+
+# Decorator that times every call of a function as a stage
+def timed(name):
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def count(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+def reset():
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+
+# Everything recorded so far as a dict that can be saved as JSON
+def report():
+    with _lock:
+        stages = {
+            name: {"calls": calls, "seconds": round(total, 6), "max_seconds": round(longest, 6)}
+            for name, (calls, total, longest) in sorted(_stages.items())
+        }
+        counters = dict(sorted(_counters.items()))
+    return {"stages": stages, "counters": counters}
+
+# Adds a report from another process, such as a worker of RunLocations, to this one
+def merge(other):
+    if not other:
+        return
+    with _lock:
+        for name, values in other.get("stages", {}).items():
+            entry = _stages.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += values["calls"]
+            entry[1] += values["seconds"]
+            entry[2] = max(entry[2], values["max_seconds"])
+        for name, amount in other.get("counters", {}).items():
+            _counters[name] = _counters.get(name, 0) + amount
+
+def _metric_name(name):
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+# The report in the Prometheus text format, gauges can add current values such as latency percentiles
+def prometheus_text(gauges=None):
+    data = report()
+    lines = [
+        f"# HELP {PREFIX}_stage_seconds Time spent in each pipeline stage",
+        f"# TYPE {PREFIX}_stage_seconds summary",
+    ]
+    for name, values in data["stages"].items():
+        lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{name}"}} {values["seconds"]}')
+        lines.append(f'{PREFIX}_stage_seconds_count{{stage="{name}"}} {values["calls"]}')
+    lines += [
+        f"# HELP {PREFIX}_stage_max_seconds Longest single call of each pipeline stage",
+        f"# TYPE {PREFIX}_stage_max_seconds gauge",
+    ]
+    for name, values in data["stages"].items():
+        lines.append(f'{PREFIX}_stage_max_seconds{{stage="{name}"}} {values["max_seconds"]}')
+    for name, amount in data["counters"].items():
+        metric = f"{PREFIX}_{_metric_name(name)}_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {amount}")
+    for name, value in (gauges or {}).items():
+        metric = f"{PREFIX}_{_metric_name(name)}"
+        lines.append(f"# TYPE {metric} gauge")
+        lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+# Saves the report to path, or to METRICS_FILE when no path is given. Does nothing when neither is set
+def save(path=None):
+    path = path or METRICS_FILE
+    if not path:
+        return
+    if os.path.splitext(path)[1].lower() in (".prom", ".txt"):
+        text = prometheus_text()
+    else:
+        text = json.dumps(report(), indent=2) + "\n"
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(text)
@@ -0,0 +1,75 @@
+import os
+import numpy as np
+
+# How the chosen locations are drawn on the maps:
+#   markers - one marker per point, the original look, fine for a few hundred points
+#   cluster - a single FastMarkerCluster layer, the points are one JavaScript array
+#   heatmap - the points are summed into small bins first, so the file size depends on the area, not the runs
+#   auto    - picks one of the above from the number of points
+MAP_MODES = ("auto", "markers", "cluster", "heatmap")
+MAP_MODE = os.environ.get("DATAPRIVACY_MAP_MODE", "auto")
+MARKER_LIMIT = 300       # most points drawn as separate markers in auto mode
+CLUSTER_LIMIT = 20000    # most points drawn as a cluster layer in auto mode, a heatmap is used above this
+HEAT_BIN = 0.0005        # degrees, about 50 m
+
+# Shows the popup text kept in the third column of each row
+CLUSTER_CALLBACK = """
+function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    if (row[2]) {
+        marker.bindPopup(row[2]);
+    }
+    return marker;
+}
+"""
+
+# The mode to draw count points with
+def choose_mode(count, mode=None):
+    mode = (mode or MAP_MODE).lower()
+    if mode not in MAP_MODES:
+        raise ValueError(f"Unknown map mode: {mode}, use one of {', '.join(MAP_MODES)}")
+    if mode != "auto":
+        return mode
+    if count <= MARKER_LIMIT:
+        return "markers"
+    if count <= CLUSTER_LIMIT:
+        return "cluster"
+    return "heatmap"
+
+# Sums weighted points into square bins, returns the bin centers and total weight of each bin
+def bin_points(lats, lons, weights=None, bin_size=HEAT_BIN):
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    weights = np.ones(len(lats)) if weights is None else np.asarray(weights, dtype=np.float64)
+    if len(lats) == 0:
+        return lats, lons, weights
+    cells = np.stack([np.floor(lats / bin_size), np.floor(lons / bin_size)], axis=1).astype(np.int64)
+    unique, inverse = np.unique(cells, axis=0, return_inverse=True)
+    totals = np.bincount(inverse.ravel(), weights=weights, minlength=len(unique))
+    return (unique[:, 0] + 0.5) * bin_size, (unique[:, 1] + 0.5) * bin_size, totals
+
+def add_cluster(Map, lats, lons, labels=None, name="Chosen locations"):
+    from folium.plugins import FastMarkerCluster
+    if labels is None:
+        labels = [""] * len(lats)
+    data = [[float(lat), float(lon), label] for lat, lon, label in zip(lats, lons, labels)]
+    FastMarkerCluster(data, callback=CLUSTER_CALLBACK, name=name).add_to(Map)
+
+def add_heatmap(Map, lats, lons, weights=None, name="Chosen locations"):
+    from folium.plugins import HeatMap
+    bin_lats, bin_lons, totals = bin_points(lats, lons, weights)
+    if len(totals) == 0:
+        return
+    totals = totals / totals.max()
+    data = [[float(lat), float(lon), float(w)] for lat, lon, w in zip(bin_lats, bin_lons, totals)]
+    HeatMap(data, name=name, radius=15, blur=10).add_to(Map)
+
+# Draws the points as a cluster layer or a heatmap, markers are drawn by the callers in their own style.
+# weights are how many times each point was chosen and labels are the popup texts
+def add_layer(Map, mode, lats, lons, weights=None, labels=None):
+    if mode == "cluster":
+        add_cluster(Map, lats, lons, labels)
+    elif mode == "heatmap":
+        add_heatmap(Map, lats, lons, weights)
+    else:
+        raise ValueError(f"add_layer draws cluster or heatmap layers, not {mode}")
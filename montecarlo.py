@@ -0,0 +1,113 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from statistics import NormalDist
+import numpy as np
+import distance
+import instrumentation
+
+# Trials are split into chunks of this many, each with its own random stream. The chunks only
+# depend on the number of trials so a seed gives the same result on any number of workers
+CHUNK_TRIALS = 250
+# Largest (trials x locations) count table one chunk builds at a time
+MAX_CHUNK_CELLS = 4_000_000
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+CONFIDENCE = 0.95
+
+# Final utility and privacy of `trials` independent runs of num_runs picks each.
+# Picking num_runs locations uniformly at random is the same as drawing how many times each
+# location was picked from a multinomial, so the cost does not grow with num_runs
+def _final_metrics(lats, lons, user_dist, user_lat, user_lon, num_runs, trials, rng, distinct, weights=None):
+    n = len(lats)
+    probabilities = np.full(n, 1.0 / n) if weights is None else weights
+    counts = rng.multinomial(num_runs, probabilities, size=trials).astype(np.float64)
+    if distinct:
+        # poi.py only counts each chosen POI once
+        counts = (counts > 0).astype(np.float64)
+    picked = counts.sum(axis=1)
+    utility = counts @ user_dist / picked
+    privacy = distance.haversine(user_lat, user_lon, counts @ lats / picked, counts @ lons / picked)
+    return utility, privacy
+
+# Runs one chunk of trials with its own random stream, this runs in a worker process
+def _run_chunk(lats, lons, user_lat, user_lon, num_runs, trials, seed, distinct, user_dist=None, weights=None):
+    rng = np.random.default_rng(seed)
+    if user_dist is None:
+        user_dist = distance.one_to_many(user_lat, user_lon, lats, lons)
+    step = max(1, MAX_CHUNK_CELLS // max(1, len(lats)))
+    utility = []
+    privacy = []
+    for start in range(0, trials, step):
+        u, p = _final_metrics(lats, lons, user_dist, user_lat, user_lon, num_runs,
+                              min(step, trials - start), rng, distinct, weights)
+        utility.append(u)
+        privacy.append(p)
+    return np.concatenate(utility), np.concatenate(privacy)
+
+# Mean, spread, quantiles and a normal confidence interval for the mean of a set of values
+def summarize(values, confidence=CONFIDENCE):
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    mean = float(values.mean())
+    std = float(values.std(ddof=1)) if n > 1 else 0.0
+    margin = NormalDist().inv_cdf(0.5 + confidence / 2) * std / np.sqrt(n)
+    return {
+        "mean": mean,
+        "std": std,
+        "ci_low": mean - margin,
+        "ci_high": mean + margin,
+        "confidence": confidence,
+        "quantiles": {q: float(v) for q, v in zip(QUANTILES, np.quantile(values, QUANTILES))},
+    }
+
+# Runs many independently seeded trials of a location and summarizes the final utility and privacy.
+# Every chunk of CHUNK_TRIALS trials gets its own stream spawned from one SeedSequence and the chunks
+# are spread over the workers, so the result only depends on seed and not on the number of workers.
+# workers=1 runs everything in this process, which is what worker processes should use.
+# user_dist can hold the distance from the user to every location, such as walking distances,
+# and weights how likely each location is to be picked when it is not uniform
+@instrumentation.timed("monte_carlo")
+def estimate(lats, lons, user_lat, user_lon, num_runs, trials=1000, distinct=False, seed=None, workers=None,
+             user_dist=None, weights=None):
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    if user_dist is not None:
+        user_dist = np.asarray(user_dist, dtype=np.float64)
+    if weights is not None:
+        weights = np.asarray(weights, dtype=np.float64)
+        weights = weights / weights.sum()
+    if len(lats) == 0 or num_runs < 1 or trials < 1:
+        return None
+    workers = workers or os.cpu_count() or 1
+    chunks = -(-trials // CHUNK_TRIALS)
+    sizes = [min(CHUNK_TRIALS, trials - i * CHUNK_TRIALS) for i in range(chunks)]
+    seeds = np.random.SeedSequence(seed).spawn(chunks)
+    args = [(lats, lons, user_lat, user_lon, num_runs, size, child, distinct, user_dist, weights)
+            for size, child in zip(sizes, seeds)]
+
+    if workers == 1:
+        results = [_run_chunk(*arg) for arg in args]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, chunks)) as pool:
+            results = list(pool.map(_run_chunk, *zip(*args)))
+
+    utility = np.concatenate([r[0] for r in results])
+    privacy = np.concatenate([r[1] for r in results])
+    return {
+        "trials": trials,
+        "num_runs": num_runs,
+        "utility": summarize(utility),
+        "privacy": summarize(privacy),
+    }
+
+# Text lines describing an estimate, used for printing and the results files
+def report_lines(result):
+    lines = [f"Monte Carlo over {result['trials']} trials of {result['num_runs']} runs:"]
+    for name in ("utility", "privacy"):
+        stats = result[name]
+        quantiles = ", ".join(f"p{int(q * 100)} {v:.4f}" for q, v in stats["quantiles"].items())
+        lines.append(
+            f"{name.capitalize()}: mean {stats['mean']:.4f} km "
+            f"({stats['confidence']:.0%} CI {stats['ci_low']:.4f} - {stats['ci_high']:.4f}), "
+            f"std {stats['std']:.4f}, {quantiles}"
+        )
+    return lines
@@ -0,0 +1,213 @@
+from collections import defaultdict
+import numpy as np
+import overpass # cached queries to OpenStreetMaps
+import candidate_grid
+import simulation
+import montecarlo
+import parallel
+import instrumentation
+import geo_ind
+import walk_graph
+import clustering
+import http_client
+
+# The parts of hybrid.py that find and pick locations, without any maps or plots.
+# Only NumPy and the standard library are loaded, so short jobs and worker processes start quickly
+
+# fewest pois needed before walkable locations are left out
+POI_THRESHOLD = 20
+
+# Queiries OpenStreetMaps Overpass API to find POIs
+@instrumentation.timed("candidates")
+def FindPOIs(lat, lon, rad):
+    # finds amentities, tourism, leisure, and shop tags 
+    pois = PoiLocations(overpass.fetch_elements("poi", lat, lon, rad))
+    instrumentation.count("pois_found", len(pois))
+    return pois
+
+# turns Overpass poi elements into (name, lat, lon, "poi") locations, unnamed ones are left out
+def PoiLocations(elements):
+    pois = []
+    for el in elements:
+        name = el.get('tags', {}).get('name', 'Unnamed POI')
+        lat = el.get('lat')
+        lon = el.get('lon')
+
+        if lat is None or lon is None:
+            center = el.get('center')
+            if center:
+                lat = center.get('lat')
+                lon = center.get('lon')
+
+        if lat is not None and lon is not None and name != 'Unnamed POI':
+            pois.append((name, lat, lon, "poi"))
+
+    # returns the lists of pois
+    return pois
+
+# querires OpenStreetMaps for walkable areas along a road or trail
+@instrumentation.timed("candidates")
+def FindWalkableAreas(lat, lon, rad):
+    walkable_areas = WalkableLocations(overpass.fetch_elements("walkable", lat, lon, rad))
+    instrumentation.count("walkable_found", len(walkable_areas))
+    return walkable_areas
+
+# turns Overpass walkable elements into (name, lat, lon, "walkable") locations
+def WalkableLocations(elements):
+    # puts the walkable locations into a list with longitude and latitude
+    walkable_areas = []
+    for el in elements:
+        center = el.get('center')
+        if center:
+            lat_center = center.get('lat')
+            lon_center = center.get('lon')
+            if lat_center and lon_center:
+                highway_type = el['tags'].get('highway', 'unknown')
+                name = el['tags'].get('name', f"Walkable Area ({highway_type})")
+                walkable_areas.append((name, lat_center, lon_center, "walkable"))
+    # returns all the walkable locations
+    return walkable_areas
+
+# picks the locations to suggest, only pois when there are enough of them
+# otherwise both the pois and the walkable locations
+def ChooseLocations(pois, walkable_areas):
+    locations = pois if len(pois) >= POI_THRESHOLD else pois + walkable_areas
+    instrumentation.count("candidates", len(locations))
+    return locations
+
+# the pois and walkable locations of the whole tile a point is in, every user in the tile
+# gets the same lists so anything worked out from them can be shared
+def TileLocations(lat, lon, rad, priority=http_client.NORMAL):
+    pois = PoiLocations(overpass.fetch_tile("poi", lat, lon, rad, priority=priority).items)
+    walkable = WalkableLocations(overpass.fetch_tile("walkable", lat, lon, rad, priority=priority).items)
+    return pois, walkable
+
+# only about k of the locations of a dense area, one for each cluster of candidates (see
+# clustering.coarse_tier). The clusters are fitted on every candidate of the tile, or of the grid
+# cell when the locations come from a candidate grid, and cached so all users there share them.
+# area can hold the candidates of the tile when they are already known
+def CoarseLocations(coords, radius, locations, k, grid=None, area=None):
+    if grid is not None and grid.covers(coords[0], coords[1], radius):
+        key = ("grid", grid.path, grid.cell_of(coords[0], coords[1]))
+        return clustering.coarse_tier(locations, k, key=key, area=locations)
+    tile_lat, tile_lon, _, _, fetch_rad = overpass.tile_for(coords[0], coords[1], radius)
+    if area is None:
+        pois, walkable = TileLocations(coords[0], coords[1], radius)
+        area = pois + walkable
+    key = ("tile", overpass.OFFLINE_DB, tile_lat, tile_lon, fetch_rad)
+    return clustering.coarse_tier(locations, clustering.tile_clusters(k, radius, fetch_rad), key=key, area=area)
+
+# the text used to count how many times a location was picked
+def LocationKey(loc):
+    return f"{loc[0]} ({loc[1]}, {loc[2]})"
+
+# picks a random location for every run, returns the chosen indices and the utility and
+# privacy after every run as arrays (see simulation.simulate). user_dist can hold the
+# walking distance to every location (see walk_graph.py) to use for the utility
+def SimulateRuns(coords, locations_to_use, num_runs, rng=None, user_dist=None):
+    return simulation.simulate(
+        [float(loc[1]) for loc in locations_to_use], [float(loc[2]) for loc in locations_to_use],
+        coords[0], coords[1], num_runs, rng, user_dist=user_dist
+    )
+
+# picks a location for every run with the planar Laplace mechanism instead of uniformly at random:
+# each run reports a noisy copy of the user's location and suggests the location closest to it.
+# epsilon is per metre (see geo_ind.py), returns the same arrays as SimulateRuns
+@instrumentation.timed("simulation")
+def SimulateLaplace(coords, locations_to_use, num_runs, epsilon, rng=None, user_dist=None):
+    choices, _ = geo_ind.obfuscate_to(
+        np.full(num_runs, coords[0]), np.full(num_runs, coords[1]), locations_to_use, epsilon, rng
+    )
+    lats = [float(loc[1]) for loc in locations_to_use]
+    lons = [float(loc[2]) for loc in locations_to_use]
+    utility, privacy = simulation.curves(lats, lons, coords[0], coords[1], choices, user_dist=user_dist)
+    return {
+        "choices": choices,
+        "utility": utility,
+        "privacy": privacy,
+        "counts": np.bincount(choices, minlength=len(locations_to_use)),
+    }
+
+# counts keyed by LocationKey, locations maps each key back to the location it came from
+# so the chosen locations can be found without going through every candidate
+class LocationCounter(defaultdict):
+    def __init__(self, *args):
+        super().__init__(int)
+        self.locations = {}
+
+# how many times each location was picked, in the order they were first picked
+def PickCounts(locations_to_use, choices):
+    location_counter = LocationCounter()
+    for choice, count in zip(*simulation.first_picks(choices)):
+        location = locations_to_use[choice]
+        key = LocationKey(location)
+        location_counter[key] += int(count)
+        location_counter.locations[key] = location
+    return location_counter
+
+# finds the locations to suggest for one of many users, this runs on a thread.
+# Returns the locations and the walking distance to each one, or None for straight lines
+def FetchLocations(task):
+    coords, radius, num_runs, grid_path, trials, seed, options = task
+    grid = None
+    if grid_path:
+        grid = candidate_grid.CandidateGrid(grid_path)
+    if grid is not None and grid.covers(coords[0], coords[1], radius):
+        locations = grid.candidates(coords[0], coords[1])
+    else:
+        locations = ChooseLocations(FindPOIs(coords[0], coords[1], radius), FindWalkableAreas(coords[0], coords[1], radius))
+
+    cluster_k = options.get('cluster_k')
+    if cluster_k and len(locations) > cluster_k:
+        locations = CoarseLocations(coords, radius, locations, cluster_k, grid)
+
+    user_dist = None
+    if options.get('walk_distance') and locations:
+        try:
+            walkable_locations, user_dist = walk_graph.within_walk(coords, locations, options['walk_distance'])
+        except Exception as e:
+            print(f"Could not load the walking network for {coords}, using straight line distances: {e}")
+        else:
+            if user_dist is not None:
+                locations = walkable_locations
+    return locations, user_dist
+
+# runs the simulation for one of many users, this runs in a worker process.
+# The stage timings of the worker are sent back with the result to be merged by the parent
+def SimulateLocations(task, fetched):
+    coords, radius, num_runs, grid_path, trials, seed, options = task
+    locations_to_use, user_dist = fetched
+    if not locations_to_use or num_runs < 1:
+        return None
+    instrumentation.reset()
+    lats = [float(loc[1]) for loc in locations_to_use]
+    lons = [float(loc[2]) for loc in locations_to_use]
+    epsilon = options.get('geo_ind_epsilon')
+    if epsilon:
+        result = SimulateLaplace(coords, locations_to_use, num_runs, epsilon, user_dist=user_dist)
+    else:
+        result = simulation.simulate(lats, lons, coords[0], coords[1], num_runs, user_dist=user_dist)
+    return {
+        "utility": float(result["utility"][-1]),
+        "privacy": float(result["privacy"][-1]),
+        "locations": len(locations_to_use),
+        "location_counter": dict(PickCounts(locations_to_use, result["choices"])),
+        # each location already has its own worker process, so the trials stay in it.
+        # The estimate is for uniform picks, so there is none with planar Laplace noise
+        "monte_carlo": montecarlo.estimate(lats, lons, coords[0], coords[1], num_runs, trials, seed=seed,
+                                           workers=1, user_dist=user_dist) if trials and not epsilon else None,
+        # every run is only sent back when it is saved to a results file
+        "runs": (locations_to_use, result["choices"], result["utility"], result["privacy"])
+                if options.get('keep_runs') else None,
+        "metrics": instrumentation.report(),
+    }
+
+# runs many user locations at once, the results are in the same order as the locations
+# trials turns on the Monte Carlo estimate, seed makes it repeatable. options can hold the
+# same cluster_k, walk_distance and geo_ind_epsilon settings as a single location, and
+# keep_runs to send back every run
+def RunLocations(coords_list, radius, num_runs, grid_path=None, trials=0, seed=None, options=None):
+    options = options or {}
+    tasks = [(coords, radius, num_runs, grid_path, trials, None if seed is None else [seed, i], options)
+             for i, coords in enumerate(coords_list)]
+    return parallel.run_locations(tasks, FetchLocations, SimulateLocations)
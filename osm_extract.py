@@ -0,0 +1,456 @@
+import bz2
+import gzip
+import json
+import math
+import re
+import sqlite3
+import sys
+import threading
+import xml.etree.ElementTree as ET
+import overpass
+import distance
+
+# Size of the grid cells used to look up elements near a point, in degrees
+CELL_SIZE = 0.01
+
+# Same tag filters as the Overpass queries in FindPOIs and FindWalkableAreas
+POI_KEYS = ("amenity", "tourism", "leisure", "shop")
+EXCLUDED_HIGHWAYS = re.compile(r"motorway|motorway_link")
+
+def is_poi(tags):
+    return any(key in tags for key in POI_KEYS)
+
+def is_walkable(osm_type, tags):
+    highway = tags.get("highway")
+    return osm_type == "way" and highway is not None and not EXCLUDED_HIGHWAYS.search(highway)
+
+def cell_of(lat, lon):
+    return math.floor(lat / CELL_SIZE), math.floor(lon / CELL_SIZE)
+
+# Local store of the POI and walkable elements of an OpenStreetMap extract
+class OfflineStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS nodes (id INTEGER PRIMARY KEY, lat REAL, lon REAL);
+            CREATE TABLE IF NOT EXISTS way_nodes (way_id INTEGER, node_id INTEGER);
+            CREATE INDEX IF NOT EXISTS way_nodes_way ON way_nodes (way_id);
+            CREATE INDEX IF NOT EXISTS way_nodes_node ON way_nodes (node_id);
+            CREATE TABLE IF NOT EXISTS relation_members (relation_id INTEGER, type TEXT, ref INTEGER);
+            CREATE INDEX IF NOT EXISTS relation_members_relation ON relation_members (relation_id);
+            CREATE INDEX IF NOT EXISTS relation_members_ref ON relation_members (type, ref);
+            CREATE TABLE IF NOT EXISTS elements (
+                type TEXT, id INTEGER, lat REAL, lon REAL, cell_lat INTEGER, cell_lon INTEGER,
+                poi INTEGER, walkable INTEGER, tags TEXT, PRIMARY KEY (type, id));
+            CREATE INDEX IF NOT EXISTS elements_cell ON elements (cell_lat, cell_lon);
+            CREATE TABLE IF NOT EXISTS way_bounds (
+                way_id INTEGER PRIMARY KEY, min_lat REAL, max_lat REAL, min_lon REAL, max_lon REAL);
+            CREATE INDEX IF NOT EXISTS way_bounds_lat ON way_bounds (min_lat, max_lat);
+            """
+        )
+        # stores made before way_bounds existed get the bounds of their walkable ways once
+        if conn.execute("SELECT 1 FROM way_bounds LIMIT 1").fetchone() is None:
+            conn.execute(
+                "INSERT INTO way_bounds SELECT way_nodes.way_id, MIN(nodes.lat), MAX(nodes.lat), "
+                "MIN(nodes.lon), MAX(nodes.lon) FROM elements "
+                "JOIN way_nodes ON way_nodes.way_id = elements.id JOIN nodes ON nodes.id = way_nodes.node_id "
+                "WHERE elements.type = 'way' AND elements.walkable = 1 GROUP BY way_nodes.way_id"
+            )
+        conn.commit()
+
+    # One connection per thread so the store can be shared by worker threads
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            self._local.conn = conn
+        return conn
+
+    # Writes an element to the search table when it matches one of the tag filters
+    def put_element(self, osm_type, osm_id, lat, lon, tags):
+        poi = is_poi(tags)
+        walkable = is_walkable(osm_type, tags)
+        conn = self._connect()
+        if osm_type == "way":
+            conn.execute("DELETE FROM way_bounds WHERE way_id = ?", (osm_id,))
+        if lat is None or (not poi and not walkable):
+            conn.execute("DELETE FROM elements WHERE type = ? AND id = ?", (osm_type, osm_id))
+            return
+        # walkable ways are also found by their bounding box, see _walk_graph
+        if walkable:
+            bounds = self.way_bounds(osm_id)
+            if bounds:
+                conn.execute("INSERT INTO way_bounds VALUES (?, ?, ?, ?, ?)", (osm_id,) + bounds)
+        cell_lat, cell_lon = cell_of(lat, lon)
+        conn.execute(
+            "INSERT OR REPLACE INTO elements VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (osm_type, osm_id, lat, lon, cell_lat, cell_lon, int(poi), int(walkable), json.dumps(tags))
+        )
+
+    def put_way(self, osm_id, refs):
+        conn = self._connect()
+        conn.execute("DELETE FROM way_nodes WHERE way_id = ?", (osm_id,))
+        conn.executemany("INSERT INTO way_nodes VALUES (?, ?)", [(osm_id, ref) for ref in refs])
+
+    def put_relation(self, osm_id, members):
+        conn = self._connect()
+        conn.execute("DELETE FROM relation_members WHERE relation_id = ?", (osm_id,))
+        conn.executemany(
+            "INSERT INTO relation_members VALUES (?, ?, ?)",
+            [(osm_id, member_type, ref) for member_type, ref in members]
+        )
+
+    # Position stored for an element, or None when it is not in the search table
+    def element_position(self, osm_type, osm_id):
+        row = self._connect().execute(
+            "SELECT lat, lon FROM elements WHERE type = ? AND id = ?", (osm_type, osm_id)
+        ).fetchone()
+        return tuple(row) if row else None
+
+    def element_tags(self, osm_type, osm_id):
+        row = self._connect().execute(
+            "SELECT tags FROM elements WHERE type = ? AND id = ?", (osm_type, osm_id)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # Bounding box of the nodes of a way as (min lat, max lat, min lon, max lon)
+    def way_bounds(self, osm_id):
+        row = self._connect().execute(
+            "SELECT MIN(lat), MAX(lat), MIN(lon), MAX(lon) FROM nodes "
+            "WHERE id IN (SELECT node_id FROM way_nodes WHERE way_id = ?)",
+            (osm_id,)
+        ).fetchone()
+        if row[0] is None:
+            return None
+        return tuple(row)
+
+    # Center of the bounding box of the nodes of a way
+    def way_center(self, osm_id):
+        bounds = self.way_bounds(osm_id)
+        if bounds is None:
+            return None
+        return ((bounds[0] + bounds[1]) / 2, (bounds[2] + bounds[3]) / 2)
+
+    # Center of the bounding box of the member nodes and the nodes of the member ways of a relation
+    def relation_center(self, osm_id):
+        row = self._connect().execute(
+            "SELECT MIN(lat), MAX(lat), MIN(lon), MAX(lon) FROM nodes WHERE id IN ("
+            "SELECT ref FROM relation_members WHERE relation_id = ? AND type = 'node' "
+            "UNION SELECT node_id FROM way_nodes WHERE way_id IN "
+            "(SELECT ref FROM relation_members WHERE relation_id = ? AND type = 'way'))",
+            (osm_id, osm_id)
+        ).fetchone()
+        if row[0] is None:
+            return None
+        return ((row[0] + row[1]) / 2, (row[2] + row[3]) / 2)
+
+    def _ways_using(self, node_ids):
+        return self._referencing("SELECT DISTINCT way_id FROM way_nodes WHERE node_id IN ({})", [], node_ids)
+
+    def _relations_using(self, member_type, refs):
+        return self._referencing(
+            "SELECT DISTINCT relation_id FROM relation_members WHERE type = ? AND ref IN ({})", [member_type], refs
+        )
+
+    def _referencing(self, sql, params, ids):
+        conn = self._connect()
+        found = set()
+        ids = list(ids)
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            rows = conn.execute(sql.format(",".join("?" * len(chunk))), params + chunk)
+            found.update(row[0] for row in rows)
+        return found
+
+    # Node ids of a way in order, with the position of each node (None when the node is missing)
+    def way_geometry(self, osm_id):
+        rows = self._connect().execute(
+            "SELECT way_nodes.node_id, nodes.lat, nodes.lon FROM way_nodes "
+            "LEFT JOIN nodes ON nodes.id = way_nodes.node_id WHERE way_nodes.way_id = ? ORDER BY way_nodes.rowid",
+            (osm_id,)
+        ).fetchall()
+        return ([row[0] for row in rows],
+                [{'lat': row[1], 'lon': row[2]} if row[1] is not None else None for row in rows])
+
+    # Walkable ways with any part within rad km, with their node ids and geometry like `out body geom`.
+    # Ways are found by their bounding box instead of their center, so a long way that passes
+    # through the circle is found too, and then their segments are checked
+    def _walk_graph(self, lat, lon, rad, dlat, dlon):
+        rows = self._connect().execute(
+            "SELECT elements.id, elements.tags FROM way_bounds "
+            "JOIN elements ON elements.type = 'way' AND elements.id = way_bounds.way_id "
+            "WHERE elements.walkable = 1 AND min_lat <= ? AND max_lat >= ? AND min_lon <= ? AND max_lon >= ?",
+            (lat + dlat, lat - dlat, lon + dlon, lon - dlon)
+        ).fetchall()
+        elements = []
+        for osm_id, tags in rows:
+            el = {'type': 'way', 'id': osm_id, 'tags': json.loads(tags)}
+            el['nodes'], el['geometry'] = self.way_geometry(osm_id)
+            elements.append(el)
+        return overpass.near_geometry(elements, lat, lon, rad)
+
+    # Returns the elements of a kind within rad km, in the same shape as the Overpass JSON.
+    # walk_graph is the walkable ways with their node ids and geometry, like `out body geom`
+    def query(self, kind, lat, lon, rad):
+        if kind == "poi":
+            column = "poi"
+        elif kind in ("walkable", "walk_graph"):
+            column = "walkable"
+        else:
+            raise ValueError(f"Unknown query kind: {kind}")
+        dlat = rad / overpass.KM_PER_DEGREE
+        dlon = rad / (overpass.KM_PER_DEGREE * max(math.cos(math.radians(lat)), 1e-6))
+        if kind == "walk_graph":
+            return self._walk_graph(lat, lon, rad, dlat, dlon)
+        low_lat, low_lon = cell_of(lat - dlat, lon - dlon)
+        high_lat, high_lon = cell_of(lat + dlat, lon + dlon)
+        rows = self._connect().execute(
+            f"SELECT type, id, lat, lon, tags FROM elements WHERE {column} = 1 "
+            "AND cell_lat BETWEEN ? AND ? AND cell_lon BETWEEN ? AND ?",
+            (low_lat, high_lat, low_lon, high_lon)
+        )
+        rows = rows.fetchall()
+        if not rows:
+            return []
+        dist = distance.one_to_many(lat, lon, [row[2] for row in rows], [row[3] for row in rows])
+        elements = []
+        for (osm_type, osm_id, el_lat, el_lon, tags), el_dist in zip(rows, dist):
+            if el_dist > rad:
+                continue
+            el = {'type': osm_type, 'id': osm_id, 'tags': json.loads(tags)}
+            if osm_type == "node":
+                el['lat'] = el_lat
+                el['lon'] = el_lon
+            else:
+                el['center'] = {'lat': el_lat, 'lon': el_lon}
+            elements.append(el)
+        return elements
+
+    # Applies an osmChange (.osc) file and returns the old and new positions of every
+    # element whose entry changed, so callers can refresh only the areas around them
+    def apply_change(self, path):
+        conn = self._connect()
+        old_positions = {}
+        moved_nodes = set()
+        changed_ways = set()
+        way_tags = {}
+        relation_tags = {}
+
+        def remember(osm_type, osm_id):
+            if (osm_type, osm_id) not in old_positions:
+                old_positions[(osm_type, osm_id)] = self.element_position(osm_type, osm_id)
+
+        for action, osm_type, osm_id, lat, lon, tags, refs in _parse_xml(path):
+            remember(osm_type, osm_id)
+            if osm_type == "node":
+                moved_nodes.add(osm_id)
+                if action == "delete":
+                    conn.execute("DELETE FROM nodes WHERE id = ?", (osm_id,))
+                    self.put_element("node", osm_id, None, None, {})
+                else:
+                    conn.execute("INSERT OR REPLACE INTO nodes VALUES (?, ?, ?)", (osm_id, lat, lon))
+                    self.put_element("node", osm_id, lat, lon, tags)
+            elif osm_type == "way":
+                changed_ways.add(osm_id)
+                if action == "delete":
+                    self.put_way(osm_id, [])
+                    self.put_element("way", osm_id, None, None, {})
+                    way_tags.pop(osm_id, None)
+                else:
+                    self.put_way(osm_id, refs)
+                    way_tags[osm_id] = tags
+            else:
+                if action == "delete":
+                    self.put_relation(osm_id, [])
+                    self.put_element("relation", osm_id, None, None, {})
+                    relation_tags.pop(osm_id, None)
+                else:
+                    self.put_relation(osm_id, refs)
+                    relation_tags[osm_id] = tags
+
+        # ways and relations built from changed nodes or ways need a new center too
+        moved_ways = self._ways_using(moved_nodes)
+        for way_id in moved_ways - set(way_tags):
+            tags = self.element_tags("way", way_id)
+            if tags is not None:
+                way_tags[way_id] = tags
+        changed_ways.update(moved_ways)
+        dependents = self._relations_using("node", moved_nodes) | self._relations_using("way", changed_ways)
+        for relation_id in dependents - set(relation_tags):
+            tags = self.element_tags("relation", relation_id)
+            if tags is not None:
+                relation_tags[relation_id] = tags
+
+        for way_id, tags in way_tags.items():
+            remember("way", way_id)
+            center = self.way_center(way_id) if tags else None
+            self.put_element("way", way_id, *(center or (None, None)), tags)
+        for relation_id, tags in relation_tags.items():
+            remember("relation", relation_id)
+            center = self.relation_center(relation_id) if tags else None
+            self.put_element("relation", relation_id, *(center or (None, None)), tags)
+        conn.commit()
+
+        points = []
+        for key, old in old_positions.items():
+            new = self.element_position(*key)
+            if old is not None:
+                points.append(old)
+            if new is not None and new != old:
+                points.append(new)
+        return points
+
+    def commit(self):
+        self._connect().commit()
+
+# Collects the nodes, ways and relations of an extract and writes them to the store.
+# Extracts list every node before the ways, so the center of a way (the middle of its bounding box,
+# like Overpass "out center") is read back from the nodes table instead of keeping all nodes in memory
+class _Importer:
+    def __init__(self, store):
+        self.store = store
+        self.conn = store._connect()
+        self.pending_relations = []
+
+    def node(self, osm_id, lat, lon, tags):
+        self.conn.execute("INSERT OR REPLACE INTO nodes VALUES (?, ?, ?)", (osm_id, lat, lon))
+        if tags:
+            self.store.put_element("node", osm_id, lat, lon, tags)
+
+    def way(self, osm_id, refs, tags):
+        self.store.put_way(osm_id, refs)
+        if is_poi(tags) or is_walkable("way", tags):
+            center = self.store.way_center(osm_id)
+            if center:
+                self.store.put_element("way", osm_id, center[0], center[1], tags)
+
+    def relation(self, osm_id, members, tags):
+        self.store.put_relation(osm_id, members)
+        if tags and is_poi(tags):
+            self.pending_relations.append((osm_id, tags))
+
+    # Relations are done last since their member ways may come after them in the file
+    def finish(self):
+        for osm_id, tags in self.pending_relations:
+            center = self.store.relation_center(osm_id)
+            if center:
+                self.store.put_element("relation", osm_id, center[0], center[1], tags)
+        self.store.commit()
+
+def _open_xml(path):
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rb")
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+# Reads an .osm or .osc XML file one element at a time so large files do not have to fit in memory.
+# Yields the osmChange action (None for plain extracts), type, id, position, tags and node refs or members
+def _parse_xml(path):
+    action = None
+    with _open_xml(path) as file:
+        for event, elem in ET.iterparse(file, events=("start", "end")):
+            if event == "start":
+                if elem.tag in ("create", "modify", "delete"):
+                    action = elem.tag
+                continue
+            if elem.tag not in ("node", "way", "relation"):
+                continue
+            tags = {t.get("k"): t.get("v") for t in elem.findall("tag")}
+            osm_id = int(elem.get("id"))
+            lat = lon = None
+            refs = None
+            if elem.tag == "node":
+                if elem.get("lat") is not None:
+                    lat = float(elem.get("lat"))
+                    lon = float(elem.get("lon"))
+            elif elem.tag == "way":
+                refs = [int(nd.get("ref")) for nd in elem.findall("nd")]
+            else:
+                refs = [(m.get("type"), int(m.get("ref"))) for m in elem.findall("member")]
+            yield action, elem.tag, osm_id, lat, lon, tags, refs
+            elem.clear()
+
+def _read_xml(path, importer):
+    for action, osm_type, osm_id, lat, lon, tags, refs in _parse_xml(path):
+        if osm_type == "node":
+            importer.node(osm_id, lat, lon, tags)
+        elif osm_type == "way":
+            importer.way(osm_id, refs, tags)
+        else:
+            importer.relation(osm_id, refs, tags)
+
+# Reads an .osm.pbf file, this needs the optional pyosmium package
+def _read_pbf(path, importer):
+    try:
+        import osmium
+    except ImportError:
+        raise ImportError("Reading .osm.pbf files needs pyosmium (pip install osmium)")
+
+    class Handler(osmium.SimpleHandler):
+        def node(self, n):
+            importer.node(n.id, n.location.lat, n.location.lon, {t.k: t.v for t in n.tags})
+
+        def way(self, w):
+            importer.way(w.id, [nd.ref for nd in w.nodes], {t.k: t.v for t in w.tags})
+
+        def relation(self, r):
+            members = [({"n": "node", "w": "way", "r": "relation"}[m.type], m.ref) for m in r.members]
+            importer.relation(r.id, members, {t.k: t.v for t in r.tags})
+
+    Handler().apply_file(path)
+
+# Loads an OpenStreetMap extract into a local store
+def import_extract(extract_path, store_path):
+    store = OfflineStore(store_path)
+    importer = _Importer(store)
+    if extract_path.endswith(".pbf"):
+        _read_pbf(extract_path, importer)
+    else:
+        _read_xml(extract_path, importer)
+    importer.finish()
+    return store
+
+_stores = {}
+
+def get_store(path):
+    if path not in _stores:
+        _stores[path] = OfflineStore(path)
+    return _stores[path]
+
+# Applies an osmChange file to a store and refreshes the affected cells of a candidate grid
+def apply_change(change_path, store_path, grid_path=None):
+    store = get_store(store_path)
+    points = store.apply_change(change_path)
+    cells = []
+    if grid_path:
+        import candidate_grid
+        overpass.OFFLINE_DB = store_path
+        cells = candidate_grid.refresh_grid(grid_path, points)
+    return points, cells
+
+def main():
+    if len(sys.argv) >= 3 and sys.argv[1] == "--apply":
+        store_path = sys.argv[3] if len(sys.argv) > 3 else "osm_offline.sqlite"
+        grid_path = sys.argv[4] if len(sys.argv) > 4 else None
+        points, cells = apply_change(sys.argv[2], store_path, grid_path)
+        print(f"Updated {len(points)} positions in {store_path}")
+        if grid_path:
+            print(f"Refreshed {len(cells)} cells in {grid_path}")
+        return
+    if len(sys.argv) < 2:
+        print("Usage: python osm_extract.py <extract.osm|extract.osm.pbf> [store.sqlite]")
+        print("       python osm_extract.py --apply <changes.osc> [store.sqlite] [grid_dir]")
+        return
+    store_path = sys.argv[2] if len(sys.argv) > 2 else "osm_offline.sqlite"
+    store = import_extract(sys.argv[1], store_path)
+    conn = store._connect()
+    pois = conn.execute("SELECT COUNT(*) FROM elements WHERE poi = 1").fetchone()[0]
+    walkable = conn.execute("SELECT COUNT(*) FROM elements WHERE walkable = 1").fetchone()[0]
+    print(f"Imported {pois} POIs and {walkable} walkable areas into {store_path}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import zlib
+import numpy as np
+import http_client
+import instrumentation
+from spatial_index import SpatialIndex
+
+# Using the Overpass API for mapping, the other public mirrors are tried when one is down or busy.
+# OVERPASS_URLS can hold a comma separated list of endpoints to use instead
+OVERPASS_URL = "http://overpass-api.de/api/interpreter"
+OVERPASS_URLS = [url.strip() for url in os.environ.get("OVERPASS_URLS", "").split(",") if url.strip()] or [
+    OVERPASS_URL,
+    "https://overpass.kumi.systems/api/interpreter",
+    "https://overpass.private.coffee/api/interpreter",
+]
+
+# Settings for the on-disk tile cache of Overpass responses
+CACHE_ENABLED = os.environ.get("OVERPASS_CACHE", "1") != "0"
+CACHE_PATH = os.environ.get("OVERPASS_CACHE_PATH", "overpass_cache.sqlite")
+CACHE_TTL = 7 * 24 * 60 * 60          # seconds an entry is kept before it is downloaded again
+CACHE_MAX_BYTES = 256 * 1024 * 1024   # total compressed size kept on disk
+TILE_SIZE = 0.01                      # degrees, about 1.1 km of latitude
+RADIUS_STEP = 0.25                    # km, fetch radii are rounded up to this step
+TILE_MEMORY = 32                      # recently used tiles kept in memory with a spatial index
+
+# When set to a store made by osm_extract.py, elements come from it instead of Overpass
+OFFLINE_DB = os.environ.get("OSM_OFFLINE_DB")
+
+KM_PER_DEGREE = 111.195
+
+# Build the query text for a kind of search around a point
+def build_query(kind, lat, lon, rad):
+    if kind == "poi":
+        # finds amentities, tourism, leisure, and shop tags
+        return f"""
+    [out:json];
+    (
+      node["amenity"](around:{rad * 1000},{lat},{lon});
+      node["tourism"](around:{rad * 1000},{lat},{lon});
+      node["leisure"](around:{rad * 1000},{lat},{lon});
+      node["shop"](around:{rad * 1000},{lat},{lon});
+
+      way["amenity"](around:{rad * 1000},{lat},{lon});
+      way["tourism"](around:{rad * 1000},{lat},{lon});
+      way["leisure"](around:{rad * 1000},{lat},{lon});
+      way["shop"](around:{rad * 1000},{lat},{lon});
+
+      relation["amenity"](around:{rad * 1000},{lat},{lon});
+      relation["tourism"](around:{rad * 1000},{lat},{lon});
+      relation["leisure"](around:{rad * 1000},{lat},{lon});
+      relation["shop"](around:{rad * 1000},{lat},{lon});
+    );
+    out center tags;
+    """
+    if kind == "walkable":
+        # finds roads and paths that are not motorways
+        return f"""
+    [out:json];
+    (
+      way["highway"](around:{rad * 1000},{lat},{lon})
+        ["highway"!~"motorway|motorway_link"];
+    );
+    out center tags;
+    """
+    if kind == "walk_graph":
+        # the same roads and paths with their node ids and the position of every node, for walk_graph.py
+        return f"""
+    [out:json];
+    (
+      way["highway"](around:{rad * 1000},{lat},{lon})
+        ["highway"!~"motorway|motorway_link"];
+    );
+    out body geom;
+    """
+    raise ValueError(f"Unknown query kind: {kind}")
+
+# Send a query to Overpass and return the list of elements
+def download(query, timeout=None, priority=http_client.NORMAL):
+    with instrumentation.stage("overpass_fetch"):
+        response = http_client.get_with_failover(
+            OVERPASS_URLS, params={'data': query},
+            timeout=timeout or http_client.DEFAULT_TIMEOUT, priority=priority
+        )
+    instrumentation.count("overpass_requests")
+    instrumentation.count("overpass_bytes", len(response.content))
+    with instrumentation.stage("json_decode"):
+        return response.json().get('elements', [])
+
+# Get the coordinates of an element, using the center for ways and relations.
+# Ways fetched with their geometry have no center, the middle of their bounding box is used
+def element_coords(el):
+    lat = el.get('lat')
+    lon = el.get('lon')
+    if lat is None or lon is None:
+        center = el.get('center')
+        if center:
+            lat = center.get('lat')
+            lon = center.get('lon')
+    if (lat is None or lon is None) and el.get('geometry'):
+        points = [point for point in el['geometry'] if point]
+        if points:
+            lat = (min(p['lat'] for p in points) + max(p['lat'] for p in points)) / 2
+            lon = (min(p['lon'] for p in points) + max(p['lon'] for p in points)) / 2
+    if lat is None or lon is None:
+        return None
+    return (lat, lon)
+
+# The elements with any part of their geometry within rad km of a point. A long way that passes the
+# point can have the center of its bounding box far outside the circle, so its segments are checked
+# instead: every segment is projected to km around the point and its closest spot is measured
+def near_geometry(elements, lat, lon, rad):
+    x_scale = math.cos(math.radians(lat)) * KM_PER_DEGREE
+    start_lats = []
+    start_lons = []
+    end_lats = []
+    end_lons = []
+    owners = []
+    for i, el in enumerate(elements):
+        points = [point for point in el.get('geometry') or [] if point]
+        # a way with one located node is a segment of length 0
+        for a, b in zip(points, points[1:] or points):
+            start_lats.append(a['lat'])
+            start_lons.append(a['lon'])
+            end_lats.append(b['lat'])
+            end_lons.append(b['lon'])
+            owners.append(i)
+    if not owners:
+        return []
+    x0 = (np.asarray(start_lons) - lon) * x_scale
+    y0 = (np.asarray(start_lats) - lat) * KM_PER_DEGREE
+    dx = (np.asarray(end_lons) - lon) * x_scale - x0
+    dy = (np.asarray(end_lats) - lat) * KM_PER_DEGREE - y0
+    length2 = dx * dx + dy * dy
+    t = np.clip(-(x0 * dx + y0 * dy) / np.where(length2 > 0, length2, 1.0), 0.0, 1.0)
+    near = np.hypot(x0 + t * dx, y0 + t * dy) <= rad
+    return [elements[i] for i in np.unique(np.asarray(owners)[near])]
+
+# Find the tile a point falls in and the radius needed to cover the search circle from the tile center
+def tile_for(lat, lon, rad):
+    tile_lat = math.floor(lat / TILE_SIZE)
+    tile_lon = math.floor(lon / TILE_SIZE)
+    center_lat = (tile_lat + 0.5) * TILE_SIZE
+    center_lon = (tile_lon + 0.5) * TILE_SIZE
+    # the farthest a point in the tile can be from its center
+    half_lat = TILE_SIZE / 2 * KM_PER_DEGREE
+    half_lon = TILE_SIZE / 2 * KM_PER_DEGREE
+    half_diagonal = math.hypot(half_lat, half_lon)
+    fetch_rad = math.ceil((rad + half_diagonal) / RADIUS_STEP) * RADIUS_STEP
+    return tile_lat, tile_lon, center_lat, center_lon, round(fetch_rad, 4)
+
+# Small on-disk cache stored in SQLite with zlib compressed JSON
+class TileCache:
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tiles ("
+                "key TEXT PRIMARY KEY, created REAL, accessed REAL, size INTEGER, data BLOB)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (accessed)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    # Returns the cached elements and the time they were stored, or None when missing or expired
+    def get(self, key):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute("SELECT created, data FROM tiles WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            created, data = row
+            if now - created > self.ttl:
+                conn.execute("DELETE FROM tiles WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE tiles SET accessed = ? WHERE key = ?", (now, key))
+        with instrumentation.stage("json_decode"):
+            return json.loads(zlib.decompress(data)), created
+
+    # Stores the elements and drops the least recently used entries when over the size cap
+    def put(self, key, elements):
+        now = time.time()
+        data = zlib.compress(json.dumps(elements, separators=(',', ':')).encode('utf-8'))
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO tiles (key, created, accessed, size, data) VALUES (?, ?, ?, ?, ?)",
+                (key, now, now, len(data), sqlite3.Binary(data))
+            )
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+            if total > self.max_bytes:
+                rows = conn.execute("SELECT key, size FROM tiles ORDER BY accessed").fetchall()
+                for old_key, size in rows:
+                    if total <= self.max_bytes or old_key == key:
+                        break
+                    conn.execute("DELETE FROM tiles WHERE key = ?", (old_key,))
+                    total -= size
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM tiles")
+
+_cache = None
+_tiles = OrderedDict()
+_tiles_lock = threading.Lock()
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = TileCache(CACHE_PATH)
+    return _cache
+
+# Builds a spatial index over the located elements of a tile and keeps the most recent
+# tiles in memory, so users in the same tile are answered without reading the cache again.
+# created is when the elements were downloaded, so a tile expires from memory when it does on disk
+def tile_index(key, elements=None, created=None):
+    now = time.time()
+    with _tiles_lock:
+        tile = _tiles.get(key)
+        if tile is not None and now - tile[0] <= CACHE_TTL:
+            _tiles.move_to_end(key)
+            return tile[1]
+    if elements is None:
+        return None
+
+    located = []
+    lats = []
+    lons = []
+    for el in elements:
+        coords = element_coords(el)
+        if coords:
+            located.append(el)
+            lats.append(coords[0])
+            lons.append(coords[1])
+    index = SpatialIndex(lats, lons, items=located)
+    with _tiles_lock:
+        _tiles[key] = (now if created is None else created, index)
+        _tiles.move_to_end(key)
+        while len(_tiles) > TILE_MEMORY:
+            _tiles.popitem(last=False)
+    return index
+
+# Spatial index over every element of the tile a point is in, big enough to answer any search of
+# radius rad from inside the tile. Comes from memory, the disk cache, Overpass or the offline store
+def fetch_tile(kind, lat, lon, rad, timeout=None, priority=http_client.NORMAL):
+    tile_lat, tile_lon, center_lat, center_lon, fetch_rad = tile_for(lat, lon, rad)
+    key = f"{kind}:{tile_lat}:{tile_lon}:{fetch_rad}"
+    if OFFLINE_DB:
+        key = f"{OFFLINE_DB}:{key}"
+    index = tile_index(key)
+    if index is not None:
+        instrumentation.count("tile_memory_hits")
+        return index
+    instrumentation.count("tile_memory_misses")
+
+    query = build_query(kind, center_lat, center_lon, fetch_rad)
+    if OFFLINE_DB:
+        import osm_extract
+        elements = osm_extract.get_store(OFFLINE_DB).query(kind, center_lat, center_lon, fetch_rad)
+    elif not CACHE_ENABLED:
+        elements = download(query, timeout=timeout, priority=priority)
+    else:
+        cache = get_cache()
+        cached = cache.get(key)
+        if cached is None:
+            instrumentation.count("tile_cache_misses")
+            elements = download(query, timeout=timeout, priority=priority)
+            cache.put(key, elements)
+        else:
+            instrumentation.count("tile_cache_hits")
+            elements, created = cached
+            return tile_index(key, elements, created)
+    return tile_index(key, elements)
+
+# Find the elements of a kind of search around a point, from the offline store or the tile cache
+def fetch_elements(kind, lat, lon, rad, timeout=None, priority=http_client.NORMAL):
+    if OFFLINE_DB:
+        import osm_extract
+        return osm_extract.get_store(OFFLINE_DB).query(kind, lat, lon, rad)
+
+    if not CACHE_ENABLED:
+        return download(build_query(kind, lat, lon, rad), timeout=timeout, priority=priority)
+
+    # nearby users share a tile, so the tile is fetched with a radius that covers all of them
+    index = fetch_tile(kind, lat, lon, rad, timeout=timeout, priority=priority)
+
+    # only keep the elements that are inside the users own radius, ways of the walking network
+    # are kept when any part of them is, the tile was fetched with Overpass "around" which does the same
+    if kind == "walk_graph":
+        return near_geometry(index.items, lat, lon, rad)
+    return [index.items[i] for i in index.within(lat, lon, rad)]
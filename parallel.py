@@ -0,0 +1,52 @@
+import multiprocessing
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+# Downloads are kept to a few at a time so the public Overpass servers are not flooded
+FETCH_WORKERS = 4
+# Simulations use one process per core
+SIMULATE_WORKERS = os.cpu_count() or 1
+
+# Workers come from a forkserver (spawn where there is none) rather than a plain fork, since
+# forking while the download threads hold locks can leave a child stuck on a lock it never gets back
+def _pool_context():
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+# Workers forked from the same server start with a copy of its random state, so each one is reseeded
+def _seed_worker():
+    random.seed()
+
+# Runs many locations at once. fetch(task) does the network work on a thread pool and
+# simulate(task, fetched) does the CPU work on a process pool, so simulate has to be a
+# module level function. A simulation starts as soon as its download is done, and the
+# results come back in the same order as the tasks, with None for a task that failed
+def run_locations(tasks, fetch, simulate, fetch_workers=FETCH_WORKERS, simulate_workers=SIMULATE_WORKERS):
+    tasks = list(tasks)
+    results = [None] * len(tasks)
+    if not tasks:
+        return results
+
+    with ThreadPoolExecutor(max_workers=fetch_workers) as threads, \
+            ProcessPoolExecutor(max_workers=min(simulate_workers, len(tasks)), mp_context=_pool_context(),
+                                initializer=_seed_worker) as processes:
+        fetches = {threads.submit(fetch, task): i for i, task in enumerate(tasks)}
+        simulations = {}
+        for future in as_completed(fetches):
+            i = fetches[future]
+            try:
+                fetched = future.result()
+            except Exception as e:
+                print(f"Error fetching location {tasks[i]}: {e}")
+                continue
+            simulations[processes.submit(simulate, tasks[i], fetched)] = i
+
+        for future in as_completed(simulations):
+            i = simulations[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                print(f"Error simulating location {tasks[i]}: {e}")
+    return results
@@ -0,0 +1,92 @@
+import numpy as np
+import overpass
+import instrumentation
+from overpass import KM_PER_DEGREE
+
+# Random points on the roads and paths around a user, instead of only the center of every way.
+# A segment of a way is picked with a chance in proportion to its length and the point is put at
+# a uniform spot along it, so every metre of path inside the radius is equally likely.
+# All the points are drawn at once with NumPy, nothing is rejected and nothing is downloaded per point
+
+# The straight pieces between the nodes of the walkable ways, cut to the part inside a circle.
+# ways[i] is the element segment i came from
+class PathSegments:
+    def __init__(self, elements, lat, lon, rad):
+        start_lats = []
+        start_lons = []
+        end_lats = []
+        end_lons = []
+        way_ids = []
+        self.ways = []
+        for el in elements:
+            geometry = el.get('geometry') or []
+            added = False
+            for a, b in zip(geometry, geometry[1:]):
+                if a is None or b is None:
+                    continue
+                start_lats.append(a['lat'])
+                start_lons.append(a['lon'])
+                end_lats.append(b['lat'])
+                end_lons.append(b['lon'])
+                way_ids.append(len(self.ways))
+                added = True
+            if added:
+                self.ways.append(el)
+
+        # km east and north of the user, close enough to flat for a walking radius
+        x_scale = np.cos(np.radians(lat)) * KM_PER_DEGREE
+        x0 = (np.asarray(start_lons, dtype=np.float64) - lon) * x_scale
+        y0 = (np.asarray(start_lats, dtype=np.float64) - lat) * KM_PER_DEGREE
+        dx = (np.asarray(end_lons, dtype=np.float64) - lon) * x_scale - x0
+        dy = (np.asarray(end_lats, dtype=np.float64) - lat) * KM_PER_DEGREE - y0
+
+        # the part of each segment inside the circle is t0..t1 of the way from its start to its end,
+        # where |start + t * (end - start)| = rad
+        a = dx * dx + dy * dy
+        b = 2 * (x0 * dx + y0 * dy)
+        c = x0 * x0 + y0 * y0 - rad * rad
+        disc = b * b - 4 * a * c
+        inside = (disc > 0) & (a > 0)
+        root = np.sqrt(np.where(inside, disc, 0.0))
+        safe_a = np.where(inside, a, 1.0)
+        t0 = np.clip((-b - root) / (2 * safe_a), 0.0, 1.0)
+        t1 = np.clip((-b + root) / (2 * safe_a), 0.0, 1.0)
+        keep = inside & (t1 > t0)
+
+        self.x0 = x0[keep] + t0[keep] * dx[keep]
+        self.y0 = y0[keep] + t0[keep] * dy[keep]
+        self.dx = (t1[keep] - t0[keep]) * dx[keep]
+        self.dy = (t1[keep] - t0[keep]) * dy[keep]
+        self.way_ids = np.asarray(way_ids, dtype=np.int64)[keep]
+        self.lat = lat
+        self.lon = lon
+        self.x_scale = x_scale
+        self.cumulative = np.cumsum(np.hypot(self.dx, self.dy))
+
+    def __len__(self):
+        return len(self.way_ids)
+
+    # Total length in km of the paths inside the circle
+    def length(self):
+        return float(self.cumulative[-1]) if len(self) else 0.0
+
+    # count points spread uniformly over the length of the paths.
+    # Returns their latitudes, longitudes and the index in ways of the way each one is on
+    def sample(self, count, rng=None):
+        if rng is None:
+            rng = np.random.default_rng()
+        if not len(self) or self.length() <= 0:
+            return np.empty(0), np.empty(0), np.empty(0, dtype=np.int64)
+        segment = np.searchsorted(self.cumulative, rng.random(count) * self.cumulative[-1], side='right')
+        segment = np.minimum(segment, len(self) - 1)
+        t = rng.random(count)
+        x = self.x0[segment] + t * self.dx[segment]
+        y = self.y0[segment] + t * self.dy[segment]
+        return self.lat + y / KM_PER_DEGREE, self.lon + x / self.x_scale, self.way_ids[segment]
+
+# The path segments within rad km of a point. Every way with any part inside the circle is
+# fetched, even when its center is far outside, and PathSegments cuts it to the circle
+@instrumentation.timed("candidates")
+def fetch_segments(lat, lon, rad):
+    elements = overpass.fetch_elements("walk_graph", lat, lon, rad)
+    return PathSegments(elements, lat, lon, rad)
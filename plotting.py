@@ -0,0 +1,87 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import instrumentation
+
+# Longest curve drawn point for point, longer ones are decimated down to about this many points
+MAX_POINTS = 2000
+# Points are only drawn with markers when a curve has at most this many
+MARKER_LIMIT = 100
+
+# Indices of a min/max decimation of values. The values are split into buckets and the smallest
+# and largest value of each bucket are kept, so spikes still show up in the plot
+def decimate(values, max_points=MAX_POINTS):
+    values = np.asarray(values, dtype=np.float64)
+    n = len(values)
+    if n <= max_points:
+        return np.arange(n)
+    buckets = max(1, max_points // 2)
+    size = -(-n // buckets)
+    padded = np.full(buckets * size, np.nan)
+    padded[:n] = values
+    padded = padded.reshape(buckets, size)
+    used = ~np.isnan(padded).all(axis=1)
+    starts = np.arange(buckets)[used] * size
+    lows = starts + np.nanargmin(padded[used], axis=1)
+    highs = starts + np.nanargmax(padded[used], axis=1)
+    return np.unique(np.concatenate([[0, n - 1], lows, highs]))
+
+# A figure that draws straight to the Agg backend, without pyplot or any window
+def new_figure(figsize):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+# Plots a metric against the run number, runs start at 1
+def plot_runs(ax, values, **style):
+    index = decimate(values)
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) > MARKER_LIMIT:
+        style.pop('marker', None)
+    ax.plot(index + 1, values[index], **style)
+
+# One axes with several curves, curves are (values, style) pairs where style holds the plot arguments
+@instrumentation.timed("render_graph")
+def save_curves(path, curves, title, xlabel, ylabel, figsize=(10, 6), dpi=100):
+    fig = new_figure(figsize)
+    ax = fig.add_subplot(1, 1, 1)
+    for values, style in curves:
+        plot_runs(ax, values, **style)
+    ax.set_title(title, fontsize=14)
+    ax.set_xlabel(xlabel, fontsize=12)
+    ax.set_ylabel(ylabel, fontsize=12)
+    ax.grid(True, linestyle='--', alpha=0.7)
+    ax.legend()
+    fig.savefig(path, dpi=dpi)
+
+# Side by side axes with one curve each, panels are (values, style, title, xlabel, ylabel)
+@instrumentation.timed("render_graph")
+def save_panels(path, panels, figsize=(12, 5), dpi=100):
+    fig = new_figure(figsize)
+    for i, (values, style, title, xlabel, ylabel) in enumerate(panels):
+        ax = fig.add_subplot(1, len(panels), i + 1)
+        plot_runs(ax, values, **style)
+        ax.set_title(title)
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+    fig.tight_layout()
+    fig.savefig(path, dpi=dpi)
+
+def _render(job):
+    function, args = job
+    function(*args)
+
+# Renders many figures at once on a process pool, jobs are (function, args) pairs
+# of module level functions such as save_curves and save_panels
+@instrumentation.timed("render_graph")
+def render_batch(jobs, workers=None):
+    jobs = list(jobs)
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if workers <= 1:
+        for job in jobs:
+            _render(job)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(_render, jobs))
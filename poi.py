@@ -1,18 +1,19 @@
-import folium
-from geopy.geocoders import Nominatim
-from folium import Circle
-import webbrowser
 import os
-import requests
+import overpass
+import simulation
+import montecarlo
+import distance
+import geocode
 import re
-import random
 from collections import defaultdict
 import warnings
 import numpy as np
-import matplotlib.pyplot as plt
+import display
+import maps
+import plotting
+import results
+import instrumentation
 
-# Using the Overpass API for mapping
-OVERPASS_URL = "http://overpass-api.de/api/interpreter"
 os.environ["OMP_NUM_THREADS"] = "1"
 warnings.filterwarnings(
     "ignore",
@@ -20,46 +21,26 @@ warnings.filterwarnings(
     category=UserWarning
 )
 
+# Set DATAPRIVACY_MONTE_CARLO_TRIALS to also estimate the final utility and privacy over that many
+# independent trials, DATAPRIVACY_MONTE_CARLO_SEED makes the estimate repeatable
+MONTE_CARLO_TRIALS = int(os.environ.get("DATAPRIVACY_MONTE_CARLO_TRIALS", "0"))
+MONTE_CARLO_SEED = os.environ.get("DATAPRIVACY_MONTE_CARLO_SEED")
+MONTE_CARLO_SEED = int(MONTE_CARLO_SEED) if MONTE_CARLO_SEED else None
+
 # Generate coordinates from an address
 def GetCoordinates(address):
-    geolocator = Nominatim(user_agent="geoapi")
-    location = geolocator.geocode(address)
-    if location:
-        return (location.latitude, location.longitude)
-    else:
-        return None
+    return geocode.get_coordinates(address)
 
 # Using coordinates, find POIs using a query
+@instrumentation.timed("candidates")
 def FindPOIs(lat, lon, rad):
 
     # Query for amenity, tourism, leisure, and shop tags
-    query = f"""
-    [out:json];
-    (
-      node["amenity"](around:{rad * 1000},{lat},{lon});
-      node["tourism"](around:{rad * 1000},{lat},{lon});
-      node["leisure"](around:{rad * 1000},{lat},{lon});
-      node["shop"](around:{rad * 1000},{lat},{lon});
-
-      way["amenity"](around:{rad * 1000},{lat},{lon});
-      way["tourism"](around:{rad * 1000},{lat},{lon});
-      way["leisure"](around:{rad * 1000},{lat},{lon});
-      way["shop"](around:{rad * 1000},{lat},{lon});
-
-      relation["amenity"](around:{rad * 1000},{lat},{lon});
-      relation["tourism"](around:{rad * 1000},{lat},{lon});
-      relation["leisure"](around:{rad * 1000},{lat},{lon});
-      relation["shop"](around:{rad * 1000},{lat},{lon});
-    );
-    out center tags;
-    """
-
-    response = requests.get(OVERPASS_URL, params={'data': query})
-    data = response.json()
+    elements = overpass.fetch_elements("poi", lat, lon, rad)
     pois = []
 
     # Parse the JSON file to put POIs in a list
-    for el in data['elements']:
+    for el in elements:
         name = el.get('tags', {}).get('name', 'Unnamed POI')
         lat = el.get('lat')
         lon = el.get('lon')
@@ -74,6 +55,7 @@ def FindPOIs(lat, lon, rad):
             category = ', '.join([f"{k}={v}" for k, v in el.get('tags', {}).items() if k != 'name'])
             pois.append(f"{name} at ({lat}, {lon}) [{category}]")
 
+    instrumentation.count("pois_found", len(pois))
     return pois
 
 # Get coordinates from a POI's text name
@@ -95,8 +77,30 @@ def ParsePOI(poi):
         print("Failed to parse:", poi)
         return "Unknown", "0", "0"
 
-# Create the html map of the chosen location and the found POIs
-def CreateMap(lat, lon, rad, pois, poi_counter, noise):
+# Apply noise to every time a POI was chosen to generate the suggested points,
+# the noise for all the times a POI was chosen is drawn at once
+def AddNoise(poi_counter, noise, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
+    offset_lats = []
+    offset_lons = []
+    for poi, count in poi_counter.items():
+        if count == 0:
+            continue
+        name, latStr, lonStr = ParsePOI(poi)
+        offsets = rng.uniform(-noise, noise, size=(count, 2))
+        offset_lats.append(float(latStr) + offsets[:, 0])
+        offset_lons.append(float(lonStr) + offsets[:, 1])
+    if not offset_lats:
+        return []
+    return list(zip(np.concatenate(offset_lats).tolist(), np.concatenate(offset_lons).tolist()))
+
+# Create the html map of the chosen location and the noisy POI points
+# map_mode is one of maps.MAP_MODES, many noisy points are drawn as a cluster or heatmap
+@instrumentation.timed("render_map")
+def CreateMap(lat, lon, rad, poi_counter, offset_points, map_mode=None):
+    import folium
+    from folium import Circle
     Map = folium.Map(location=[lat, lon], zoom_start=13)
     folium.Marker([lat, lon], popup="Selected Location").add_to(Map)
 
@@ -109,18 +113,9 @@ def CreateMap(lat, lon, rad, pois, poi_counter, noise):
         fill_opacity=0.3
     ).add_to(Map)
 
-    offset_points = []
-
-    # Take all the found POIs and apply noise to them to generate the point
-    for poi in pois:
-        name, latStr, lonStr = ParsePOI(poi)
-        latF = float(latStr)
-        lonF = float(lonStr)
-
-        #NOISE = 0.002
-        for x in range(poi_counter[poi]):
-            offset_lat = latF + random.uniform(-noise, noise)
-            offset_lon = lonF + random.uniform(-noise, noise)
+    mode = maps.choose_mode(len(offset_points), map_mode)
+    if mode == "markers":
+        for offset_lat, offset_lon in offset_points:
             folium.CircleMarker(
                 location=[offset_lat, offset_lon],
                 radius=2,
@@ -128,42 +123,88 @@ def CreateMap(lat, lon, rad, pois, poi_counter, noise):
                 fill=True,
                 fill_opacity=1
             ).add_to(Map)
-            offset_points.append((offset_lat, offset_lon))               
+    else:
+        maps.add_layer(Map, mode, [p[0] for p in offset_points], [p[1] for p in offset_points])
 
     Map.save("POI_Map.html")
-    webbrowser.open('file://' + os.path.realpath("POI_Map.html"))
-
-    # Write to a text file all the found POIs
-    with open("POIs.txt", "w", encoding="utf-8") as file:
-        file.write("Random POI's with noise: (lat, lon): \n")
-        for offset_lat, offset_lon in offset_points:
-            file.write(f"({offset_lat}, {offset_lon})\n")
-
-    # Write to a text file all the POIs that were selected and how many times they were
-    with open("Chosen_POIs.txt", "w", encoding="utf-8") as file:
-        sorted_pois = sorted(poi_counter.items(), key=lambda x: x[1], reverse=True)
-        for poi, count in sorted_pois:
-            if count > 0:
-                name, lat_str, lon_str = ParsePOI(poi)
-                file.write(f"{name} ({lat_str}, {lon_str})\n")
+    display.open_map("POI_Map.html")
+
+    with instrumentation.stage("write_results"):
+        # Write to a text file all the found POIs
+        lines = ["Random POI's with noise: (lat, lon): "]
+        lines += [f"({offset_lat}, {offset_lon})" for offset_lat, offset_lon in offset_points]
+        with open("POIs.txt", "w", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+
+        # Write to a text file all the POIs that were selected and how many times they were
+        with open("Chosen_POIs.txt", "w", encoding="utf-8") as file:
+            sorted_pois = sorted(poi_counter.items(), key=lambda x: x[1], reverse=True)
+            for poi, count in sorted_pois:
+                if count > 0:
+                    name, lat_str, lon_str = ParsePOI(poi)
+                    file.write(f"{name} ({lat_str}, {lon_str})\n")
 
 # Harversine formula for finding the distance between two coordinates
 # https://www.geeksforgeeks.org/haversine-formula-to-find-distance-between-two-points-on-a-sphere/
 def CalculateDistance(lat1, lon1, lat2, lon2):
-    R = 6371.0
-    lat1_rad = np.radians(lat1)
-    lon1_rad = np.radians(lon1)
-    lat2_rad = np.radians(lat2)
-    lon2_rad = np.radians(lon2)
+    return distance.haversine(lat1, lon1, lat2, lon2)
 
-    dlon = lon2_rad - lon1_rad
-    dlat = lat2_rad - lat1_rad
+# Runs the POI method for a location and returns the chosen POIs, the noisy suggested
+# points and the utility and privacy after every run, or None when no POIs are found.
+# POIs that were already found can be passed in to skip the query
+def RunPOI(coords, radius, noise, num_runs, pois=None, rng=None):
+    # Find all POIs within the given radius
+    if pois is None:
+        pois = FindPOIs(coords[0], coords[1], radius)
+    if not pois:
+        return None
 
-    a = np.sin(dlat / 2) ** 2 + np.cos(lat1_rad) * np.cos(lat2_rad) * np.sin(dlon / 2) ** 2
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    # the same POI text can show up more than once, it is counted as one POI
+    keys = list(dict.fromkeys(pois))
+    key_index = {key: i for i, key in enumerate(keys)}
+    ids = np.array([key_index[poi] for poi in pois], dtype=np.int64)
+    lats = []
+    lons = []
+    for key in keys:
+        name, latStr, lonStr = ParsePOI(key)
+        lats.append(float(latStr))
+        lons.append(float(lonStr))
+
+    # Picks a POI for every iteration at once. Both metrics are over the distinct POIs
+    # chosen so far, so a POI only adds to them the first time it is chosen
+    if rng is None:
+        rng = np.random.default_rng()
+    choices = ids[rng.integers(0, len(pois), size=num_runs)]
+    utility_values, privacy_values = simulation.curves(lats, lons, coords[0], coords[1], choices, distinct=True)
 
-    distance = R * c
-    return distance    
+    poi_counter = defaultdict(int)
+    for choice, count in zip(*simulation.first_picks(choices)):
+        poi_counter[keys[choice]] = int(count)
+
+    return {
+        "pois": pois,
+        "poi_counter": poi_counter,
+        "noisy_points": AddNoise(poi_counter, noise, rng),
+        "utility": utility_values.tolist(),
+        "privacy": privacy_values.tolist(),
+        "lats": lats,
+        "lons": lons,
+        # how many times each POI was found, a POI found twice is picked twice as often
+        "weights": np.bincount(ids, minlength=len(keys)),
+    }
+
+# The utility and privacy panels of the graph
+def GraphPanels(utility_values, privacy_values):
+    return [
+        (utility_values, dict(marker='o', color='green'), 'Utility vs Iteration', 'Iteration',
+         'Utility (Avg Distance to Chosen POIs)'),
+        (privacy_values, dict(marker='o', color='red'), 'Privacy vs Iteration', 'Iteration',
+         'Privacy (Distance to Centroid of POIs)'),
+    ]
+
+# Plot the privacy and utility vs iteration, the graph is saved to path
+def CreateGraph(utility_values, privacy_values, path="POI_Utility_Privacy_Graph"):
+    plotting.save_panels(path, GraphPanels(utility_values, privacy_values))
 
 def Main():
     # From the user get an address or coordinates for their chosen location
@@ -207,66 +248,31 @@ def Main():
         print("Invalid number of runs")
         return
 
-    # Find all POIs within the given radius
-    pois = FindPOIs(coords[0], coords[1], radius)
-    if not pois:
+    result = RunPOI(coords, radius, noise, num_runs)
+    if result is None:
         print("No POIs found.")
         return
 
-    poi_counter = defaultdict(int)
-    utility_values = []
-    privacy_values = []
-
-    # For each iteration, calculate the privacy and utility values and save them
-    for x in range(num_runs):
-        chosen = random.choice(pois)
-        poi_counter[chosen] += 1
-
-        utility = 0.0
-        privacy = 0.0
-
-        # Utility is average distance from all current POIs in the iteration to the chosen location
-        for poi, count in poi_counter.items():
-            name, latStr, lonStr = ParsePOI(poi)
-            latF = float(latStr)
-            lonF = float(lonStr)
-            dist = CalculateDistance(coords[0], coords[1], latF, lonF)
-            utility += dist / len(poi_counter)
-        
-        # Privacy is the distance from the centroid of all current POIs in the iteration to the chosen location
-        centroid_lat = sum(float(ParsePOI(poi)[1]) for poi in poi_counter) / len(poi_counter)
-        centroid_lon = sum(float(ParsePOI(poi)[2]) for poi in poi_counter) / len(poi_counter)
-        privacy = CalculateDistance(coords[0], coords[1], centroid_lat, centroid_lon)
-
-        utility_values.append(utility)
-        privacy_values.append(privacy)
-
-        print(f"Iteration {x + 1}")
-        print(f"Privacy = {privacy}")
-        print(f"Utility = {utility}")
-        print("")
+    results.print_runs(
+        f"Iteration {x + 1}\nPrivacy = {privacy}\nUtility = {utility}\n"
+        for x, (utility, privacy) in enumerate(zip(result["utility"], result["privacy"]))
+    )
 
     # Create the map
-    CreateMap(coords[0], coords[1], radius, pois, poi_counter, noise)
+    CreateMap(coords[0], coords[1], radius, result["poi_counter"], result["noisy_points"])
 
     # Plot the privacy and utility vs iteration
-    plt.figure(figsize=(12, 5))
-
-    plt.subplot(1, 2, 1)
-    plt.plot(range(1, num_runs + 1), utility_values, marker='o', color='green')
-    plt.title('Utility vs Iteration')
-    plt.xlabel('Iteration')
-    plt.ylabel('Utility (Avg Distance to Chosen POIs)')
-
-    plt.subplot(1, 2, 2)
-    plt.plot(range(1, num_runs + 1), privacy_values, marker='o', color='red')
-    plt.title('Privacy vs Iteration')
-    plt.xlabel('Iteration')
-    plt.ylabel('Privacy (Distance to Centroid of POIs)')
+    CreateGraph(result["utility"], result["privacy"])
 
-    plt.tight_layout()
-    plt.savefig("POI_Utility_Privacy_Graph")
-    plt.show()
+    # Run many more trials of the same location, each POI only counts once like in the runs above
+    if MONTE_CARLO_TRIALS:
+        estimate = montecarlo.estimate(
+            result["lats"], result["lons"], coords[0], coords[1], num_runs, MONTE_CARLO_TRIALS,
+            distinct=True, seed=MONTE_CARLO_SEED, weights=result["weights"]
+        )
+        for line in montecarlo.report_lines(estimate):
+            print(line)
 
 if __name__ == "__main__":
     Main()
+    instrumentation.save()
@@ -0,0 +1,113 @@
+import os
+import numpy as np
+import instrumentation
+from obfuscation import LocationKey
+
+# File formats the run results can be saved in, picked from the file extension
+FORMATS = {".csv": "csv", ".npz": "npz", ".parquet": "parquet"}
+
+# When quiet, the scripts skip the lines they print for every run.
+# Set DATAPRIVACY_QUIET=1, or quiet=true in hybrid_day_in_life.txt
+QUIET = os.environ.get("DATAPRIVACY_QUIET", "0").strip().lower() not in ("", "0", "false", "no")
+
+def set_quiet(quiet=True):
+    global QUIET
+    QUIET = quiet
+
+def format_for(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in FORMATS:
+        raise ValueError(f"Unknown results format {ext}, use one of {', '.join(FORMATS)}")
+    return FORMATS[ext]
+
+# Prints the lines of every run in one write instead of a print call per line
+def print_runs(lines):
+    if QUIET:
+        return
+    text = "\n".join(lines)
+    if text:
+        print(text)
+
+# Collects the runs of one or more users in memory and saves them in one go as columns:
+# user, run, location id, utility and privacy. Location ids point into the locations table,
+# which is saved with the runs (as name, lat, lon and type columns in .npz, as a dictionary
+# encoded location column in Parquet, and as the location text in .csv).
+# Parquet needs the optional pyarrow package
+class ResultsWriter:
+    def __init__(self, path):
+        self.path = path
+        self.format = format_for(path)
+        self.locations = []
+        self._columns = {"user": [], "run": [], "location": [], "utility": [], "privacy": []}
+
+    # Adds the runs of a user, choices are indices into that user's locations
+    def add(self, locations, choices, utility, privacy, user=0):
+        choices = np.asarray(choices, dtype=np.int64)
+        offset = len(self.locations)
+        self.locations.extend(locations)
+        self._columns["user"].append(np.full(len(choices), user, dtype=np.int32))
+        self._columns["run"].append(np.arange(1, len(choices) + 1, dtype=np.int64))
+        self._columns["location"].append((choices + offset).astype(np.int64))
+        self._columns["utility"].append(np.asarray(utility, dtype=np.float64))
+        self._columns["privacy"].append(np.asarray(privacy, dtype=np.float64))
+
+    def columns(self):
+        return {
+            name: np.concatenate(parts) if parts else np.empty(0)
+            for name, parts in self._columns.items()
+        }
+
+    @instrumentation.timed("write_results")
+    def write(self):
+        columns = self.columns()
+        if self.format == "npz":
+            self._write_npz(columns)
+        elif self.format == "parquet":
+            self._write_parquet(columns)
+        else:
+            self._write_csv(columns)
+        instrumentation.count("results_bytes", os.path.getsize(self.path))
+
+    def _write_npz(self, columns):
+        np.savez(
+            self.path,
+            **columns,
+            location_name=np.array([str(loc[0]) for loc in self.locations]),
+            location_lat=np.array([float(loc[1]) for loc in self.locations]),
+            location_lon=np.array([float(loc[2]) for loc in self.locations]),
+            location_type=np.array([str(loc[3]) for loc in self.locations]),
+        )
+
+    def _write_parquet(self, columns):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Saving results as .parquet needs pyarrow (pip install pyarrow), or use .npz")
+        table = pa.table({
+            **columns,
+            "location_key": pa.DictionaryArray.from_arrays(
+                pa.array(columns["location"].astype(np.int32)),
+                pa.array([LocationKey(loc) for loc in self.locations], type=pa.string()),
+            ),
+        })
+        pq.write_table(table, self.path)
+
+    # The same columns hybrid_data.csv always had, with a User column first when there is more than one user
+    def _write_csv(self, columns):
+        keys = [LocationKey(loc).replace('"', '""') for loc in self.locations]
+        many_users = len(self._columns["user"]) > 1
+        header = "Run,Location,Utility(km),Privacy(km)"
+        lines = [f"User,{header}" if many_users else header]
+        for user, run, location, utility, privacy in zip(
+                columns["user"].tolist(), columns["run"].tolist(), columns["location"].tolist(),
+                columns["utility"].tolist(), columns["privacy"].tolist()):
+            line = f'{run},"{keys[location]}",{utility:.4f},{privacy:.4f}'
+            lines.append(f"{user},{line}" if many_users else line)
+        with open(self.path, "w", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+
+# Reads a .npz results file back as a dict of columns
+def read_npz(path):
+    with np.load(path) as data:
+        return {name: data[name] for name in data.files}
@@ -0,0 +1,287 @@
+import asyncio
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+import overpass
+import candidate_grid
+import obfuscation
+import http_client
+import instrumentation
+from spatial_index import SpatialIndex
+
+# Settings for the pickup point service, all can be set from the environment
+SERVICE_HOST = os.environ.get("SERVICE_HOST", "127.0.0.1")
+SERVICE_PORT = int(os.environ.get("SERVICE_PORT", "8080"))
+SERVICE_WORKERS = int(os.environ.get("SERVICE_WORKERS", "8"))
+CANDIDATE_GRID = os.environ.get("CANDIDATE_GRID")
+# With SERVICE_CLUSTER_K set, users in dense areas get about that many candidates, one per cluster
+# of the candidates of their tile (see clustering.coarse_tier)
+SERVICE_CLUSTER_K = int(os.environ.get("SERVICE_CLUSTER_K", "0"))
+WARM_TILES = 256        # tiles of candidates kept in memory
+MAX_RADIUS = 5.0        # km, largest radius a request can ask for
+DEFAULT_RADIUS = 1.0
+
+# Latency goals for a request whose tile is already in memory, reported by /stats
+P50_TARGET_MS = float(os.environ.get("SERVICE_P50_MS", "5"))
+P99_TARGET_MS = float(os.environ.get("SERVICE_P99_MS", "50"))
+LATENCY_WINDOW = 10000  # most recent requests used for the percentiles
+
+# Candidate locations of recently used tiles, each with a spatial index for the POIs and one for
+# the walkable locations, so a request only looks at the candidates near the user.
+# Safe to use from many threads, and only one thread loads a tile when several ask for it at once
+class CandidateStore:
+    def __init__(self, grid_path=None, max_tiles=WARM_TILES, cluster_k=SERVICE_CLUSTER_K):
+        self.grid = candidate_grid.CandidateGrid(grid_path) if grid_path else None
+        self.max_tiles = max_tiles
+        self.cluster_k = cluster_k
+        self.hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def _load(self, lat, lon, radius):
+        # high priority, a user is waiting on this download
+        pois, walkable = obfuscation.TileLocations(lat, lon, radius, priority=http_client.HIGH)
+        return SpatialIndex.from_locations(pois), SpatialIndex.from_locations(walkable), pois + walkable
+
+    # The (pois, walkable, every candidate) indexes and list covering a search of radius km from the point
+    def tile(self, lat, lon, radius):
+        tile_lat, tile_lon, _, _, fetch_rad = overpass.tile_for(lat, lon, radius)
+        key = (tile_lat, tile_lon, fetch_rad)
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                instrumentation.count("service_tile_hits")
+                return self._tiles[key]
+            future = self._loading.get(key)
+            loading = future is None
+            if loading:
+                future = Future()
+                self._loading[key] = future
+                self.misses += 1
+                instrumentation.count("service_tile_misses")
+        if not loading:
+            return future.result()
+
+        try:
+            indexes = self._load(lat, lon, radius)
+        except Exception as e:
+            with self._lock:
+                del self._loading[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._tiles[key] = indexes
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+            del self._loading[key]
+        future.set_result(indexes)
+        return indexes
+
+    # The locations hybrid.py would pick from for a user, using the candidate grid when it covers them.
+    # With cluster_k the cluster centers of the tile are shared with hybrid.py through the center cache
+    def candidates(self, lat, lon, radius):
+        if self.grid is not None and self.grid.covers(lat, lon, radius):
+            locations = self.grid.candidates(lat, lon)
+            area = None
+        else:
+            poi_index, walkable_index, area = self.tile(lat, lon, radius)
+            locations = [poi_index.items[i] for i in poi_index.within(lat, lon, radius)]
+            if len(locations) < obfuscation.POI_THRESHOLD:
+                walkable = [walkable_index.items[i] for i in walkable_index.within(lat, lon, radius)]
+                locations = obfuscation.ChooseLocations(locations, walkable)
+        if self.cluster_k and len(locations) > self.cluster_k:
+            locations = obfuscation.CoarseLocations((lat, lon), radius, locations, self.cluster_k, self.grid, area)
+        return locations
+
+    # A random pickup point for the user, or None when there is nothing nearby
+    def suggest(self, lat, lon, radius):
+        locations = self.candidates(lat, lon, radius)
+        if not locations:
+            return None
+        name, loc_lat, loc_lon, loc_type = locations[secrets.randbelow(len(locations))]
+        return {"name": name, "lat": float(loc_lat), "lon": float(loc_lon), "type": loc_type,
+                "candidates": len(locations)}
+
+# Request latencies of the most recent requests
+class LatencyStats:
+    def __init__(self, window=LATENCY_WINDOW):
+        self.count = 0
+        self._times = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, ms):
+        with self._lock:
+            self.count += 1
+            self._times.append(ms)
+
+    def summary(self):
+        with self._lock:
+            times = np.array(self._times, dtype=np.float64)
+            count = self.count
+        p50, p99 = np.percentile(times, [50, 99]) if len(times) else (0.0, 0.0)
+        return {
+            "requests": count,
+            "p50_ms": round(float(p50), 3),
+            "p99_ms": round(float(p99), 3),
+            "p50_target_ms": P50_TARGET_MS,
+            "p99_target_ms": P99_TARGET_MS,
+            "meets_targets": bool(p50 <= P50_TARGET_MS and p99 <= P99_TARGET_MS),
+        }
+
+class BadRequest(Exception):
+    pass
+
+def _number(query, name, default=None, low=None, high=None):
+    values = query.get(name)
+    if not values:
+        if default is None:
+            raise BadRequest(f"missing {name}")
+        return default
+    try:
+        value = float(values[0])
+    except ValueError:
+        raise BadRequest(f"{name} must be a number")
+    if not np.isfinite(value) or (low is not None and value < low) or (high is not None and value > high):
+        raise BadRequest(f"{name} is out of range")
+    return value
+
+# reads a request body and drops it, none of the endpoints use one, so the next request on the
+# connection starts in the right place. Returns an error when the length of the body is not known
+async def _discard_body(reader, headers):
+    if "transfer-encoding" in headers:
+        return "request bodies must have a Content-Length"
+    try:
+        remaining = int(headers.get("content-length", "0"))
+    except ValueError:
+        return "bad Content-Length"
+    if remaining < 0:
+        return "bad Content-Length"
+    while remaining:
+        chunk = await reader.read(min(remaining, 65536))
+        if not chunk:
+            raise asyncio.IncompleteReadError(b"", remaining)
+        remaining -= len(chunk)
+    return None
+
+# HTTP/1.1 service on asyncio. The lookups run on a thread pool so a tile being downloaded
+# never holds up requests for tiles that are already in memory. Only the tile and cluster
+# caches are written to files, no request or location is saved
+class ObfuscationService:
+    def __init__(self, store=None, workers=SERVICE_WORKERS):
+        self.store = store or CandidateStore(CANDIDATE_GRID)
+        self.stats = LatencyStats()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    async def obfuscate(self, query):
+        lat = _number(query, "lat", low=-90, high=90)
+        lon = _number(query, "lon", low=-180, high=180)
+        radius = _number(query, "radius", DEFAULT_RADIUS, low=0.01, high=MAX_RADIUS)
+        loop = asyncio.get_running_loop()
+        suggestion = await loop.run_in_executor(self.executor, self.store.suggest, lat, lon, radius)
+        if suggestion is None:
+            return 404, {"error": "no locations found within the radius"}
+        return 200, suggestion
+
+    async def route(self, method, target):
+        url = urlsplit(target)
+        if method != "GET":
+            return 405, {"error": "only GET is supported"}
+        if url.path == "/obfuscate":
+            start = time.perf_counter()
+            try:
+                return await self.obfuscate(parse_qs(url.query))
+            finally:
+                elapsed = time.perf_counter() - start
+                self.stats.add(elapsed * 1000)
+                instrumentation.record("service_request", elapsed)
+        if url.path == "/stats":
+            summary = self.stats.summary()
+            summary.update({"tile_hits": self.store.hits, "tile_misses": self.store.misses})
+            return 200, summary
+        if url.path == "/metrics":
+            summary = self.stats.summary()
+            return 200, instrumentation.prometheus_text({
+                "service_p50_seconds": summary["p50_ms"] / 1000, "service_p99_seconds": summary["p99_ms"] / 1000,
+            })
+        if url.path == "/health":
+            return 200, {"status": "ok"}
+        return 404, {"error": "not found"}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body_error = await _discard_body(reader, headers)
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                except ValueError:
+                    status, body, version = 400, {"error": "bad request line"}, "HTTP/1.0"
+                else:
+                    if body_error:
+                        # the rest of the connection can not be read, so it is closed after the answer
+                        status, body, version = 400, {"error": body_error}, "HTTP/1.0"
+                    else:
+                        try:
+                            status, body = await self.route(method, target)
+                        except BadRequest as e:
+                            status, body = 400, {"error": str(e)}
+                        except Exception as e:
+                            status, body = 502, {"error": f"could not load locations: {e}"}
+
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                # /metrics answers with Prometheus text, everything else with JSON
+                if isinstance(body, str):
+                    payload, content_type = body.encode("utf-8"), "text/plain; version=0.0.4"
+                else:
+                    payload, content_type = json.dumps(body).encode("utf-8"), "application/json"
+                writer.write(
+                    f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(payload)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + payload
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=SERVICE_HOST, port=SERVICE_PORT):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving pickup points on http://{host}:{port}/obfuscate?lat=..&lon=..&radius=..")
+        async with server:
+            await server.serve_forever()
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 502: "Bad Gateway"}
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else SERVICE_PORT
+    host = sys.argv[2] if len(sys.argv) > 2 else SERVICE_HOST
+    try:
+        asyncio.run(ObfuscationService().serve(host, port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import numpy as np
+import distance
+import instrumentation
+
+# Privacy and utility after every run for a sequence of chosen locations, as arrays.
+# choices are indices into lats / lons. The centroid after each run comes from cumulative
+# sums, so the whole curve takes a few NumPy calls instead of a Python loop per run.
+# With distinct=True a location only counts the first time it is chosen (poi.py's metrics).
+# user_dist can hold the distance from the user to every location when it is already known
+@instrumentation.timed("simulation")
+def curves(lats, lons, user_lat, user_lon, choices, distinct=False, user_dist=None):
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    choices = np.asarray(choices, dtype=np.int64)
+    if user_dist is None:
+        user_dist = distance.one_to_many(user_lat, user_lon, lats, lons)
+    else:
+        user_dist = np.asarray(user_dist, dtype=np.float64)
+
+    chosen_lats = lats[choices]
+    chosen_lons = lons[choices]
+    chosen_dist = user_dist[choices]
+    if distinct:
+        # keep only the first time each location shows up
+        first = np.zeros(len(choices), dtype=bool)
+        first[np.unique(choices, return_index=True)[1]] = True
+        chosen_lats = np.where(first, chosen_lats, 0.0)
+        chosen_lons = np.where(first, chosen_lons, 0.0)
+        chosen_dist = np.where(first, chosen_dist, 0.0)
+        count = np.cumsum(first)
+    else:
+        count = np.arange(1, len(choices) + 1)
+
+    centroid_lats = np.cumsum(chosen_lats) / count
+    centroid_lons = np.cumsum(chosen_lons) / count
+    # Utility is the average distance from the user to the chosen locations
+    utility = np.cumsum(chosen_dist) / count
+    # Privacy is the distance from the user to the centroid of the chosen locations
+    privacy = distance.haversine(user_lat, user_lon, centroid_lats, centroid_lons)
+    return utility, privacy
+
+# Picks a random location for every run and works out the privacy and utility curves.
+# rng is a NumPy Generator, a fresh one is made when it is not given.
+# Returns the chosen indices, the utility and privacy after every run, and how many
+# times each location was picked
+@instrumentation.timed("simulation")
+def simulate(lats, lons, user_lat, user_lon, num_runs, rng=None, distinct=False, user_dist=None):
+    if rng is None:
+        rng = np.random.default_rng()
+    n = len(lats)
+    choices = rng.integers(0, n, size=num_runs)
+    utility, privacy = curves(lats, lons, user_lat, user_lon, choices, distinct, user_dist)
+    return {
+        "choices": choices,
+        "utility": utility,
+        "privacy": privacy,
+        "counts": np.bincount(choices, minlength=n),
+    }
+
+# The chosen indices in the order they were first picked, with how many times each was picked
+def first_picks(choices):
+    unique, first, counts = np.unique(choices, return_index=True, return_counts=True)
+    order = np.argsort(first)
+    return unique[order], counts[order]
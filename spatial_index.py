@@ -0,0 +1,187 @@
+import math
+import numpy as np
+import distance
+
+KM_PER_DEGREE = 111.195
+# Default width of a grid cell in km, about the smallest search radius the scripts use
+CELL_KM = 0.25
+# Projected distances are only a close approximation of haversine, this keeps the
+# nearest neighbour search from stopping a ring too early
+SLACK = 0.99
+
+# Uniform grid over a set of candidate locations for radius and nearest queries.
+# Points are projected to km around the middle of the set and sorted by grid cell,
+# so a query only looks at the cells near it instead of every location.
+# items can hold the original locations, index.items[i] matches index i
+class SpatialIndex:
+    def __init__(self, lats, lons, items=None, cell_km=CELL_KM):
+        self.lats = np.asarray(lats, dtype=np.float64).ravel()
+        self.lons = np.asarray(lons, dtype=np.float64).ravel()
+        if self.lats.shape != self.lons.shape:
+            raise ValueError("lats and lons need the same length")
+        self.items = items
+        self.cell_km = cell_km
+        n = len(self.lats)
+
+        self.lat0 = float(self.lats.mean()) if n else 0.0
+        self.lon0 = float(self.lons.mean()) if n else 0.0
+        self.x_scale = math.cos(math.radians(self.lat0)) * KM_PER_DEGREE
+        # east-west distances shrink away from lat0, this is the smallest true / projected ratio
+        max_lat = min(89.9, float(np.abs(self.lats).max())) if n else 0.0
+        self.min_scale = min(1.0, math.cos(math.radians(max_lat)) / math.cos(math.radians(self.lat0)))
+
+        cx, cy = self._cells(self.lats, self.lons)
+        self.order = np.lexsort((cy, cx))
+        keys = np.stack([cx[self.order], cy[self.order]], axis=1)
+        unique, starts = np.unique(keys, axis=0, return_index=True)
+        self.cell_x = unique[:, 0]
+        self.cell_y = unique[:, 1]
+        self.starts = starts
+        self.ends = np.append(starts[1:], n).astype(starts.dtype)
+        self.cells = {
+            (int(x), int(y)): (int(s), int(e))
+            for x, y, s, e in zip(self.cell_x, self.cell_y, self.starts, self.ends)
+        }
+
+    # Builds an index from hybrid.py style tuples, (name, lat, lon, ...)
+    @classmethod
+    def from_locations(cls, locations, cell_km=CELL_KM):
+        lats = [float(loc[1]) for loc in locations]
+        lons = [float(loc[2]) for loc in locations]
+        return cls(lats, lons, items=locations, cell_km=cell_km)
+
+    def __len__(self):
+        return len(self.lats)
+
+    def _cells(self, lats, lons):
+        x = (np.asarray(lons, dtype=np.float64) - self.lon0) * self.x_scale
+        y = (np.asarray(lats, dtype=np.float64) - self.lat0) * KM_PER_DEGREE
+        return np.floor(x / self.cell_km).astype(np.int64), np.floor(y / self.cell_km).astype(np.int64)
+
+    def _cell(self, lat, lon):
+        cx, cy = self._cells(lat, lon)
+        return int(cx), int(cy)
+
+    def _gather(self, slices):
+        parts = [self.order[s:e] for s, e in slices]
+        if not parts:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(parts)
+
+    # Point indices inside a block of cells
+    def _block(self, x0, x1, y0, y1):
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= len(self.cells):
+            slices = [self.cells[(x, y)] for x in range(x0, x1 + 1) for y in range(y0, y1 + 1)
+                      if (x, y) in self.cells]
+        else:
+            mask = (self.cell_x >= x0) & (self.cell_x <= x1) & (self.cell_y >= y0) & (self.cell_y <= y1)
+            slices = zip(self.starts[mask], self.ends[mask])
+        return self._gather(slices)
+
+    # Point indices in the cells exactly `ring` cells away from (cx, cy)
+    def _ring(self, cx, cy, ring):
+        if ring == 0:
+            return self._gather([self.cells[(cx, cy)]] if (cx, cy) in self.cells else [])
+        if 8 * ring <= len(self.cells):
+            keys = [(x, cy - ring) for x in range(cx - ring, cx + ring + 1)]
+            keys += [(x, cy + ring) for x in range(cx - ring, cx + ring + 1)]
+            keys += [(cx - ring, y) for y in range(cy - ring + 1, cy + ring)]
+            keys += [(cx + ring, y) for y in range(cy - ring + 1, cy + ring)]
+            slices = [self.cells[key] for key in keys if key in self.cells]
+        else:
+            cheb = np.maximum(np.abs(self.cell_x - cx), np.abs(self.cell_y - cy))
+            mask = cheb == ring
+            slices = zip(self.starts[mask], self.ends[mask])
+        return self._gather(slices)
+
+    # Indices of every location within radius km of a point, in the order they were given.
+    # With return_distances the distances in km are returned as well
+    def within(self, lat, lon, radius, return_distances=False):
+        if len(self) == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return (empty, np.empty(0)) if return_distances else empty
+        dlat = radius / KM_PER_DEGREE
+        edge = min(89.9, abs(lat) + dlat)
+        dlon = min(180.0, radius / (KM_PER_DEGREE * math.cos(math.radians(edge))))
+        x0, y0 = self._cell(lat - dlat, lon - dlon)
+        x1, y1 = self._cell(lat + dlat, lon + dlon)
+
+        candidates = np.sort(self._block(x0, x1, y0, y1))
+        dists = distance.one_to_many(lat, lon, self.lats[candidates], self.lons[candidates])
+        inside = dists <= radius
+        if return_distances:
+            return candidates[inside], dists[inside]
+        return candidates[inside]
+
+    def count_within(self, lat, lon, radius):
+        return len(self.within(lat, lon, radius))
+
+    # Indices and distances in km of the k locations closest to a point, closest first.
+    # Searches outwards one ring of cells at a time and stops once no unseen cell can be closer
+    def nearest(self, lat, lon, k=1):
+        k = min(k, len(self))
+        if k <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        cx, cy = self._cell(lat, lon)
+        last_ring = int(max(np.abs(self.cell_x - cx).max(), np.abs(self.cell_y - cy).max()))
+
+        found = []
+        found_dists = []
+        count = 0
+        for ring in range(last_ring + 1):
+            indices = self._ring(cx, cy, ring)
+            if len(indices):
+                found.append(indices)
+                found_dists.append(distance.one_to_many(lat, lon, self.lats[indices], self.lons[indices]))
+                count += len(indices)
+            if count >= k:
+                kth = np.partition(np.concatenate(found_dists), k - 1)[k - 1]
+                # anything not seen yet is in a cell at least ring + 1 cells away
+                if kth <= ring * self.cell_km * self.min_scale * SLACK:
+                    break
+
+        indices = np.concatenate(found)
+        dists = np.concatenate(found_dists)
+        best = np.argsort(dists, kind="stable")[:k]
+        return indices[best], dists[best]
+
+    # Index and distance in km of the closest location to each of many points, -1 and inf when
+    # the index is empty. Points in the same cell share one search: the first ring of cells with
+    # any locations bounds how far away the closest one can be, every location up to that distance
+    # is gathered once and compared with all the points of the cell together
+    def nearest_many(self, lats, lons):
+        lats = np.asarray(lats, dtype=np.float64).ravel()
+        lons = np.asarray(lons, dtype=np.float64).ravel()
+        indices = np.full(len(lats), -1, dtype=np.int64)
+        dists = np.full(len(lats), np.inf)
+        if len(self) == 0 or len(lats) == 0:
+            return indices, dists
+
+        cx, cy = self._cells(lats, lons)
+        cells, inverse = np.unique(np.stack([cx, cy], axis=1), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse, kind="stable")
+        bounds = np.searchsorted(inverse[order], np.arange(len(cells) + 1))
+        for c, (x, y) in enumerate(cells.tolist()):
+            queries = order[bounds[c]:bounds[c + 1]]
+            last_ring = int(max(np.abs(self.cell_x - x).max(), np.abs(self.cell_y - y).max()))
+            ring = 0
+            found = [self._ring(x, y, 0)]
+            while not len(found[-1]) and ring < last_ring:
+                ring += 1
+                found.append(self._ring(x, y, ring))
+            candidates = np.concatenate(found)
+            d = distance.many_to_many(lats[queries], lons[queries], self.lats[candidates], self.lons[candidates])
+            # anything in a ring r cells away is at least r - 1 cells from every point of this cell
+            farthest = float(d.min(axis=1).max())
+            stop = min(last_ring, int(math.ceil(farthest / (self.cell_km * self.min_scale * SLACK))))
+            if stop > ring:
+                more = np.concatenate([self._ring(x, y, r) for r in range(ring + 1, stop + 1)])
+                if len(more):
+                    candidates = np.concatenate([candidates, more])
+                    d = np.concatenate([d, distance.many_to_many(
+                        lats[queries], lons[queries], self.lats[more], self.lons[more])], axis=1)
+            best = np.argmin(d, axis=1)
+            indices[queries] = candidates[best]
+            dists[queries] = d[np.arange(len(queries)), best]
+        return indices, dists
@@ -0,0 +1,193 @@
+import heapq
+import numpy as np
+import distance
+import overpass
+import instrumentation
+from spatial_index import SpatialIndex, KM_PER_DEGREE
+
+# Walking distances over the road and path network instead of straight lines, so a location across a
+# river or a rail line only counts as close when there is a way to walk there.
+# The network is the walkable ways with their geometry (the walk_graph Overpass query), and one
+# shortest path search from the user gives the walking distance to every location at once
+
+# Ways are fetched this much further out than the walking limit, so a path that leaves
+# the circle and comes back in is still part of the network
+GRAPH_MARGIN = 1.25
+# Farthest a location or the user can be from the closest path and still be reached, in km
+MAX_SNAP_KM = 0.15
+# Points are put along every edge this far apart to find the edges near a point, in km.
+# The edge picked for a point is at most half of this further away than the closest one
+SNAP_STEP_KM = 0.01
+
+# Undirected graph of path nodes, with the edges of every node stored together (CSR):
+# the neighbours of node i are neighbors[indptr[i]:indptr[i + 1]], weights are in km.
+# Points are snapped to the closest spot on an edge, not to the closest node, since streets
+# often only have nodes where they cross
+class WalkGraph:
+    def __init__(self, elements):
+        node_index = {}
+        lats = []
+        lons = []
+        starts = []
+        ends = []
+        for el in elements:
+            refs = el.get('nodes')
+            geometry = el.get('geometry')
+            if not refs or not geometry or len(refs) != len(geometry):
+                continue
+            previous = None
+            for ref, point in zip(refs, geometry):
+                # nodes without a position split the way
+                if point is None:
+                    previous = None
+                    continue
+                i = node_index.get(ref)
+                if i is None:
+                    i = node_index[ref] = len(lats)
+                    lats.append(point['lat'])
+                    lons.append(point['lon'])
+                if previous is not None and previous != i:
+                    starts.append(previous)
+                    ends.append(i)
+                previous = i
+
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.edge_starts = np.asarray(starts, dtype=np.int64)
+        self.edge_ends = np.asarray(ends, dtype=np.int64)
+        self.edge_lengths = distance.pairwise(
+            self.lats[self.edge_starts], self.lons[self.edge_starts],
+            self.lats[self.edge_ends], self.lons[self.edge_ends]
+        )
+
+        # every way can be walked both ways
+        sources = np.concatenate([self.edge_starts, self.edge_ends])
+        order = np.argsort(sources, kind="stable")
+        self.neighbors = np.concatenate([self.edge_ends, self.edge_starts])[order]
+        self.weights = np.concatenate([self.edge_lengths, self.edge_lengths])[order]
+        self.indptr = np.searchsorted(sources[order], np.arange(len(lats) + 1))
+
+        # evenly spaced points along every edge, each one knows its edge
+        steps = np.maximum(np.ceil(self.edge_lengths / SNAP_STEP_KM).astype(np.int64), 1) + 1
+        point_edges = np.repeat(np.arange(len(steps)), steps)
+        first = np.cumsum(steps) - steps
+        t = (np.arange(len(point_edges)) - first[point_edges]) / (steps[point_edges] - 1)
+        a = self.edge_starts[point_edges]
+        b = self.edge_ends[point_edges]
+        point_lats = self.lats[a] + t * (self.lats[b] - self.lats[a])
+        point_lons = self.lons[a] + t * (self.lons[b] - self.lons[a])
+        self.index = SpatialIndex(point_lats, point_lons, items=point_edges) if len(point_edges) else None
+
+    def __len__(self):
+        return len(self.lats)
+
+    # Closest spot on the network to each of many points, with one batched nearest query.
+    # Returns the edge, how far along it the spot is (0 at its start node, 1 at its end node)
+    # and the distance in km from the point to the spot. Edges are -1 and distances inf without edges
+    def snap_many(self, lats, lons):
+        lats = np.asarray(lats, dtype=np.float64).ravel()
+        lons = np.asarray(lons, dtype=np.float64).ravel()
+        if self.index is None:
+            return np.full(len(lats), -1, dtype=np.int64), np.zeros(len(lats)), np.full(len(lats), np.inf)
+        points, _ = self.index.nearest_many(lats, lons)
+        edges = self.index.items[points]
+
+        # the spot on the edge closest to the point, in km east and north of the point
+        x_scale = np.cos(np.radians(lats)) * KM_PER_DEGREE
+        a = self.edge_starts[edges]
+        b = self.edge_ends[edges]
+        ax = (self.lons[a] - lons) * x_scale
+        ay = (self.lats[a] - lats) * KM_PER_DEGREE
+        dx = (self.lons[b] - lons) * x_scale - ax
+        dy = (self.lats[b] - lats) * KM_PER_DEGREE - ay
+        length2 = dx * dx + dy * dy
+        t = np.clip(-(ax * dx + ay * dy) / np.where(length2 > 0, length2, 1.0), 0.0, 1.0)
+        return edges, t, np.hypot(ax + t * dx, ay + t * dy)
+
+    # Closest spot on the network to one point, see snap_many
+    def snap(self, lat, lon):
+        edges, t, dists = self.snap_many([lat], [lon])
+        return int(edges[0]), float(t[0]), float(dists[0])
+
+    # Dijkstra from one or more nodes, each starting start_km away, stopping at max_km.
+    # Returns the walking distance to every node, inf for the nodes further than max_km or not connected
+    def shortest_paths(self, sources, max_km=float('inf'), start_km=0.0):
+        sources = np.atleast_1d(sources).tolist()
+        start_km = np.broadcast_to(np.asarray(start_km, dtype=np.float64), (len(sources),)).tolist()
+        indptr = self.indptr.tolist()
+        neighbors = self.neighbors.tolist()
+        weights = self.weights.tolist()
+        dist = [float('inf')] * len(self)
+        heap = []
+        for source, km in zip(sources, start_km):
+            if km <= max_km and km < dist[source]:
+                dist[source] = km
+                heap.append((km, source))
+        heapq.heapify(heap)
+        while heap:
+            d, node = heapq.heappop(heap)
+            if d > dist[node]:
+                continue
+            for j in range(indptr[node], indptr[node + 1]):
+                nd = d + weights[j]
+                neighbor = neighbors[j]
+                if nd <= max_km and nd < dist[neighbor]:
+                    dist[neighbor] = nd
+                    heapq.heappush(heap, (nd, neighbor))
+        return np.array(dist)
+
+    # True when the point is close enough to a path to walk from
+    def reaches(self, lat, lon):
+        return self.snap(lat, lon)[2] <= MAX_SNAP_KM
+
+    # Walking distance in km from the user to every location, with one shortest path search.
+    # The user and each location walk in a straight line to the closest spot on a path and then
+    # along that edge to one of its ends, or straight along it when both are on the same edge.
+    # Locations further than max_km or off the network get inf
+    def walking_distances(self, lat, lon, lats, lons, max_km=float('inf')):
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        result = np.full(len(lats), np.inf)
+        edge, t, source_km = self.snap(lat, lon)
+        if edge < 0 or source_km > MAX_SNAP_KM:
+            return result
+        length = self.edge_lengths[edge]
+        node_dist = self.shortest_paths(
+            [self.edge_starts[edge], self.edge_ends[edge]], max_km,
+            [source_km + t * length, source_km + (1 - t) * length]
+        )
+
+        edges, along, snap_km = self.snap_many(lats, lons)
+        reached = snap_km <= MAX_SNAP_KM
+        edges = np.where(reached, edges, 0)
+        lengths = self.edge_lengths[edges]
+        walk = np.minimum(
+            node_dist[self.edge_starts[edges]] + along * lengths,
+            node_dist[self.edge_ends[edges]] + (1 - along) * lengths
+        )
+        same = edges == edge
+        walk[same] = np.minimum(walk[same], source_km + np.abs(along[same] - t) * length)
+        result[reached] = walk[reached] + snap_km[reached]
+        result[result > max_km] = np.inf
+        return result
+
+# The walking network around a point, big enough for walks of up to rad km
+@instrumentation.timed("walk_graph")
+def fetch_graph(lat, lon, rad):
+    graph = WalkGraph(overpass.fetch_elements("walk_graph", lat, lon, rad * GRAPH_MARGIN))
+    instrumentation.count("walk_graph_nodes", len(graph))
+    return graph
+
+# Keeps the locations that are at most max_km away on foot (an isochrone) and returns them with
+# their walking distances. When the user is not near the network the locations and None
+# are returned, so the straight line distances are used as before
+def within_walk(coords, locations, max_km, graph=None):
+    if graph is None:
+        graph = fetch_graph(coords[0], coords[1], max_km)
+    if not locations or not graph.reaches(coords[0], coords[1]):
+        return locations, None
+    dists = graph.walking_distances(
+        coords[0], coords[1], [float(loc[1]) for loc in locations], [float(loc[2]) for loc in locations], max_km
+    )
+    keep = np.flatnonzero(np.isfinite(dists))
+    return [locations[i] for i in keep], dists[keep]
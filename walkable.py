@@ -1,49 +1,39 @@
-import folium
-from geopy.geocoders import Nominatim
-from folium import Circle
-import webbrowser
+import overpass
+import simulation
+import distance
+import geocode
 import os
-import requests
-from tqdm import tqdm
 import numpy as np
-import matplotlib.pyplot as plt
+import display
+import maps
+import plotting
+import results
+import instrumentation
+import path_sampler
 from collections import defaultdict
 
-# Using the Overpass API for mapping
-OVERPASS_URL = "http://overpass-api.de/api/interpreter"
+# Where the walkable points come from: "centers" uses the center of every road and path,
+# "paths" draws random points along them (see path_sampler.py). Set DATAPRIVACY_WALKABLE_POINTS
+WALKABLE_POINTS = os.environ.get("DATAPRIVACY_WALKABLE_POINTS", "centers").strip().lower()
 
 # Generate coordinates from an address
 def get_coordinates(address):
-    geolocator = Nominatim(user_agent="geoapi")
-    location = geolocator.geocode(address)
-    if location:
-        return (location.latitude, location.longitude)
-    else:
-        return None
+    return geocode.get_coordinates(address)
 
 # Using coordinates, find walkable areas using a query
+@instrumentation.timed("candidates")
 def FindWalkableAreas(lat, lon, rad):
 
     # Query for areas around highways
-    query = f"""
-    [out:json];
-    (
-      way["highway"](around:{rad * 1000},{lat},{lon})
-        ["highway"!~"motorway|motorway_link"];
-    );
-    out center tags;
-    """
     try:
-        response = requests.get(OVERPASS_URL, params={'data': query}, timeout=10)
-        response.raise_for_status()
-        data = response.json()
+        elements = overpass.fetch_elements("walkable", lat, lon, rad, timeout=10)
     except Exception as e:
         print("Overpass API error:", e)
         return []
 
     # Parse the JSON file to put walkable locations in a list
     walkable_areas = []
-    for el in data.get('elements', []):
+    for el in elements:
         center = el.get('center')
         if center:
             lat_center = center.get('lat')
@@ -52,10 +42,41 @@ def FindWalkableAreas(lat, lon, rad):
                 highway_type = el['tags'].get('highway', 'unknown')
                 name = el['tags'].get('name', f"Walkable Area ({highway_type})")
                 walkable_areas.append((name, lat_center, lon_center, f"highway={highway_type}", "walkable"))
+    instrumentation.count("walkable_found", len(walkable_areas))
     return walkable_areas
 
+# count random points along the roads and paths within the radius, in the same shape as FindWalkableAreas
+def SamplePathPoints(lat, lon, rad, count, rng=None):
+    try:
+        segments = path_sampler.fetch_segments(lat, lon, rad)
+    except Exception as e:
+        print("Overpass API error:", e)
+        return []
+
+    lats, lons, way_ids = segments.sample(count, rng)
+    points = []
+    for point_lat, point_lon, way_id in zip(lats.tolist(), lons.tolist(), way_ids.tolist()):
+        tags = segments.ways[way_id].get('tags', {})
+        highway_type = tags.get('highway', 'unknown')
+        name = tags.get('name', f"Walkable Area ({highway_type})")
+        points.append((name, point_lat, point_lon, f"highway={highway_type}", "walkable"))
+    instrumentation.count("walkable_found", len(points))
+    return points
+
+# The walkable points to use for num_runs runs, picked by WALKABLE_POINTS
+def FindWalkablePoints(lat, lon, rad, num_runs):
+    if WALKABLE_POINTS == "paths":
+        return SamplePathPoints(lat, lon, rad, num_runs)
+    if WALKABLE_POINTS != "centers":
+        print(f"Unknown walkable points setting {WALKABLE_POINTS}, using centers")
+    return FindWalkableAreas(lat, lon, rad)
+
 # Create the map of walkable locations
-def create_map(center_lat, center_lon, radius_km, walkable_areas):
+# map_mode is one of maps.MAP_MODES, many walkable areas are drawn as a cluster or heatmap
+@instrumentation.timed("render_map")
+def create_map(center_lat, center_lon, radius_km, walkable_areas, map_mode=None):
+    import folium
+    from folium import Circle
     Map = folium.Map(location=[center_lat, center_lon], zoom_start=13)
     folium.Marker([center_lat, center_lon], popup="Center Location").add_to(Map)
 
@@ -69,43 +90,78 @@ def create_map(center_lat, center_lon, radius_km, walkable_areas):
     ).add_to(Map)
 
     # Take all the walkable areas and show them on the map
-    for name, lat, lon, tags, _ in walkable_areas:
-        folium.CircleMarker(
-            location=[lat, lon],
-            radius=3,
-            color='black',
-            fill=True,
-            fill_opacity=1,
-            popup=f"{name}\n{tags}"
-        ).add_to(Map)
+    mode = maps.choose_mode(len(walkable_areas), map_mode)
+    if mode == "markers":
+        for name, lat, lon, tags, _ in walkable_areas:
+            folium.CircleMarker(
+                location=[lat, lon],
+                radius=3,
+                color='black',
+                fill=True,
+                fill_opacity=1,
+                popup=f"{name}\n{tags}"
+            ).add_to(Map)
+    else:
+        maps.add_layer(
+            Map, mode, [area[1] for area in walkable_areas], [area[2] for area in walkable_areas],
+            labels=[f"{name}<br>{tags}" for name, _, _, tags, _ in walkable_areas]
+        )
 
     Map.save("Walkable_Map.html")
-    webbrowser.open('file://' + os.path.realpath("Walkable_Map.html"))
+    display.open_map("Walkable_Map.html")
 
 # Write to a text file all the found walkable locations
+@instrumentation.timed("write_results")
 def save_to_file(points, filename="Walkable.txt"):
+    lines = ["Walkable areas:", ""]
+    lines += [f"{name}: ({lat}, {lon})" for name, lat, lon, tags, status in points]
     with open(filename, "w", encoding="utf-8") as f:
-        f.write("Walkable areas:\n\n")
-        for name, lat, lon, tags, status in points:
-            f.write(f"{name}: ({lat}, {lon})\n")
+        f.write("\n".join(lines) + "\n")
 
 # Harversine formula for finding the distance between two coordinates
 # https://www.geeksforgeeks.org/haversine-formula-to-find-distance-between-two-points-on-a-sphere/
 def CalculateDistance(lat1, lon1, lat2, lon2):
-    R = 6371.0
-    lat1_rad = np.radians(lat1)
-    lon1_rad = np.radians(lon1)
-    lat2_rad = np.radians(lat2)
-    lon2_rad = np.radians(lon2)
+    return distance.haversine(lat1, lon1, lat2, lon2)
 
-    dlon = lon2_rad - lon1_rad
-    dlat = lat2_rad - lat1_rad
+# Runs the walkable method for a location and returns the kept walkable areas and the
+# utility and privacy after each one, or None when no walkable areas are found.
+# Walkable areas that were already found can be passed in to skip the query
+def run_walkable(coords, radius, num_runs, total_walkable_areas=None):
+    if total_walkable_areas is None:
+        total_walkable_areas = FindWalkablePoints(coords[0], coords[1], radius, num_runs)
 
-    a = np.sin(dlat / 2) ** 2 + np.cos(lat1_rad) * np.cos(lat2_rad) * np.sin(dlon / 2) ** 2
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    if not total_walkable_areas:
+        return None
 
-    distance = R * c
-    return distance 
+    if len(total_walkable_areas) < num_runs:
+        num_runs = len(total_walkable_areas)
+
+    # Every iteration adds the next walkable area. Privacy is the distance from the centroid of
+    # the current walkable areas to the user, utility is the average distance to them
+    walkable_areas = total_walkable_areas[:num_runs]
+    utility_values, privacy_values = simulation.curves(
+        [area[1] for area in walkable_areas], [area[2] for area in walkable_areas],
+        coords[0], coords[1], np.arange(num_runs)
+    )
+
+    return {
+        "walkable_areas": walkable_areas,
+        "utility": utility_values.tolist(),
+        "privacy": privacy_values.tolist(),
+    }
+
+# The utility and privacy panels of the graph
+def graph_panels(utility_values, privacy_values):
+    return [
+        (utility_values, dict(marker='o', color='green'), 'Utility vs Iteration', 'Iteration',
+         'Utility (Avg Distance to Chosen POIs)'),
+        (privacy_values, dict(marker='o', color='red'), 'Privacy vs Iteration', 'Iteration',
+         'Privacy (Distance to Centroid of POIs)'),
+    ]
+
+# Plot the privacy and utility vs iteration, the graph is saved to path
+def create_graph(utility_values, privacy_values, path="Walkable_Utility_Privacy_Graph"):
+    plotting.save_panels(path, graph_panels(utility_values, privacy_values))
 
 def main():
     # From the user get an address or coordinates for their chosen location
@@ -143,71 +199,24 @@ def main():
         return
 
     print("Finding walkable areas using Overpass API...")
-    total_walkable_areas = FindWalkableAreas(coords[0], coords[1], radius)
+    result = run_walkable(coords, radius, num_runs)
 
-    if not total_walkable_areas:
+    if result is None:
         print("No walkable areas found.")
         return
-    
-    walkable_areas = []
-    utility_values = []
-    privacy_values = []
-
-    if len(total_walkable_areas) < num_runs:
-        num_runs = len(total_walkable_areas)
-
-    # For each iteration, calculate the privacy and utility values and save them
-    for x in range(num_runs):
-        chosen = total_walkable_areas[x]
-        walkable_areas.append(chosen)
-
-        utility = 0.0
-        privacy = 0.0
-
-        # Privacy is the distance from the centroid of all current POIs in the iteration to the chosen location
-        lat_sum = sum(p[1] for p in walkable_areas)
-        lon_sum = sum(p[2] for p in walkable_areas)
-        centroid_lat = lat_sum / len(walkable_areas)
-        centroid_lon = lon_sum / len(walkable_areas)
-        privacy = CalculateDistance(coords[0], coords[1], centroid_lat, centroid_lon)
 
-        total = 0
-        for _, lat, lon, *_ in walkable_areas:
-            total += CalculateDistance(coords[0], coords[1], lat, lon)
-        utility = total / x
-
-        utility_values.append(utility)
-        privacy_values.append(privacy)
-
-        print(f"Iteration {x + 1}")
-        print(f"Privacy = {privacy}")
-        print(f"Utility = {utility}")
-        print("")
+    results.print_runs(
+        f"Iteration {x + 1}\nPrivacy = {privacy}\nUtility = {utility}\n"
+        for x, (utility, privacy) in enumerate(zip(result["utility"], result["privacy"]))
+    )
 
     # Create the map and text files
-    save_to_file(walkable_areas)
-    create_map(coords[0], coords[1], radius, walkable_areas)
+    save_to_file(result["walkable_areas"])
+    create_map(coords[0], coords[1], radius, result["walkable_areas"])
 
     # Plot the privacy and utility vs iteration
-    plt.figure(figsize=(12, 5))
-
-    plt.subplot(1, 2, 1)
-    plt.plot(range(1, num_runs + 1), utility_values, marker='o', color='green')
-    plt.title('Utility vs Iteration')
-    plt.xlabel('Iteration')
-    plt.ylabel('Utility (Avg Distance to Chosen POIs)')
-
-    plt.subplot(1, 2, 2)
-    plt.plot(range(1, num_runs + 1), privacy_values, marker='o', color='red')
-    plt.title('Privacy vs Iteration')
-    plt.xlabel('Iteration')
-    plt.ylabel('Privacy (Distance to Centroid of POIs)')
-
-    plt.tight_layout()
-    plt.savefig("Walkable_Utility_Privacy_Graph")
-    plt.show()
-
-    
+    create_graph(result["utility"], result["privacy"])
 
 if __name__ == "__main__":
     main()
+    instrumentation.save()